@@ -1,6 +1,5 @@
 from django.conf import settings
 from crits.core.mongo_tools import mongo_connector
-from crits.core.class_mapper import class_from_id
 from crits.core.handlers import collect_objects
 from crits.backdoors.backdoor import Backdoor
 from crits.emails.email import Email
@@ -17,81 +16,134 @@ def source_match(item_source, sources):
             return True
     return False
 
-def get_md5_objects(oid, sources, md5_list=[], x=0):
+# Number of ids in each $in query when prefetching.
+PREFETCH_BATCH = 500
+
+# Sample fields used in the CSV output.
+SAMPLE_FIELDS = ('md5', 'mimetype', 'filename', 'obj', 'relationships')
+
+EMAIL_FIELDS = ('isodate', 'sender', 'subject', 'x_originating_ip', 'x_mailer',
+                'source', 'campaign', 'relationships')
+
+# Samples and Backdoors for one export. Objects are fetched in batches with
+# $in and kept until the export is done, so each is read at most once. Objects
+# which do not exist or are not in the user's sources are kept as None.
+class ObjectCache(object):
+    def __init__(self, sources):
+        self.sources = sources
+        self.samples = {}
+        self.backdoors = {}
+
+    def _load(self, klass, cache, ids, fields):
+        ids = list(set(str(id_) for id_ in ids) - set(cache))
+        for i in xrange(0, len(ids), PREFETCH_BATCH):
+            batch = ids[i:i + PREFETCH_BATCH]
+            for id_ in batch:
+                cache[id_] = None
+            objs = klass.objects(id__in=batch,
+                                 source__name__in=self.sources).only(*fields)
+            for obj in objs:
+                cache[str(obj.id)] = obj
+
+    def load_samples(self, ids):
+        self._load(Sample, self.samples, ids, SAMPLE_FIELDS)
+
+    def load_backdoors(self, ids):
+        self._load(Backdoor, self.backdoors, ids, ('name',))
+
+    def sample(self, oid):
+        oid = str(oid)
+        if oid not in self.samples:
+            self.load_samples([oid])
+        return self.samples[oid]
+
+    # Walk the relationships on this sample, see if it is related to a
+    # backdoor. Take the first backdoor that comes up, it may or may not be
+    # the versioned one.
+    def backdoor_name(self, sample):
+        ids = rel_ids(sample.relationships, 'Backdoor')
+        self.load_backdoors(ids)
+        for id_ in ids:
+            backdoor = self.backdoors[str(id_)]
+            if backdoor:
+                return backdoor.name
+        return "None"
+
+def rel_ids(rels, rel_type):
+    return [r.object_id for r in rels if r.rel_type == rel_type]
+
+# Prefetch the given samples, their backdoors and the samples related to them.
+def prefetch_samples(cache, ids):
+    cache.load_samples(ids)
+    samples = [cache.samples[str(id_)] for id_ in ids]
+    samples = [s for s in samples if s]
+    related = []
+    backdoors = []
+    for s in samples:
+        related.extend(rel_ids(s.relationships, 'Sample'))
+        backdoors.extend(rel_ids(s.relationships, 'Backdoor'))
+    cache.load_samples(related)
+    cache.load_backdoors(backdoors)
+
+def sample_object_values(s, sources):
+    for o in s.obj:
+        if o.object_type in [ObjectTypes.DOMAIN, ObjectTypes.IPV4_ADDRESS, ObjectTypes.C2_URL] and source_match(o.source, sources):
+            yield o.value
+
+# Objects on a sample and on the samples directly related to it.
+def get_md5_objects(oid, sources, md5_list=None, cache=None):
+    if md5_list is None:
+        md5_list = []
+    if cache is None:
+        cache = ObjectCache(sources)
+
     obj_list = []
-    s = class_from_id('Sample', oid)
+    s = cache.sample(oid)
     if not s:
         return obj_list
 
-    if not source_match(s.source, sources):
-        return obj_list
-
     md5_list.append(s.md5)
+    obj_list.extend(sample_object_values(s, sources))
 
-    for o in s.obj:
-        if o.object_type in [ObjectTypes.DOMAIN, ObjectTypes.IPV4_ADDRESS, ObjectTypes.C2_URL] and source_match(o.source, sources):
-            obj_list.append(o.value)
-    for r in s.relationships:
-        if r.rel_type == 'Sample':
-            s2 = class_from_id('Sample', r.object_id)
-            if not s2:
-                continue
-
-            if not source_match(s2.source, sources):
-                continue
-
-            if s2.md5 not in md5_list and x < 1:
-                obj_list += get_md5_objects(r.object_id, sources, md5_list, x + 1)
+    related = rel_ids(s.relationships, 'Sample')
+    cache.load_samples(related)
+    for object_id in related:
+        s2 = cache.samples[str(object_id)]
+        if not s2 or s2.md5 in md5_list:
+            continue
+        md5_list.append(s2.md5)
+        obj_list.extend(sample_object_values(s2, sources))
     return obj_list
 
-def get_sample_rels(rel, eid, sources):
-    s_list = []
-    for r in rel:
-        if r.rel_type == 'Sample':
-            s = class_from_id(r.rel_type, r.object_id)
-            if not s:
-                continue
-
-            if not source_match(s.source, sources):
-                continue
-
-            obj_list = get_md5_objects(r.object_id, sources)
-            # Walk the relationships on this sample, see if it is related to
-            # a backdoor. Take the first backdoor that comes up, it may or
-            # may not be the versioned one.
-            backdoor_name = "None"
-            for sample_r in s.relationships:
-                if sample_r.rel_type == 'Backdoor':
-                    backdoor = Backdoor.objects(id=sample_r.object_id).first()
-                    if backdoor and source_match(backdoor.source, sources):
-                        backdoor_name = backdoor.name
-                        break
-            s_list.append({
-                'md5': s.md5,
-                'email_id': eid,
-                'mimetype': s.mimetype,
-                'filename': s.filename,
-                'backdoor': backdoor_name,
-                'objects':  obj_list,
-                })
-    return s_list
+def get_sample_rels(rel, eid, sources, cache=None):
+    if cache is None:
+        cache = ObjectCache(sources)
 
-# Given an event ID grab all related objects and generate CSV output for
-# them. Do not recurse any deeper than that in collect_objects.
-def generate_anb_event_data(type_, cid, data, sources):
-    types = ['Email', 'Sample', 'Indicator', 'IP', 'Domain', 'Event']
-    related_objects = collect_objects(type_,
-                                      cid,
-                                      1, # Depth limit
-                                      250, # Total limit
-                                      100, # Rel limit
-                                      types,
-                                      sources,
-                                      need_filedata=False)
+    for object_id in rel_ids(rel, 'Sample'):
+        s = cache.sample(object_id)
+        if not s:
+            continue
+
+        yield {
+            'md5': s.md5,
+            'email_id': eid,
+            'mimetype': s.mimetype,
+            'filename': s.filename,
+            'backdoor': cache.backdoor_name(s),
+            'objects': get_md5_objects(object_id, sources, cache=cache),
+            }
+
+# Collect (key, row) pairs from a row generator into one CSV string per key.
+def join_rows(rows, keys):
+    data = dict((k, []) for k in keys)
+    for (key, row) in rows:
+        data[key].append(row)
+    return dict((k, ''.join(v)) for (k, v) in data.iteritems())
 
+def anb_event_rows(cid, related_objects, cache):
     for (obj_id, (obj_type, obj)) in related_objects.iteritems():
         if obj_type == 'Email':
-            data['emails'] += "%s,%s,%s,%s,%s,%s,%s\r\n" % (
+            yield 'emails', "%s,%s,%s,%s,%s,%s,%s\r\n" % (
                 cid,
                 obj_id,
                 obj.isodate,
@@ -100,51 +152,66 @@ def generate_anb_event_data(type_, cid, data, sources):
                 obj.x_originating_ip,
                 obj.x_mailer)
         elif obj_type == 'Sample':
-            # Walk the relationships on this sample, see if it is related to
-            # a backdoor. Take the first backdoor that comes up, it may or
-            # may not be the versioned one.
-            backdoor_name = "None"
-            for rel in obj.relationships:
-                if rel.rel_type == 'Backdoor':
-                    backdoor = Backdoor.objects(id=rel.object_id).first()
-                    if backdoor and source_match(backdoor.source, sources):
-                        backdoor_name = backdoor.name
-                        break
-            data['samples'] += "%s,%s,%s,%s,%s,%s\r\n" % (
+            yield 'samples', "%s,%s,%s,%s,%s,%s\r\n" % (
                 cid,
                 obj_id,
                 obj.md5,
                 obj.mimetype,
                 obj.filename,
-                backdoor_name)
+                cache.backdoor_name(obj))
             for inner_obj in obj.obj:
-                data['objects'] += "%s,%s,%s\r\n" % (
+                yield 'objects', "%s,%s,%s\r\n" % (
                     obj_id,
                     inner_obj.object_type,
                     inner_obj.value)
         elif obj_type == 'Indicator':
-            data['indicators'] += "%s,%s,%s,%s\r\n" % (
+            yield 'indicators', "%s,%s,%s,%s\r\n" % (
                 cid,
                 obj_id,
                 obj.ind_type,
                 obj.value)
         elif obj_type == 'IP':
-            data['ips'] += "%s,%s,%s,%s\r\n" % (
+            yield 'ips', "%s,%s,%s,%s\r\n" % (
                 cid,
                 obj_id,
                 obj.ip_type,
                 obj.ip)
         elif obj_type == 'Domain':
-            data['domains'] += "%s,%s,%s,%s\r\n" % (
+            yield 'domains', "%s,%s,%s,%s\r\n" % (
                 cid,
                 obj_id,
                 obj.record_type,
                 obj.domain)
         elif obj_type == 'Event':
-            data['events'] += "%s,%s,%s\r\n" % (
+            yield 'events', "%s,%s,%s\r\n" % (
                 cid,
                 obj_id,
                 obj.title)
+
+# Given an event ID grab all related objects and generate CSV output for
+# them. Do not recurse any deeper than that in collect_objects.
+def generate_anb_event_data(type_, cid, data, sources):
+    types = ['Email', 'Sample', 'Indicator', 'IP', 'Domain', 'Event']
+    related_objects = collect_objects(type_,
+                                      cid,
+                                      1, # Depth limit
+                                      250, # Total limit
+                                      100, # Rel limit
+                                      types,
+                                      sources,
+                                      need_filedata=False)
+
+    # Look up the backdoors of all the samples at once.
+    cache = ObjectCache(sources)
+    backdoors = []
+    for (obj_type, obj) in related_objects.itervalues():
+        if obj_type == 'Sample':
+            backdoors.extend(rel_ids(obj.relationships, 'Backdoor'))
+    cache.load_backdoors(backdoors)
+
+    rows = join_rows(anb_event_rows(cid, related_objects, cache), data.keys())
+    for (key, value) in rows.iteritems():
+        data[key] += value
     return data
 
 def execute_anb_event(cid, sources):
@@ -166,22 +233,13 @@ def execute_anb_event(cid, sources):
 
     return data
 
-# Get every email in the campaign first, then walk each email looking for
-# samples related to the email. Then get objects for those samples.
-def execute_anb_campaign(cid, sources):
-    data = {'emails': '', 'samples': '', 'objects': ''}
-
-    email_list = Email.objects(campaign__name=cid, source__name__in=sources)
-    if not email_list:
-        return data
-
-    md5_list = []
-
+def anb_campaign_rows(email_list, sources, cache):
     for email in email_list:
-        md5_list = get_sample_rels(email.relationships, str(email.id), sources)
+        md5_list = get_sample_rels(email.relationships, str(email.id), sources,
+                                   cache)
         email.sanitize_sources(sources=sources)
 
-        data['emails'] += "%s,%s,%s,%s,%s,%s,%s,%s\r\n" % (
+        yield 'emails', "%s,%s,%s,%s,%s,%s,%s,%s\r\n" % (
             email.id,
             email.isodate,
             email.sender,
@@ -192,16 +250,33 @@ def execute_anb_campaign(cid, sources):
             email.campaign[0].name)
 
         for m in md5_list:
-            data['samples'] += "%s,%s,%s,%s,%s\r\n" % (
+            yield 'samples', "%s,%s,%s,%s,%s\r\n" % (
                 m['email_id'],
                 m['md5'],
                 m['mimetype'],
                 m['backdoor'],
                 m['filename'])
             for o in m.get('objects', []):
-                data['objects'] += "%s,%s\r\n" % (m['md5'], o)
+                yield 'objects', "%s,%s\r\n" % (m['md5'], o)
 
-    return data
+# Get every email in the campaign first, then walk each email looking for
+# samples related to the email. Then get objects for those samples. All of
+# the samples and backdoors are fetched up front in a few $in queries.
+def execute_anb_campaign(cid, sources):
+    data = {'emails': '', 'samples': '', 'objects': ''}
+
+    email_list = list(Email.objects(campaign__name=cid,
+                                    source__name__in=sources).only(*EMAIL_FIELDS))
+    if not email_list:
+        return data
+
+    cache = ObjectCache(sources)
+    sample_ids = []
+    for email in email_list:
+        sample_ids.extend(rel_ids(email.relationships, 'Sample'))
+    prefetch_samples(cache, sample_ids)
+
+    return join_rows(anb_campaign_rows(email_list, sources, cache), data.keys())
 
 def execute_anb(ctype, cid, sources):
     data = {
@@ -119,6 +119,25 @@ class CRITsScript(CRITsBaseScript):
                             pass
                             #print "error with %s" % item["md5"]
 
+    def get_pe_meta(self, filter):
+        # Hashed here instead of running the peinfo service, only the
+        # headers are parsed.
+        import pefile
+        from peinfo_service.pehash import pehash
+        from crits.samples.sample import Sample
+
+        sample_list = Sample.objects(__raw__=filter).only('md5', 'filedata')
+        for sample in sample_list:
+            try:
+                pe = pefile.PE(data=sample.filedata.read(), fast_load=True)
+                pe.parse_data_directories(directories=[
+                    pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_IMPORT']])
+                print "'%s', '%s', '%s'" % (sample.md5, pe.get_imphash(),
+                                            pehash(pe))
+            except Exception:
+                pass
+                #print "error with %s" % sample.md5
+
     def run(self, argv):
         parser = OptionParser()
         parser.add_option("-f", "--filter", action="store", dest="filter",
@@ -143,3 +162,5 @@ class CRITsScript(CRITsBaseScript):
             self.get_yara_meta(filter)
         elif opts.office:
             self.get_office_meta(filter)
+        elif opts.pe_info:
+            self.get_pe_meta(filter)
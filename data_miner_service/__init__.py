@@ -1,18 +1,22 @@
-import re
 import logging
+from collections import OrderedDict
 
 from crits.services.core import Service, ServiceConfigError
 from crits.emails.email import Email
 from crits.events.event import Event
 from crits.raw_data.raw_data import RawData
 from crits.samples.sample import Sample
-from crits.domains.domain import TLD
 from crits.indicators.indicator import Indicator
-from crits.core.data_tools import make_ascii_strings
 from crits.vocabulary.indicators import IndicatorTypes
 
+from .extractor import (IOCExtractor, HASH_RES, get_tlds, iter_ascii_strings,
+                        scan_domains, scan_emails, scan_ips, scan_urls)
+
 logger = logging.getLogger(__name__)
 
+# Bytes of sample data to read at a time.
+READ_CHUNK_SIZE = 1024 * 1024
+
 
 class DataMinerService(Service):
     """
@@ -43,145 +47,127 @@ class DataMinerService(Service):
         elif isinstance(obj, Email):
             data = obj.raw_body
         elif isinstance(obj, Sample):
-            samp_data = obj.filedata.read()
-            data = make_ascii_strings(data=samp_data)
-            if not data:
-                self._debug("Could not find sample data to parse.")
-                return
+            data = None
         else:
             self._debug("This type is not supported by this service.")
             return
 
-        ips = extract_ips(data)
+        extractor = IOCExtractor()
+        if data is None:
+            # Pull the strings out of the sample a chunk at a time instead of
+            # reading all of it into memory.
+            chunks = iter(lambda: obj.filedata.read(READ_CHUNK_SIZE), '')
+            for strings in iter_ascii_strings(chunks):
+                extractor.feed(strings)
+        elif data:
+            extractor.feed(data)
+        extractor.close()
+
+        ips = extractor.ips
+        domains = extractor.domains
+        urls = extractor.urls
+        emails = extractor.emails
+        existing = existing_indicators(ips + domains + urls + emails)
         for ip in ips:
             tdict = {'Type': IndicatorTypes.IPV4_ADDRESS}
-            id_ = Indicator.objects(value=ip).only('id').first()
-            if id_:
-                tdict['exists'] = str(id_.id)
+            if ip in existing:
+                tdict['exists'] = existing[ip]
             self._add_result('Potential IP Address', ip, tdict)
-        domains = extract_domains(data)
         for domain in domains:
             tdict = {'Type': IndicatorTypes.DOMAIN}
-            id_ =  Indicator.objects(value=domain).only('id').first()
-            if id_:
-                tdict['exists'] = str(id_.id)
+            if domain in existing:
+                tdict['exists'] = existing[domain]
             self._add_result('Potential Domains', domain, tdict)
-        urls = extract_urls(data)
         for url in urls:
             tdict = {'Type': IndicatorTypes.URI}
-            id_ = Indicator.objects(value=url).only('id').first()
-            if id_:
-                tdict['exists'] = str(id_.id)
+            if url in existing:
+                tdict['exists'] = existing[url]
             self._add_result('Potential URLs', url, tdict)
-        emails = extract_emails(data)
         for email in emails:
             tdict = {'Type': IndicatorTypes.EMAIL_ADDRESS}
-            id_ = Indicator.objects(value=email).only('id').first()
-            if id_:
-                tdict['exists'] = str(id_.id)
+            if email in existing:
+                tdict['exists'] = existing[email]
             self._add_result('Potential Emails', email, tdict)
-        hashes = extract_hashes(data)
-        hash_tracker = []
-        for hash_ in hashes:
-            type_ = hash_[0]
-            val = hash_[1]
+        hashes = []
+        hash_tracker = set()
+        for type_, val in extractor.hashes:
             if val not in hash_tracker:
-                tdict = {'Type': type_}
-                if type_ == IndicatorTypes.MD5:
-                    id_ = Sample.objects(md5=val).only('id').first()
-                elif type_ == IndicatorTypes.SHA1:
-                    id_ = Sample.objects(sha1=val).only('id').first()
-                elif type_ == IndicatorTypes.SHA256:
-                    id_ = Sample.objects(sha256=val).only('id').first()
-                elif type_ == IndicatorTypes.SSDEEP:
-                    id_ = Sample.objects(ssdeep=val).only('id').first()
-                else:
-                    id_ = None
-                if id_:
-                    tdict['exists'] = str(id_.id)
-                self._add_result('Potential Samples', val, tdict)
-                hash_tracker.append(val)
+                hashes.append((type_, val))
+                hash_tracker.add(val)
+        existing = existing_samples(hashes)
+        for type_, val in hashes:
+            tdict = {'Type': type_}
+            if (type_, val) in existing:
+                tdict['exists'] = existing[(type_, val)]
+            self._add_result('Potential Samples', val, tdict)
+
+# Maximum number of values in a single $in query.
+QUERY_BATCH_SIZE = 1000
+
+# Sample field to look up each hash type in.
+HASH_FIELDS = {
+    IndicatorTypes.MD5: 'md5',
+    IndicatorTypes.SHA1: 'sha1',
+    IndicatorTypes.SHA256: 'sha256',
+    IndicatorTypes.SSDEEP: 'ssdeep',
+}
+
+def _batches(values):
+    values = list(values)
+    for i in xrange(0, len(values), QUERY_BATCH_SIZE):
+        yield values[i:i + QUERY_BATCH_SIZE]
+
+# look up which values already exist as indicators, returns value -> id
+def existing_indicators(values):
+    existing = {}
+    for batch in _batches(set(values)):
+        for ind in Indicator.objects(value__in=batch).only('id', 'value'):
+            existing.setdefault(ind.value, str(ind.id))
+    return existing
+
+# look up which hashes already exist as samples, returns (type, hash) -> id
+def existing_samples(hashes):
+    by_type = {}
+    for type_, val in hashes:
+        if type_ in HASH_FIELDS:
+            by_type.setdefault(type_, set()).add(val)
+    existing = {}
+    for type_, values in by_type.iteritems():
+        field = HASH_FIELDS[type_]
+        for batch in _batches(values):
+            query = {'%s__in' % field: batch}
+            for sample in Sample.objects(**query).only('id', field):
+                existing.setdefault((type_, sample[field]), str(sample.id))
+    return existing
 
 # hack of a parser to extract potential ip addresses from data
 def extract_ips(data):
-    pattern = r"((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)([ (\[]?(\.|dot)[ )\]]?(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)){3})"
-    final_ips = []
-    ips = [each[0] for each in re.findall(pattern, data)]
-    for item in ips:
-        ip = re.sub("[ ()\[\]]", "", item)
-        ip = re.sub("dot", ".", ip)
-        if ip not in final_ips:
-            final_ips.append(ip)
-    return final_ips
+    found = OrderedDict()
+    scan_ips(data, found)
+    return found.keys()
 
 # hack of a parser to extract potential domains from data
 def extract_domains(data):
-    pattern = r'[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?[\.[a-zA-Z]{2,}'
-    domains = [each for each in re.findall(pattern, data) if len(each) > 0]
-    final_domains = []
-    for item in domains:
-        if len(item) > 1 and item.find('.') != -1:
-            try:
-                tld = item.split(".")[-1]
-                check = TLD.objects(tld=tld).first()
-                if check and item not in final_domains:
-                    final_domains.append(item)
-            except:
-                pass
-    return final_domains
+    found = OrderedDict()
+    scan_domains(data, found, get_tlds())
+    return found.keys()
 
 # hack of a parser to extract potential URLs (Links) from data
 def extract_urls(data):
-    pattern = r'(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?'
-    results = re.findall(pattern,data)
-    urls = [each for each in results if len(each) >0]
-    final_urls = []
-    for item in urls:
-        url = item[0]+"://"+item[1]+item[2]
-        if url not in final_urls:
-            final_urls.append(url)
-    return final_urls
+    found = OrderedDict()
+    scan_urls(data, found)
+    return found.keys()
 
 
 # hack of a parser to extract potential emails from data
 def extract_emails(data):
-    pattern = r'[a-zA-Z0-9-\.\+]+@.[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?[\.[a-zA-Z]{2,}'
-    emails = [each for each in re.findall(pattern, data) if len(each) > 0]
-    final_emails = []
-    for item in emails:
-        if len(item) > 1 and item.find('.') != -1:
-            try:
-                tld = item.split(".")[-1]
-                check = TLD.objects(tld=tld).first()
-                if check and item not in final_emails:
-                    final_emails.append(item)
-            except:
-                pass
-    return final_emails
+    found = OrderedDict()
+    scan_emails(data, found, get_tlds())
+    return found.keys()
 
 # hack of a parser to extract potential domains from data
 def extract_hashes(data):
-
-    re_md5 = re.compile("\\b[a-f0-9]{32}\\b", re.I | re.S | re.M)
-    re_sha1 = re.compile("\\b[a-f0-9]{40}\\b", re.I | re.S | re.M)
-    re_sha256 = re.compile("\\b[a-f0-9]{64}\\b", re.I | re.S | re.M)
-    re_ssdeep = re.compile("\\b\\d{2}:[A-Za-z0-9/+]{3,}:[A-Za-z0-9/+]{3,}\\b", re.I | re.S | re.M)
-
     final_hashes = []
-    md5 = IndicatorTypes.MD5
-    sha1 = IndicatorTypes.SHA1
-    sha256 = IndicatorTypes.SHA256
-    ssdeep = IndicatorTypes.SSDEEP
-    final_hashes.extend(
-        [(md5,each) for each in re.findall(re_md5, data) if len(each) > 0]
-    )
-    final_hashes.extend(
-        [(sha1,each) for each in re.findall(re_sha1, data) if len(each) > 0]
-    )
-    final_hashes.extend(
-        [(sha256,each) for each in re.findall(re_sha256, data) if len(each) > 0]
-    )
-    final_hashes.extend(
-        [(ssdeep,each) for each in re.findall(re_ssdeep, data) if len(each) > 0]
-    )
+    for type_, regex in HASH_RES:
+        final_hashes.extend((type_, each) for each in regex.findall(data))
     return final_hashes
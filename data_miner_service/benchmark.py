@@ -0,0 +1,80 @@
+"""
+Measure the throughput of the data miner IOC extraction on a synthetic text
+corpus.
+
+Needs CRITs on the python path, but no database: a fixed TLD set is used.
+
+Example Usage:
+    python benchmark.py -m 50
+"""
+
+import random
+import time
+from optparse import OptionParser
+
+from extractor import IOCExtractor
+
+TLDS = frozenset(['com', 'net', 'org', 'info', 'ru', 'cn', 'de', 'uk'])
+
+WORDS = ['the', 'service', 'connect', 'error', 'GetProcAddress', 'kernel32',
+         'LoadLibraryA', 'config', 'value', 'data', 'user', 'admin']
+
+
+def make_ioc(rng):
+    name = ''.join(rng.choice('abcdefghijklmnop') for _ in range(8))
+    tld = rng.choice(sorted(TLDS) + ['dll', 'exe'])
+    kind = rng.randint(0, 5)
+    if kind == 0:
+        return "%d.%d.%d.%d" % tuple(rng.randint(1, 254) for _ in range(4))
+    elif kind == 1:
+        return "%s.%s" % (name, tld)
+    elif kind == 2:
+        return "http://%s.%s/%s/index.php?id=%d" % (name, tld, name,
+                                                    rng.randint(0, 999))
+    elif kind == 3:
+        return "%s@%s.%s" % (name, name[::-1], tld)
+    elif kind == 4:
+        return "%032x" % rng.getrandbits(128)
+    return "%064x" % rng.getrandbits(256)
+
+
+def make_corpus(size):
+    rng = random.Random(1)
+    lines = []
+    total = 0
+    while total < size:
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 12))]
+        if rng.random() < 0.3:
+            words.insert(rng.randint(0, len(words)), make_ioc(rng))
+        line = ' '.join(words)
+        lines.append(line)
+        total += len(line) + 1
+    return '\n'.join(lines)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-m", "--megabytes", action="store", dest="mb",
+            type="int", default=50, help="corpus size in MB")
+    parser.add_option("-c", "--chunk-size", action="store", dest="chunk",
+            type="int", default=1024 * 1024, help="bytes fed at a time")
+    (opts, args) = parser.parse_args()
+
+    data = make_corpus(opts.mb * 1024 * 1024)
+    mb = len(data) / (1024.0 * 1024.0)
+
+    start = time.time()
+    extractor = IOCExtractor(tlds=TLDS)
+    for i in xrange(0, len(data), opts.chunk):
+        extractor.feed(data[i:i + opts.chunk])
+    extractor.close()
+    elapsed = time.time() - start
+
+    print("%.1f MB in %.2fs: %.1f MB/s" % (mb, elapsed, mb / elapsed))
+    print("ips: %d domains: %d urls: %d emails: %d hashes: %d" %
+          (len(extractor.ips), len(extractor.domains), len(extractor.urls),
+           len(extractor.emails), len(extractor.hashes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import re
+import time
+from collections import OrderedDict
+
+from crits.vocabulary.indicators import IndicatorTypes
+
+IP_RE = re.compile(r"((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)([ (\[]?(\.|dot)[ )\]]?(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)){3})")
+IP_CLEAN_RE = re.compile("[ ()\[\]]")
+DOMAIN_RE = re.compile(r'[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?[\.[a-zA-Z]{2,}')
+URL_RE = re.compile(r'(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?')
+EMAIL_RE = re.compile(r'[a-zA-Z0-9-\.\+]+@.[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?[\.[a-zA-Z]{2,}')
+HASH_RES = [
+    (IndicatorTypes.MD5, re.compile("\\b[a-f0-9]{32}\\b", re.I | re.S | re.M)),
+    (IndicatorTypes.SHA1, re.compile("\\b[a-f0-9]{40}\\b", re.I | re.S | re.M)),
+    (IndicatorTypes.SHA256, re.compile("\\b[a-f0-9]{64}\\b", re.I | re.S | re.M)),
+    (IndicatorTypes.SSDEEP, re.compile("\\b\\d{2}:[A-Za-z0-9/+]{3,}:[A-Za-z0-9/+]{3,}\\b", re.I | re.S | re.M)),
+]
+
+# Same strings as make_ascii_strings, printable runs of 4 or more.
+ASCII_RE = re.compile('[ -~]{4,}')
+
+# Longest string kept between chunks. Longer strings are split, repeating
+# the last MAX_TOKEN bytes at the start of the next line so no IOC up to
+# that length is cut in two.
+MAX_CARRY = 16384
+MAX_TOKEN = 2048
+
+# Seconds to keep the TLD list before reloading it from the database.
+TLD_CACHE_TIMEOUT = 3600
+
+_tld_cache = {'tlds': None, 'loaded': 0}
+
+
+def get_tlds(reload=False):
+    """
+    Get the set of known TLDs, loaded from the database at most once per
+    TLD_CACHE_TIMEOUT.
+
+    :param reload: Reload the TLDs from the database.
+    :type reload: bool
+    :returns: frozenset of str
+    """
+
+    now = time.time()
+    if (reload or _tld_cache['tlds'] is None or
+        now - _tld_cache['loaded'] > TLD_CACHE_TIMEOUT):
+        # Imported here so the extractor can be used without a database,
+        # for example by benchmark.py.
+        from crits.domains.domain import TLD
+        tlds = TLD.objects().only('tld')
+        _tld_cache['tlds'] = frozenset(t.tld for t in tlds)
+        _tld_cache['loaded'] = now
+    return _tld_cache['tlds']
+
+
+def iter_ascii_strings(chunks):
+    """
+    Extract ASCII strings from chunks of binary data, one string per line.
+
+    Strings spanning two chunks are joined, so the output is the same as
+    running make_ascii_strings over the whole data, except that strings
+    longer than MAX_CARRY are split over several overlapping lines.
+
+    :param chunks: The binary data.
+    :type chunks: iterable of str
+    :returns: generator of str
+    """
+
+    carry = ''
+    for chunk in chunks:
+        data = carry + chunk
+        carry = ''
+        matches = list(ASCII_RE.finditer(data))
+        strings = [m.group() for m in matches]
+        # A string running to the end of the chunk may continue in the next.
+        if matches and matches[-1].end() == len(data):
+            carry = strings.pop()
+            if len(carry) > MAX_CARRY:
+                # Don't rescan an ever growing string with every chunk.
+                strings.append(carry)
+                carry = carry[-MAX_TOKEN:]
+        else:
+            # A short printable run at the end could still become a string.
+            tail = len(data)
+            while tail > 0 and ' ' <= data[tail - 1] <= '~' and len(data) - tail < 3:
+                tail -= 1
+            carry = data[tail:]
+        if strings:
+            yield '\n'.join(strings) + '\n'
+    if len(carry) >= 4:
+        yield carry + '\n'
+
+
+def scan_ips(data, found):
+    for m in IP_RE.finditer(data):
+        ip = IP_CLEAN_RE.sub("", m.group(1))
+        found[ip.replace("dot", ".")] = None
+
+
+def _has_tld(item, tlds):
+    if len(item) > 1 and item.find('.') != -1:
+        return item.split(".")[-1] in tlds
+    return False
+
+
+def scan_domains(data, found, tlds):
+    for item in DOMAIN_RE.findall(data):
+        if _has_tld(item, tlds):
+            found[item] = None
+
+
+def scan_urls(data, found):
+    for m in URL_RE.finditer(data):
+        found[m.group(1) + "://" + m.group(2) + (m.group(3) or '')] = None
+
+
+def scan_emails(data, found, tlds):
+    for item in EMAIL_RE.findall(data):
+        if _has_tld(item, tlds):
+            found[item] = None
+
+
+def scan_hashes(data, found):
+    # found maps each hash type to an OrderedDict of values.
+    for type_, regex in HASH_RES:
+        values = found.setdefault(type_, OrderedDict())
+        for item in regex.findall(data):
+            values[item] = None
+
+
+class IOCExtractor(object):
+    """
+    Extract potential IPs, domains, URLs, email addresses and hashes.
+
+    Data can be given in one piece or fed in chunks. Only complete lines are
+    scanned, so no match is lost at a chunk boundary: none of the patterns
+    match across a newline. Values are deduplicated in the order they are
+    first found.
+    """
+
+    def __init__(self, tlds=None):
+        if tlds is None:
+            tlds = get_tlds()
+        self.tlds = tlds
+        self._ips = OrderedDict()
+        self._domains = OrderedDict()
+        self._urls = OrderedDict()
+        self._emails = OrderedDict()
+        self._hashes = OrderedDict((type_, OrderedDict()) for type_, _ in HASH_RES)
+        self._buffer = ''
+
+    def feed(self, data):
+        data = self._buffer + data
+        end = data.rfind('\n') + 1
+        self._buffer = data[end:]
+        if end:
+            self._scan(data[:end])
+
+    def close(self):
+        if self._buffer:
+            self._scan(self._buffer)
+            self._buffer = ''
+        return self
+
+    def _scan(self, data):
+        scan_ips(data, self._ips)
+        scan_domains(data, self._domains, self.tlds)
+        scan_urls(data, self._urls)
+        scan_emails(data, self._emails, self.tlds)
+        scan_hashes(data, self._hashes)
+
+    @property
+    def ips(self):
+        return self._ips.keys()
+
+    @property
+    def domains(self):
+        return self._domains.keys()
+
+    @property
+    def urls(self):
+        return self._urls.keys()
+
+    @property
+    def emails(self):
+        return self._emails.keys()
+
+    @property
+    def hashes(self):
+        return [(type_, val) for type_, hashes in self._hashes.iteritems()
+                for val in hashes]
@@ -3,23 +3,23 @@
 # All rights reserved.
 # Source code distributed pursuant to license agreement.
 
-import array
-import math
-from decimal import *
-
 from django.template.loader import render_to_string
 
 from crits.services.core import Service, ServiceConfigError
 
+from . import entropy
 from . import forms
 
+# Windows at or above this many bits per byte are likely packed or encrypted.
+HIGH_ENTROPY = 7.2
+
 class EntropycalcService(Service):
     """
     Calculate entropy over data.
     """
 
     name = "entropycalc"
-    version = '0.0.1'
+    version = '0.1.0'
     supported_types = ['Sample']
     description = "Calculate entropy of a sample."
 
@@ -38,7 +38,11 @@ class EntropycalcService(Service):
     def bind_runtime_form(analyst, config):
         if config:
             # The values are submitted as a list for some reason.
-            data = {'start': config['start'][0], 'end': config['end'][0]}
+            data = {'start': config['start'][0], 'end': config['end'][0],
+                    'profile': 'profile' in config}
+            for name in ('window', 'step'):
+                if name in config:
+                    data[name] = config[name][0]
         else:
             data = {}
             fields = forms.EntropyCalcRunForm().fields
@@ -55,30 +59,40 @@ class EntropycalcService(Service):
                                  'identifier': identifier})
 
     def _calculate_entropy(self, data):
-        entropy = Decimal(0)
-        if len(data) == 0:
-            return entropy
-
-        occurences = array.array('L', [0]*256)
-
-        for x in data:
-            occurences[ord(x)] += 1
-
-        for x in occurences:
-            if x:
-                p_x = Decimal(x) / len(data)
-                entropy -= p_x * Decimal(math.log(p_x, 2))
-
-        return entropy
-
+        return entropy.entropy(data)
 
     def run(self, obj, config):
         start = config['start']
         end = config['end']
         data = obj.filedata.read()
+        # A negative start counts from the end of the file.
+        if start < 0:
+            start = max(len(data) + start, 0)
         # If end is -1, just leave it off.
         if end == -1:
-            output = self._calculate_entropy(data[start:])
+            data = data[start:]
         else:
-            output = self._calculate_entropy(data[start:end])
+            data = data[start:end]
+        output = self._calculate_entropy(data)
         self._add_result('Entropy calculation', "%.1f" % output, {'Value': "%.15f" % output})
+
+        if config.get('profile'):
+            window = config['window']
+            step = config['step']
+            if window <= 0 or step <= 0:
+                self._error("Window and step must be positive.")
+                return
+            fitted = entropy.profile_step(len(data), step)
+            if fitted != step:
+                self._info("Profile step raised to %d bytes to stay within "
+                           "%d windows." % (fitted, entropy.MAX_WINDOWS))
+                step = fitted
+            for offset, length, value in entropy.entropy_profile(data, window, step):
+                # Offsets are relative to the start of the file.
+                offset += start
+                self._add_result('Entropy profile',
+                                 "0x%x-0x%x" % (offset, offset + length),
+                                 {'Offset': offset,
+                                  'Length': length,
+                                  'Value': "%.3f" % value,
+                                  'High': "Yes" if value >= HIGH_ENTROPY else "No"})
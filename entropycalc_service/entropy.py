@@ -0,0 +1,139 @@
+# Byte histogram based entropy calculation.
+#
+# numpy is used when it is available, otherwise the histograms are built with
+# str.count which still runs in C. The helpers are also used by other services
+# computing entropy, such as pdfinfo.
+
+import math
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Below this size, without numpy, counting only the bytes present with a
+# Counter is cheaper than scanning the data once per byte value.
+SMALL_DATA = 512
+
+# Most windows in an entropy profile, the step is raised to fit.
+MAX_WINDOWS = 1024
+
+
+def byte_histogram(data):
+    """
+    Count the occurrences of each byte value.
+
+    :param data: The data to count.
+    :type data: str
+    :returns: numpy array of 256 ints, or a list without numpy.
+    """
+
+    if numpy is not None:
+        return numpy.bincount(numpy.frombuffer(data, dtype=numpy.uint8),
+                              minlength=256)
+    return [data.count(chr(x)) for x in xrange(256)]
+
+
+def histogram_entropy(counts, length):
+    """
+    Shannon entropy in bits per byte of a byte histogram.
+
+    :param counts: The number of occurrences of each byte value.
+    :type counts: list or numpy array of int
+    :param length: The number of bytes counted.
+    :type length: int
+    :returns: float
+    """
+
+    if not length:
+        return 0.0
+    if numpy is not None:
+        p_x = numpy.asarray(counts, dtype=numpy.float64)
+        p_x = p_x[p_x > 0] / length
+        return float(-(p_x * numpy.log2(p_x)).sum())
+    entropy = 0.0
+    for x in counts:
+        if x:
+            p_x = float(x) / length
+            entropy -= p_x * math.log(p_x, 2)
+    return entropy
+
+
+def entropy(data):
+    """
+    Shannon entropy in bits per byte of some data.
+
+    :param data: The data.
+    :type data: str
+    :returns: float
+    """
+
+    if numpy is None and len(data) < SMALL_DATA:
+        return histogram_entropy(Counter(data).values(), len(data))
+    return histogram_entropy(byte_histogram(data), len(data))
+
+
+def profile_step(length, step, max_windows=MAX_WINDOWS):
+    """
+    Step to use for an entropy profile, raised if needed so the profile of
+    data of this length has at most max_windows windows.
+
+    :param length: Size of the data in bytes.
+    :type length: int
+    :param step: The requested step.
+    :type step: int
+    :param max_windows: Most windows to allow.
+    :type max_windows: int
+    :returns: int
+    """
+
+    return max(step, -(-length // max_windows))
+
+
+def entropy_profile(data, window, step, max_windows=MAX_WINDOWS):
+    """
+    Entropy of each window of the data.
+
+    The histogram is kept between windows and only the bytes leaving and
+    entering the window are counted, instead of recounting every window.
+    The last window may be shorter than the window size. If the step would
+    give more than max_windows windows it is raised with profile_step().
+
+    :param data: The data.
+    :type data: str
+    :param window: Size of each window in bytes.
+    :type window: int
+    :param step: Bytes between the start of each window.
+    :type step: int
+    :param max_windows: Most windows to return.
+    :type max_windows: int
+    :returns: generator of (offset, length, entropy) tuples.
+    """
+
+    if window <= 0 or step <= 0:
+        raise ValueError("Window and step must be positive.")
+    if not data:
+        return
+    step = profile_step(len(data), step, max_windows)
+    if step >= window:
+        # No overlap, nothing to reuse between windows.
+        for offset in xrange(0, len(data), step):
+            chunk = data[offset:offset + window]
+            yield offset, len(chunk), entropy(chunk)
+        return
+
+    counts = byte_histogram(data[:window])
+    offset = 0
+    while True:
+        length = min(window, len(data) - offset)
+        yield offset, length, histogram_entropy(counts, length)
+        if offset + window >= len(data):
+            break
+        leaving = byte_histogram(data[offset:offset + step])
+        entering = byte_histogram(data[offset + window:offset + window + step])
+        if numpy is not None:
+            counts = counts - leaving + entering
+        else:
+            counts = [c - l + e for c, l, e in zip(counts, leaving, entering)]
+        offset += step
@@ -9,6 +9,18 @@ class EntropyCalcRunForm(forms.Form):
     end = forms.IntegerField(required=True,
                              label="End offset",
                              initial=-1)
+    profile = forms.BooleanField(required=False,
+                                 label="Entropy profile",
+                                 help_text="Also calculate entropy for each window of the data.",
+                                 initial=False)
+    window = forms.IntegerField(required=True,
+                                label="Profile window",
+                                help_text="Size of each window in bytes.",
+                                initial=65536)
+    step = forms.IntegerField(required=True,
+                              label="Profile step",
+                              help_text="Bytes between the start of each window.",
+                              initial=65536)
 
     def __init__(self, *args, **kwargs):
         kwargs.setdefault('label_suffix', ':')
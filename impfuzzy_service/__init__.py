@@ -7,10 +7,15 @@ from django.template.loader import render_to_string
 from crits.samples.sample import Sample
 from crits.services.core import Service, ServiceConfigError
 
+from ssdeep_service import ssdeep_index
+
 from . import forms
 
 logger = logging.getLogger(__name__)
 
+# Index new samples as they are saved, not only when the service runs.
+ssdeep_index.watch_field('impfuzzy', 'impfuzzy')
+
 #This is based on ssdeep_compare
 
 class impfuzzyService(Service):
@@ -69,37 +74,62 @@ class impfuzzyService(Service):
             logger.error = "impfuzzy: Could not generate impfuzzy value for sample: %s" % str(obj.id)
             self._error("Could not generate impfuzzy value for sample")
             return
-        # setup the sample space to compare against
-        # first use the mimetype as a comparator if available
-        if obj.impfuzzy:
+        if not obj.impfuzzy:
+            # Only touch the impfuzzy field instead of saving the whole
+            # sample in the middle of the run.
+            Sample.objects(id=obj.id).update_one(set__impfuzzy=target_impfuzzy)
             obj.impfuzzy = target_impfuzzy
-            obj.save()
             self._info("impfuzzy: Filled-in in the impfuzzy")
         else:
             self._info("impfuzzy attribute already present, not overwriting")
         self._add_result('impfuzzy_hash', target_impfuzzy,{'impfuzzy': target_impfuzzy})
         target_mimetype = obj.mimetype
+        if ssdeep_index.has_index('impfuzzy'):
+            candidates = ssdeep_index.find_candidates('impfuzzy', target_impfuzzy)
+        else:
+            self._info("impfuzzy index has not been built, comparing against "
+                       "all samples. Run the impfuzzy_cluster script with -b "
+                       "to build it.")
+            candidates = self._scan_candidates(target_impfuzzy, target_mimetype)
+        # Keep the index current with every sample the service runs on.
+        ssdeep_index.index_hash('impfuzzy', target_md5, target_impfuzzy)
+
+        scores = {}
+        for md5, impfuzzy in candidates:
+            if md5 == target_md5:
+                continue
+            score = pyimpfuzzy.hash_compare(target_impfuzzy, impfuzzy)
+            if score >= threshold:
+                scores[md5] = score
+
+        # Only fetch the samples that matched, using the mimetype as a
+        # comparator if available.
+        match_list = []
+        if scores:
+            query_filter = {'md5': {'$in': scores.keys()}}
+            if target_mimetype:
+                query_filter['mimetype'] = target_mimetype
+            for sample in Sample.objects(__raw__=query_filter).only('md5', 'description'):
+                # Grab the md5 and the description for later
+                match_list.append({'md5': sample.md5, 'description': sample.description, 'score': scores[sample.md5]})
+        # finally sort the results
+        match_list.sort(key=lambda sample: sample["score"], reverse=True)
+        for match in match_list:
+            #Show the MD5 and the Description
+            self._add_result("impfuzzy_match (MD5)", match["md5"], {'description': match["description"], 'score': match["score"]})
+
+    @staticmethod
+    def _scan_candidates(target_impfuzzy, target_mimetype):
+        # setup the sample space to compare against
+        # first use the mimetype as a comparator if available
         query_filter = {}
         if target_mimetype:
             query_filter['mimetype'] = target_mimetype
         # then use only samples with a multiple of chunksize
         chunk_size = int(target_impfuzzy.split(":")[0])
         query_filter["$or"] = []
-        query_filter["$or"].append({"impfuzzy": {"$regex": "^%d:" % chunk_size * 2}})
+        query_filter["$or"].append({"impfuzzy": {"$regex": "^%d:" % (chunk_size * 2)}})
         query_filter["$or"].append({"impfuzzy": {"$regex": "^%d:" % chunk_size}})
         query_filter["$or"].append({"impfuzzy": {"$regex": "^%d:" % (chunk_size // 2)}})
-        result_filter = {'md5': 1, 'impfuzzy': 1, 'description':1}
-        candidate_space = Sample.objects(__raw__=query_filter).only(*result_filter)
-        #    self.info("candidate: %s" % repr(candidate_space))
-        match_list = []
-        for candidate in candidate_space:
-            if "impfuzzy" in candidate:
-                score = pyimpfuzzy.hash_compare(target_impfuzzy, candidate["impfuzzy"])
-                if score >= threshold and candidate["md5"] != target_md5:
-                    # Grab the md5 and the description for later
-                    match_list.append({'md5': candidate["md5"], 'description': candidate["description"], 'score': score})
-        # finally sort the results
-        match_list.sort(key=lambda sample: sample["score"], reverse=True)
-        for match in match_list:
-            #Show the MD5 and the Description
-            self._add_result("impfuzzy_match (MD5)", match["md5"], {'description': match["description"], 'score': match["score"]})
+        candidate_space = Sample.objects(__raw__=query_filter).only('md5', 'impfuzzy')
+        return [(c.md5, c.impfuzzy) for c in candidate_space if c.impfuzzy]
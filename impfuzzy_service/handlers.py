@@ -0,0 +1,97 @@
+import pyimpfuzzy
+
+from crits.samples.sample import Sample
+from crits.vocabulary.relationships import RelationshipTypes
+
+from ssdeep_service import ssdeep_index
+
+
+def backfill_index():
+    """
+    Index the impfuzzy hash of all Samples.
+
+    PE Samples without an impfuzzy hash, because the service never ran on
+    them, get it computed from their file data and saved first.
+
+    :returns: int, number of Samples indexed.
+    """
+
+    return ssdeep_index.backfill('impfuzzy', 'impfuzzy',
+                                 compute=_compute_impfuzzy)
+
+
+def _compute_impfuzzy(sample):
+    if not sample.filedata:
+        return None
+    data = sample.filedata.read()
+    if not data or data[:2] != 'MZ':
+        return None
+    try:
+        impfuzzy = pyimpfuzzy.get_impfuzzy_data(data)
+    except Exception:
+        return None
+    if impfuzzy:
+        Sample.objects(id=sample.id).update_one(set__impfuzzy=impfuzzy)
+    return impfuzzy
+
+
+def cluster_samples(threshold, analyst, batch_size=500):
+    """
+    Relate all indexed Samples with similar impfuzzy hashes.
+
+    All pairs scoring at or above the threshold are found in one pass over
+    the impfuzzy index and written as relationships. Samples are loaded and
+    saved in batches, so each one is only saved once per batch no matter
+    how many matches it has.
+
+    :param threshold: Minimum impfuzzy score for a relationship.
+    :type threshold: int
+    :param analyst: The user creating the relationships.
+    :type analyst: str
+    :param batch_size: Number of matching pairs to handle per batch.
+    :type batch_size: int
+    :returns: dict with keys "pairs" and "relationships".
+    """
+
+    result = {'pairs': 0, 'relationships': 0}
+    batch = []
+    pairs = ssdeep_index.iter_similar_pairs('impfuzzy',
+                                            pyimpfuzzy.hash_compare,
+                                            threshold)
+    for pair in pairs:
+        batch.append(pair)
+        if len(batch) >= batch_size:
+            result['relationships'] += _relate_batch(batch, analyst)
+            result['pairs'] += len(batch)
+            batch = []
+    if batch:
+        result['relationships'] += _relate_batch(batch, analyst)
+        result['pairs'] += len(batch)
+    return result
+
+
+def _relate_batch(batch, analyst):
+    md5s = set()
+    for left, right, score in batch:
+        md5s.add(left)
+        md5s.add(right)
+    samples = dict((s.md5, s) for s in Sample.objects(md5__in=list(md5s)))
+
+    changed = set()
+    count = 0
+    for left, right, score in batch:
+        if left not in samples or right not in samples:
+            continue
+        res = samples[left].add_relationship(
+            rel_item=samples[right],
+            rel_type=RelationshipTypes.RELATED_TO,
+            analyst=analyst,
+            rel_confidence='medium',
+            rel_reason='impfuzzy score: %d' % score,
+            get_rels=False)
+        if res['success']:
+            changed.update((left, right))
+            count += 1
+    for md5 in changed:
+        samples[md5].save(username=analyst)
+    return count
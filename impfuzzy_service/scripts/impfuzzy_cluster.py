@@ -0,0 +1,36 @@
+"""
+Relate all Samples with similar impfuzzy hashes in one batched pass.
+
+Example Usage:
+    python impfuzzy_cluster.py -b -t 80
+"""
+
+from optparse import OptionParser
+
+from crits.core.basescript import CRITsBaseScript
+from impfuzzy_service.handlers import backfill_index, cluster_samples
+
+class CRITsScript(CRITsBaseScript):
+    def __init__(self, username=None):
+        self.username = username
+
+    def run(self, argv):
+        parser = OptionParser()
+        parser.add_option("-t", "--threshold", action="store", dest="threshold",
+                type="int", default=50, help="Minimum score for a match")
+        parser.add_option("-b", "--backfill", action="store_true",
+                dest="backfill", default=False,
+                help="Index the impfuzzy hash of all samples first, "
+                     "computing it for PE samples which lack it")
+        parser.add_option("-s", "--batch-size", action="store", dest="batch_size",
+                type="int", default=500, help="Matches to save per batch")
+        (opts, args) = parser.parse_args(argv)
+
+        if opts.backfill:
+            count = backfill_index()
+            print "[+] Indexed %d samples" % count
+
+        username = self.username or "Command Line"
+        result = cluster_samples(opts.threshold, username, opts.batch_size)
+        print "[+] Matching pairs: %d" % result['pairs']
+        print "[+] Relationships added: %d" % result['relationships']
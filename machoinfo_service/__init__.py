@@ -1,18 +1,64 @@
 import struct
 import hashlib
 
+from django.template.loader import render_to_string
+
 from crits.services.core import Service, ServiceConfigError
 from crits.certificates.handlers import handle_cert_file
 from crits.vocabulary.relationships import RelationshipTypes
 
 from machoinfo import MachOEntity, MachOParser, MachOParserError
+from . import forms
 
 class MachOInfoService(Service):
     name = "machoinfo"
-    version = '0.0.1'
+    version = '0.1.0'
     supported_types = ['Sample']
     description = "Generate metadata about Mach-O binaries."
 
+    @staticmethod
+    def parse_config(config):
+        try:
+            max_symbols = int(config.get('max_symbols') or 0)
+        except ValueError:
+            raise ServiceConfigError("Maximum symbols must be a number.")
+        if max_symbols < 0:
+            raise ServiceConfigError("Maximum symbols can not be negative.")
+
+    @staticmethod
+    def get_config(existing_config):
+        # Generate default config from form and initial values.
+        config = {}
+        fields = forms.MachOInfoConfigForm().fields
+        for name, field in fields.iteritems():
+            config[name] = field.initial
+
+        # If there is a config in the database, use values from that.
+        if existing_config:
+            for key, value in existing_config.iteritems():
+                config[key] = value
+        return config
+
+    @classmethod
+    def generate_config_form(self, config):
+        html = render_to_string('services_config_form.html',
+                                {'name': self.name,
+                                 'form': forms.MachOInfoConfigForm(initial=config),
+                                 'config_error': None})
+        form = forms.MachOInfoConfigForm
+        return form, html
+
+    @staticmethod
+    def get_config_details(config):
+        display_config = {}
+
+        # Rename keys so they render nice.
+        fields = forms.MachOInfoConfigForm().fields
+        for name, field in fields.iteritems():
+            display_config[field.label] = config[name]
+
+        return display_config
+
     @staticmethod
     def valid_for(obj):
         if obj.filedata.grid_id == None:
@@ -34,6 +80,7 @@ class MachOInfoService(Service):
             raise ServiceConfigError("Bad magic.")
 
     def run(self, obj, config):
+        max_symbols = int(config.get('max_symbols') or 0)
         data = obj.filedata.read()
         mop = MachOParser(data)
         try:
@@ -89,7 +136,13 @@ class MachOInfoService(Service):
             for cmd in entity.cmdlist:
                 if cmd['cmd'] == MachOEntity.LC_CODE_SIGNATURE:
                     e = 'Entity %i - %s' % (i, entity.cmd_name(cmd['cmd']))
-                    for sig in cmd.get('signatures', []):
+                    # Signatures are decoded here, on first access.
+                    try:
+                        signatures = cmd.get('signatures', [])
+                    except MachOParserError, err:
+                        self._error("ERROR: %s" % err)
+                        continue
+                    for sig in signatures:
                         if sig['type'] == MachOEntity.CODE_DIRECTORY:
                             result = {
                                 'ver':          sig['ver'],
@@ -152,6 +205,11 @@ class MachOInfoService(Service):
 
             for cmd in entity.cmdlist:
                 if cmd['cmd'] == MachOEntity.LC_SYMTAB:
+                    # Check the count before the symbols are decoded.
+                    if max_symbols and cmd['nsyms'] > max_symbols:
+                        self._info("Entity %i: skipping %i symbols, more than %i." %
+                                   (i, cmd['nsyms'], max_symbols))
+                        continue
                     for sym in cmd['symbols']:
                         result = {
                             'Stab type': sym.get('stab_type', 'Not stab'),
@@ -0,0 +1,114 @@
+"""
+Time MachOParser.parse on synthetic universal (fat) binaries with large
+symbol tables.
+
+Only needs machoinfo.py, the binaries are generated in memory. Each one
+holds a 32-bit and a 64-bit slice, each with a segment and a symbol table.
+
+Example Usage:
+    python benchmark.py -s 100000 -n 3
+"""
+
+import random
+import struct
+import time
+from optparse import OptionParser
+
+from machoinfo import MachOEntity, MachOParser
+
+LC_SEGMENT = 0x1
+LC_SYMTAB = 0x2
+LC_SEGMENT_64 = 0x19
+MH_EXECUTE = 0x2
+
+
+def make_slice(nsyms, is_64, rng):
+    if is_64:
+        header_sz, nlist_fmt, seg_sz, sect_sz = 32, '<IBBHQ', 72, 80
+    else:
+        header_sz, nlist_fmt, seg_sz, sect_sz = 28, '<IBBhI', 56, 68
+    nsects = 2
+    segment_sz = seg_sz + nsects * sect_sz
+    cmds_sz = segment_sz + 24
+    sym_off = header_sz + cmds_sz
+
+    # Symbol names and the string table. Offset 0 is the empty string.
+    strings = ['']
+    str_offsets = []
+    str_len = 1
+    for i in range(nsyms):
+        name = '_sym_%d_%x' % (i, rng.getrandbits(32))
+        str_offsets.append(str_len)
+        strings.append(name)
+        str_len += len(name) + 1
+    str_tab = '\x00'.join(strings) + '\x00'
+
+    nlist = struct.Struct(nlist_fmt)
+    symbols = ''.join(nlist.pack(str_offsets[i], rng.choice([0x0e, 0x0f, 0x01, 0x24]),
+                                 1, 0, i * 16)
+                      for i in range(nsyms))
+    str_off = sym_off + len(symbols)
+
+    if is_64:
+        header = struct.pack('<IIIIIIII', MachOEntity.MH_MAGIC_64, 0x01000007, 3,
+                             MH_EXECUTE, 2, cmds_sz, 0, 0)
+        segment = struct.pack('<II16sQQQQIIII', LC_SEGMENT_64, segment_sz,
+                              '__TEXT', 0, 0x1000, 0, 0x1000, 7, 5, nsects, 0)
+        sections = ''.join(struct.pack('<16s16sQQIIIIIIII', '__text%d' % i, '__TEXT',
+                                       0x1000 * i, 16, header_sz, 0, 0, 0,
+                                       0x80000400, 0, 0, 0)
+                           for i in range(nsects))
+    else:
+        header = struct.pack('<IIIIIII', MachOEntity.MH_MAGIC, 7, 3,
+                             MH_EXECUTE, 2, cmds_sz, 0)
+        segment = struct.pack('<II16sIIIIIIII', LC_SEGMENT, segment_sz,
+                              '__TEXT', 0, 0x1000, 0, 0x1000, 7, 5, nsects, 0)
+        sections = ''.join(struct.pack('<16s16sIIIIIIIII', '__text%d' % i, '__TEXT',
+                                       0x1000 * i, 16, header_sz, 0, 0, 0,
+                                       0x80000400, 0, 0)
+                           for i in range(nsects))
+    symtab = struct.pack('<IIIIII', LC_SYMTAB, 24, sym_off, nsyms, str_off,
+                         len(str_tab))
+    return header + segment + sections + symtab + symbols + str_tab
+
+
+def make_fat(nsyms, rng):
+    slices = [make_slice(nsyms, False, rng), make_slice(nsyms, True, rng)]
+    offset = 8 + 20 * len(slices)
+    arches = []
+    for data in slices:
+        arches.append(struct.pack('>IIIII', 7, 3, offset, len(data), 0))
+        offset += len(data)
+    return (struct.pack('>II', MachOEntity.FAT_MAGIC, len(slices)) +
+            ''.join(arches) + ''.join(slices))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-s", "--symbols", action="store", dest="symbols",
+            type="int", default=100000, help="symbols in each slice")
+    parser.add_option("-n", "--binaries", action="store", dest="binaries",
+            type="int", default=3, help="number of binaries")
+    (opts, args) = parser.parse_args()
+
+    rng = random.Random(1)
+    corpus = [make_fat(opts.symbols, rng) for _ in range(opts.binaries)]
+    mb = sum(len(data) for data in corpus) / (1024.0 * 1024.0)
+
+    start = time.time()
+    symbols = 0
+    for data in corpus:
+        mop = MachOParser(data)
+        mop.parse()
+        for entity in mop.entities:
+            for cmd in entity.cmdlist:
+                symbols += len(cmd.get('symbols', []))
+    elapsed = time.time() - start
+
+    print("%d binaries, %.1f MB, %d symbols" % (opts.binaries, mb, symbols))
+    print("parse: %.3fs (%.1f MB/s, %d symbols/s)" %
+          (elapsed, mb / elapsed, symbols / elapsed))
+
+
+if __name__ == '__main__':
+    main()
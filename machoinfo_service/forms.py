@@ -0,0 +1,13 @@
+from django import forms
+
+class MachOInfoConfigForm(forms.Form):
+    error_css_class = 'error'
+    required_css_class = 'required'
+    max_symbols = forms.IntegerField(required=False,
+                                     label="Maximum symbols",
+                                     initial=10000,
+                                     help_text="Symbol tables with more symbols than this are not decoded or added to the results. 0 adds all symbols.")
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('label_suffix', ':')
+        super(MachOInfoConfigForm, self).__init__(*args, **kwargs)
@@ -19,6 +19,43 @@ from datetime import datetime
 class MachOParserError(Exception):
     pass
 
+# A parsed load command. Parts which are expensive to decode, like symbol
+# tables and code signatures, are left to a loader which is only called the
+# first time one of their keys is accessed. The loader may raise
+# MachOParserError.
+class LoadCommand(dict):
+    def __init__(self, values, loader=None, keys=()):
+        dict.__init__(self, values)
+        self.loader = loader
+        self.lazy_keys = frozenset(keys)
+
+    @property
+    def loaded(self):
+        return self.loader is None
+
+    def load(self):
+        loader = self.loader
+        if loader:
+            # Only try once, even if the loader fails.
+            self.loader = None
+            loader(self)
+
+    def __missing__(self, key):
+        if key in self.lazy_keys and not self.loaded:
+            self.load()
+            return self[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.lazy_keys:
+            self.load()
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if key in self.lazy_keys:
+            self.load()
+        return dict.get(self, key, default)
+
 class MachOEntity(object):
     # Magic values
     FAT_MAGIC   = 0xCAFEBABE
@@ -237,6 +274,10 @@ class MachOEntity(object):
 
     # nlist n_type values
     # Use these if n_type & N_TYPE is set.
+    # Precompiled structs, keyed by endianness and format. Shared by all
+    # entities, see get_struct().
+    _structs = {}
+
     N_UNDF = 0x00
     N_ABS  = 0x02
     N_SECT = 0x0E
@@ -440,6 +481,12 @@ class MachOEntity(object):
                                  self.LC_SYMTAB: self.parse_lc_symtab_sub
                                }
 
+        # Sub parsers which only run when one of these keys is accessed.
+        self.lazy_sub_cmd_keys = {
+                                   self.LC_CODE_SIGNATURE: ('sig', 'signatures'),
+                                   self.LC_SYMTAB: ('symbols',)
+                                 }
+
         # Section type mapping
         self.section_types = {
                                self.S_REGULAR: 'Regular',
@@ -612,6 +659,14 @@ class MachOEntity(object):
     def sig_name(self, sig):
         return self.signatures.get(sig, "0x%08x" % sig)
 
+    # Return a precompiled struct for a format in this entity's endianness.
+    def get_struct(self, fmt):
+        key = self.endian + fmt
+        st = self._structs.get(key)
+        if st is None:
+            st = self._structs[key] = struct.Struct(key)
+        return st
+
     def unknown_cmd(self, cmd_data):
         ret = {}
         return ret
@@ -628,18 +683,19 @@ class MachOEntity(object):
         (ret['vmsize'], ret['filesize'], ret['nsects'], ret['flags']) = struct.unpack(self.endian + 'IxxxxIxxxxxxxxII', cmd_data[20:48])
 
         # Sections come after the command.
-        sect_ptr = cmd_data[48:]
+        sect_off = 48
+        sect_struct = self.get_struct('IIIxxxxxxxxxxxxI')
         ret['sectlist'] = []
         for i in xrange(ret['nsects']):
             sect = {}
             # XXX: Ensure nsects * sizeof(struct section) is not off the end.
-            null = sect_ptr[:16].find('\x00')
+            null = cmd_data.find('\x00', sect_off, sect_off + 16)
             if null == -1:
-                null = 16
-            sect['sectname'] = sect_ptr[:null]
+                null = sect_off + 16
+            sect['sectname'] = cmd_data[sect_off:null]
             # Bytes 16 through 32 are the segment name in this section.
             # Skip it as we aren't using it.
-            (addr, sect['size'], sect['offset'], flags) = struct.unpack(self.endian + 'IIIxxxxxxxxxxxxI', sect_ptr[32:60])
+            (addr, sect['size'], sect['offset'], flags) = sect_struct.unpack(cmd_data[sect_off + 32:sect_off + 60])
             sect['addr'] = "0x%08x" % addr
             # 24 bits are for attributes, 8 bits are for type.
             sect['type'] = self.section_types.get(flags & 0xFF, "0x%08x" % flags)
@@ -648,7 +704,7 @@ class MachOEntity(object):
                 if flags & attr == attr:
                     sect['flaglist'].append(desc)
             ret['sectlist'].append(sect)
-            sect_ptr = sect_ptr[68:]
+            sect_off += 68
         return ret
 
     def parse_lc_symtab(self, cmd_data):
@@ -746,18 +802,19 @@ class MachOEntity(object):
         (ret['vmsize'], ret['filesize'], ret['nsects'], ret['flags']) = struct.unpack(self.endian + 'QxxxxxxxxQxxxxxxxxII', cmd_data[24:64])
 
         # Sections come after the command.
-        sect_ptr = cmd_data[64:]
+        sect_off = 64
+        sect_struct = self.get_struct('QQIxxxxxxxxxxxxI')
         ret['sectlist'] = []
         for i in xrange(ret['nsects']):
             sect = {}
             # XXX: Ensure nsects * sizeof(struct section_64) is not off the end.
-            null = sect_ptr[:16].find('\x00')
+            null = cmd_data.find('\x00', sect_off, sect_off + 16)
             if null == -1:
-                null = 16
-            sect['sectname'] = sect_ptr[:null]
+                null = sect_off + 16
+            sect['sectname'] = cmd_data[sect_off:null]
             # Bytes 16 through 32 are the segment name in this section.
             # Skip it as we aren't using it.
-            (addr, sect['size'], sect['offset'], flags) = struct.unpack(self.endian + 'QQIxxxxxxxxxxxxI', sect_ptr[32:68])
+            (addr, sect['size'], sect['offset'], flags) = sect_struct.unpack(cmd_data[sect_off + 32:sect_off + 68])
             sect['addr'] = "0x%08x" % addr
             # 24 bits are for attributes, 8 bits are for type.
             sect['type'] = self.section_types.get(flags & 0xFF, "0x%08x" % flags)
@@ -767,7 +824,7 @@ class MachOEntity(object):
                     sect['flaglist'].append(desc)
             ret['sectlist'].append(sect)
             # XXX: Should be 76 but there are an extra 4 padding bytes (align?)
-            sect_ptr = sect_ptr[80:]
+            sect_off += 80
         return ret
 
     def parse_lc_source_version(self, cmd_data):
@@ -919,44 +976,40 @@ class MachOEntity(object):
         str_off = cmd_dict['str_off']
         str_sz = cmd_dict['str_sz']
 
-        # No need to keep these around anymore.
+        # No need to keep the offset around anymore. nsyms is kept so the
+        # number of symbols is known without decoding them.
         del cmd_dict['sym_off']
-        del cmd_dict['nsyms']
 
-        # We need the string table for some symbols.
-        str_tab = data[str_off:str_off + str_sz]
+        # The string table is read in place in data, from str_off up to
+        # str_end, instead of being copied.
+        str_end = min(str_off + str_sz, len(data))
+
+        # n_desc is unsigned for 64-bit files and signed for 32-bit. Weird.
+        if self.magic in [self.MH_MAGIC_64, self.MH_CIGAM_64]:
+            nlist = self.get_struct('IBBHQ')
+        else:
+            # The docs say n_strx is a signed value, mach-o/nlist.h says
+            # otherwise. I'm trusting the header file. :)
+            nlist = self.get_struct('IBBhI')
+        unpack_from = nlist.unpack_from
 
         # XXX: Ensure sym_off + sizeof(struct nlist) is valid
-        ptr = data[sym_off:]
-        for i in xrange(nsyms):
-            sym = {}
-
-            # n_desc is unsigned for 64-bit files and signed for 32-bit. Weird.
-            if self.magic in [self.MH_MAGIC_64, self.MH_CIGAM_64]:
-                fmt = 'IBBHQ'
-                nlist_size = struct.calcsize(fmt)
-            else:
-                # The docs say n_strx is a signed value, mach-o/nlist.h says
-                # otherwise. I'm trusting the header file. :)
-                fmt = 'IBBhI'
-                nlist_size = struct.calcsize(fmt)
-
-            (n_strx, n_type, n_sect, n_desc, n_value) = struct.unpack(self.endian + fmt, ptr[:nlist_size])
-
-            if n_strx > 0:
-                # XXX: Ensure that str_off + n_strx is valid
-                # n_strx is an offset into the string table starting at
-                # str_off. The strings are null terminated.
-                null = str_tab[n_strx:].find('\x00')
-                if null == 0 or null == -1:
-                    ptr = ptr[nlist_size:]
-                    continue
-                else:
-                    sym['string'] = str_tab[n_strx:n_strx + null]
-            else:
-                ptr = ptr[nlist_size:]
+        # Walk the symbols by offset, each nlist is unpacked in place.
+        for ptr in xrange(sym_off, sym_off + nsyms * nlist.size, nlist.size):
+            (n_strx, n_type, n_sect, n_desc, n_value) = unpack_from(data, ptr)
+
+            if n_strx <= 0:
+                continue
+            # XXX: Ensure that str_off + n_strx is valid
+            # n_strx is an offset into the string table starting at
+            # str_off. The strings are null terminated.
+            str_start = str_off + n_strx
+            null = data.find('\x00', str_start, str_end)
+            if null == str_start or null == -1:
                 continue
 
+            sym = {'string': data[str_start:null]}
+
             # If any of the stab bits are set, the entire byte is to be
             # interpreted as a stab byte. If they are not set then
             # use the other masks to check the values.
@@ -985,7 +1038,6 @@ class MachOEntity(object):
                     sym['external'] = False
 
             symbols.append(sym)
-            ptr = ptr[nlist_size:]
 
         # Symbols go into the cmd_dict.
         cmd_dict['symbols'] = symbols
@@ -1013,8 +1065,11 @@ class MachOEntity(object):
         return self.magic in [self.MH_MAGIC_64, self.MH_CIGAM_64]
 
     # Offset must point to the start of the header. This function
-    # calculates where the commands are from there.
-    def parse_cmds(self, data):
+    # calculates where the commands are from there. source returns the
+    # data again for the lazy sub parsers, so they don't keep a copy of it.
+    def parse_cmds(self, data, source=None):
+        if source is None:
+            source = lambda: data
         if self.is_64bit():
             cmd_offset = self.MACHO64_SZ
         else:
@@ -1022,19 +1077,27 @@ class MachOEntity(object):
 
         if (cmd_offset + (self.ncmds * self.LC_SZ)) > len(data):
             raise MachOParserError("Load commands too large.")
+        lc_struct = self.get_struct('II')
         # Loop through all the commands.
         for i in xrange(self.ncmds):
-            (cmd, size) = struct.unpack(self.endian + 'II', data[cmd_offset:cmd_offset + self.LC_SZ])
+            (cmd, size) = lc_struct.unpack_from(data, cmd_offset)
             # The parsers don't want the 8 bytes we just parsed.
             cmd_data = data[cmd_offset + self.LC_SZ:cmd_offset + size]
             cmd_parser = self.cmd_parsers.get(cmd, self.unknown_cmd)
             cmd_dict = cmd_parser(cmd_data)
             cmd_dict['cmd'] = cmd
-            # Call a sub parser for any commands that need it.
-            sub_cmd_parser = self.sub_cmd_parsers.get(cmd_dict['cmd'], None)
-            if sub_cmd_parser:
-                # cmd_dict is modified by sub parsers.
-                sub_cmd_parser(cmd_dict, data)
+            # Call a sub parser for any commands that need it, now or
+            # when its results are first accessed.
+            sub_cmd_parser = self.sub_cmd_parsers.get(cmd, None)
+            lazy_keys = self.lazy_sub_cmd_keys.get(cmd, ())
+            if sub_cmd_parser and lazy_keys:
+                loader = lambda cmd_dict, parser=sub_cmd_parser: parser(cmd_dict, source())
+                cmd_dict = LoadCommand(cmd_dict, loader, lazy_keys)
+            else:
+                cmd_dict = LoadCommand(cmd_dict)
+                if sub_cmd_parser:
+                    # cmd_dict is modified by sub parsers.
+                    sub_cmd_parser(cmd_dict, data)
             self.cmdlist.append(cmd_dict)
             cmd_offset += size
 
@@ -1049,9 +1112,25 @@ class MachOEntity(object):
         self.sizeofcmds = sizeofcmds
         self.flagval = flagval
 
-    def parse(self, data):
-        self.parse_header(data[:self.MACHO32_SZ])
-        self.parse_cmds(data)
+    # Parses the header and load commands. Symbol tables and code signatures
+    # are decoded when first accessed, see LoadCommand. For one architecture
+    # of a universal binary, pass the whole file with the offset and size of
+    # the architecture. Its data is then only copied while it is parsed.
+    def parse(self, data, offset=0, size=None):
+        if size is None:
+            size = len(data) - offset
+        if offset or size != len(data):
+            source = lambda: data[offset:offset + size]
+        else:
+            source = lambda: data
+        arch_data = source()
+        self.parse_header(arch_data[:self.MACHO32_SZ])
+        self.parse_cmds(arch_data, source)
+
+    # Decode everything left to be decoded lazily.
+    def load_all(self):
+        for cmd_dict in self.cmdlist:
+            cmd_dict.load()
 
 class MachOParser(object):
     def __init__(self, data):
@@ -1079,19 +1158,20 @@ class MachOParser(object):
 
         if entity.is_universal():
             self.entities.append(entity)
-            ptr = self.data[self.FAT_SZ:]
+            fat_arch = entity.get_struct('II')
+            ptr = self.FAT_SZ
             for i in xrange(entity.nfat):
                 # Grab the offset and size from each fat_arch.
-                (offset, size) = struct.unpack(entity.endian + 'II', ptr[8:16])
+                (offset, size) = fat_arch.unpack(self.data[ptr + 8:ptr + 16])
                 if (offset + size) > len(self.data):
                     raise MachOParserError("nfat %i too big.")
                 new_entity = MachOEntity()
                 new_entity.get_magic(self.data[offset:offset + 8])
                 if new_entity.is_universal():
                     raise MachOParserError("Universal inception.")
-                new_entity.parse(self.data[offset:offset + size])
+                new_entity.parse(self.data, offset, size)
                 self.entities.append(new_entity)
-                ptr = ptr[self.FAT_ARCH_SZ:]
+                ptr += self.FAT_ARCH_SZ
         elif entity.is_32bit() or entity.is_64bit():
             entity.parse(self.data)
             self.entities.append(entity)
@@ -43,6 +43,9 @@ class CRITsScript(CRITsBaseScript):
         mop = MachOParser(data)
         try:
             mop.parse()
+            # Everything is printed, so decode it all up front.
+            for entity in mop.entities:
+                entity.load_all()
         except MachOParserError, e:
             print "ERROR: %s" % e
 
@@ -1,4 +1,3 @@
-import sys
 import time
 import array
 import hashlib
@@ -6,8 +5,6 @@ import binascii
 import struct
 import pprint
 
-sys.setrecursionlimit(10000)
-
 class OfficeParser(object):
     summary_mapping = {
         "\xE0\x85\x9F\xF2\xF9\x4F\x68\x10\xAB\x91\x08\x00\x2B\x27\xB3\xD9": { 
@@ -68,42 +65,39 @@ class OfficeParser(object):
         self.mini_fat_data = ''
         self.sector_size = 512
 
+    def get_chain(self, table, sector):
+        # Follow a chain of sectors through a FAT table. The chain ends at
+        # an end of chain marker, a free/special or out of range sector, a
+        # sector pointing to itself, or a sector already seen (a cycle).
+        chain = []
+        seen = set()
+        while sector < len(table) and sector not in seen:
+            seen.add(sector)
+            next_sector = table[sector]
+            if next_sector == sector:
+                break
+            chain.append(sector)
+            if next_sector == 0xfffffffe:
+                break
+            sector = next_sector
+        return chain
+
     def get_mini_fat_chain(self, sector):
-        if sector in [0xffffffff, 0xfffffffe]:
-            return ''
-        elif sector < len(self.mini_fat_table):
-            if self.mini_fat_table[sector] == 0xfffffffe:
-                return self.get_mini_fat_sector(sector)
-            elif sector != self.mini_fat_table[sector]:
-                data = self.get_mini_fat_sector(sector)
-                return data + self.get_mini_fat_chain(self.mini_fat_table[sector])
-        return ''
+        chain = self.get_chain(self.mini_fat_table, sector)
+        return ''.join([self.get_mini_fat_sector(s) for s in chain])
 
     def get_mini_fat_sector(self, sector):
         return self.mini_fat_data[(sector) * 64 : (sector + 1) * 64]
 
     def get_fat_chain(self, sector):
-        if sector in [0xffffffff, 0xfffffffe]:
-            return ''
-        elif sector < len(self.fat_table):
-            if self.verbose:
-                print "request sector %d - len %d" % (sector, len(self.fat_table))
-            if self.fat_table[sector] == 0xfffffffe:
-                return self.get_fat_sector(sector)
-            elif sector != self.fat_table[sector]:
-                data = self.get_fat_sector(sector)
-                return data + self.get_fat_chain(self.fat_table[sector])
-        return ''
+        chain = self.get_chain(self.fat_table, sector)
+        if self.verbose:
+            for s in chain:
+                print "request sector %d - len %d" % (s, len(self.fat_table))
+        return ''.join([self.get_fat_sector(s) for s in chain])
 
     def get_mini_fat_sector_chain(self, sector):
-        if sector in [0xffffffff, 0xfffffffe, 0xfffffffd]:
-            return []
-        elif sector < len(self.fat_table):
-            if self.fat_table[sector] == 0xfffffffe:
-                return [sector]
-            elif sector != self.fat_table[sector]:
-                return [sector] + self.get_mini_fat_sector_chain(self.fat_table[sector])
-        return []
+        return self.get_chain(self.fat_table, sector)
 
     def get_fat_sector(self, sector):
         return self.data[(sector + 1) * self.sector_size : (sector+2) * self.sector_size]
@@ -277,6 +271,11 @@ class OfficeParser(object):
         return {}
 
     def parse_directory(self, data):
+        for offset in xrange(0, len(data) - 127, 128):
+            self.parse_directory_entry(data[offset:offset + 128])
+        return {}
+
+    def parse_directory_entry(self, data):
         if len(data) >= 128:
             #if data[:8] == '\x00\x10\x00\x00\x00\x00\x00\x00': 
             #    print "trucating first 8 bytes"
@@ -332,8 +331,7 @@ class OfficeParser(object):
                 entry['data'] = dir_data
             if self.verbose:
                 pprint.pprint(entry)
-            self.directory.append(entry) 
-            self.parse_directory(data[128:])
+            self.directory.append(entry)
         return {}
 
     def pretty_print(self):
@@ -2,12 +2,12 @@ import hashlib
 import logging
 
 from crits.services.core import Service, ServiceConfigError
+from entropycalc_service.entropy import entropy
 
 import pdfparser
 import pdfid
-import math
+import pdfwalk
 import re
-import json
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +21,7 @@ class PDFInfoService(Service):
     """
 
     name = "pdfinfo"
-    version = '1.2.0'
+    version = '1.3.0'
     description = "Extract information from PDF files."
     supported_types = ['Sample']
 
@@ -35,14 +35,7 @@ class PDFInfoService(Service):
         """
         Calculate entropy for provided data
         """
-        if not data:
-            return 0
-        entropy = 0
-        for x in range(256):
-            p_x = float(data.count(chr(x)))/len(data)
-            if p_x > 0:
-                entropy += - p_x*math.log(p_x, 2)
-        return entropy
+        return entropy(data)
 
     def _get_pdf_version(self, data):
         """
@@ -55,31 +48,15 @@ class PDFInfoService(Service):
         else:
             return "0.0"
 
-    def run_pdfid(self, data):
+    def run_pdfid(self, keywords):
         """
-        Uses PDFid to generate stats for the PDF
+        Report PDFid stats for the PDF
         - Display keyword matches
         """
-        xml_json_success = True
+        for name, count in keywords or []:
+            self._add_result('pdfid', name, {'count': count})
 
-        xml_data = pdfid.PDFiD(data)
-        try:
-            json_data = pdfid.PDFiD2JSON(xml_data,'')
-            pdfid_dict = json.loads(json_data)[0]
-        except UnicodeDecodeError:
-            xml_json_success = False
-        
-        if xml_json_success:
-            try:
-                for item in pdfid_dict['pdfid']['keywords']['keyword']:
-                    self._add_result('pdfid', item['name'], {'count':item['count']})
-            except KeyError:
-                pass
-        else:
-            for count, item in re.findall(r'<Keyword\sCount="([^\"]+)"[^>]+Name=\"([^\"]+)\"',xml_data.toxml()):
-                self._add_result('pdfid', item, {'count':count})
-
-    def object_search(self, data, search_size=100):
+    def object_search(self, pdf_objects, search_size=100):
         """
         Locate objects and references of interest
         @return dictionary containing object types and object id's
@@ -88,8 +65,6 @@ class PDFInfoService(Service):
         Note: It is important that objects_str definitions do 
             not detect objects found with objects_regex defs.
         """
-        oPDFParser = pdfparser.cPDFParser(data)
-        done = False 
         objects = {}
         objects_regex = [(r'js', r'\/JavaScript\s(\d+)\s\d+\sR'),
                         (r'js', r'\/JS\s(\d+)\s\d+\sR'),
@@ -102,122 +77,111 @@ class PDFInfoService(Service):
                         (r'file', '/F\n'),
                         (r'file', '/F\r\n')]
 
-        #Walk the PDF objects
-        while done == False:
-            try:
-                pdf_object = oPDFParser.GetObject()
-            except Exception as e:
-                pdf_object = None
-
-            if pdf_object != None:
-                if pdf_object.type in [pdfparser.PDF_ELEMENT_INDIRECT_OBJECT]:
-                    #See if this PDF object has references to items of interest
-                    rawContent = pdfparser.FormatOutput(pdf_object.content, True)
-                    pdf_references = pdf_object.GetReferences()
-                    if pdf_references:
-                        #Match getReferences() with objects_regex results
-                        for item in objects_regex:
-                            matches = re.findall(item[1],rawContent[:search_size])
-                            for match in matches:
-                                for ref in pdf_references:
-                                    #Record found items
-                                    if match == ref[0]:
-                                        if objects.get(item[0]):
-                                            objects[item[0]].append(match)
-                                        else:
-                                            objects[item[0]] = [match]
-                    #Find items within the current object.
-                    for item in objects_str:
-                        if pdf_object.Contains(item[1]):
-                            if objects.get(item[0]):
-                                objects[item[0]].append(str(pdf_object.id))
-                            else:
-                                objects[item[0]] = [str(pdf_object.id)]
-            else:
-                done = True
+        for pdf_object in pdf_objects:
+            #See if this PDF object has references to items of interest
+            rawContent = pdfparser.FormatOutput(pdf_object.content, True)
+            pdf_references = pdf_object.GetReferences()
+            if pdf_references:
+                #Match getReferences() with objects_regex results
+                for item in objects_regex:
+                    matches = re.findall(item[1],rawContent[:search_size])
+                    for match in matches:
+                        for ref in pdf_references:
+                            #Record found items
+                            if match == ref[0]:
+                                if objects.get(item[0]):
+                                    objects[item[0]].append(match)
+                                else:
+                                    objects[item[0]] = [match]
+            #Find items within the current object.
+            for item in objects_str:
+                if pdf_object.Contains(item[1]):
+                    if objects.get(item[0]):
+                        objects[item[0]].append(str(pdf_object.id))
+                    else:
+                        objects[item[0]] = [str(pdf_object.id)]
         return objects
 
-    def run_pdfparser(self, data):
+    def _stream_md5(self, pdf_object):
+        """
+        MD5 of the decompressed stream of a PDF object
+        @return hex digest, or None if the object has no stream
+        """
+        if not pdf_object.ContainsStream():
+            return None
+
+        try:
+            #decompress stream using codec
+            streamContent = pdf_object.Stream() 
+        except Exception as e:
+            streamContent = "decompress failed."
+
+        if "decompress failed." in streamContent[:50]:
+            #Provide raw stream data
+            streamContent = pdf_object.Stream('')
+
+        #Stream returns list of object tags (not actual stream data)
+        if type(streamContent) == list:
+            streamContent = pdfparser.FormatOutput(pdf_object.content, True)
+            #Inspect pdf_object.content and extract raw stream
+            stream_start = streamContent.find('stream') + len('stream')
+            stream_end = streamContent.rfind('endstream')
+            if stream_start >= 0 and stream_end > 0:
+                streamContent = streamContent[stream_start:stream_end]
+
+        return hashlib.md5(streamContent).hexdigest()
+
+    def run_pdfparser(self, pdf_objects):
         """
         Uses pdf-parser to get information for each object.
-        """        
-        oPDFParser = pdfparser.cPDFParser(data)
-        done = False
-        found_objects = {}
-
-        #Walk the PDF and inspect PDF objects
-        found_objects = self.object_search(data)
-
-        while done == False:
-            try:
-                pdf_object = oPDFParser.GetObject()
-            except Exception as e:
-                pdf_object = None
-
-            if pdf_object != None:
-                if pdf_object.type in [pdfparser.PDF_ELEMENT_INDIRECT_OBJECT]:
-                    #Get general information for this PDF object
-                    rawContent = pdfparser.FormatOutput(pdf_object.content, True)
-                    section_md5_digest = hashlib.md5(rawContent).hexdigest()
-                    section_entropy = self.H(rawContent)
-                    object_type = pdf_object.GetType()
-
-                    #Access data associated with this PDF object
-                    if pdf_object.ContainsStream():
-                        object_stream = True
-                        try:
-                            #decompress stream using codec
-                            streamContent = pdf_object.Stream() 
-                        except Exception as e:
-                            streamContent = "decompress failed."
-
-                        if "decompress failed." in streamContent[:50]:
-                            #Provide raw stream data
-                            streamContent = pdf_object.Stream('')
-
-                        #Stream returns list of object tags (not actual stream data)
-                        if type(streamContent) == list:
-                            streamContent = pdfparser.FormatOutput(pdf_object.content, True)
-                            #Inspect pdf_object.content and extract raw stream
-                            stream_start = streamContent.find('stream') + len('stream')
-                            stream_end = streamContent.rfind('endstream')
-                            if stream_start >= 0 and stream_end > 0:
-                                streamContent = streamContent[stream_start:stream_end]
-
-                        stream_md5_digest = hashlib.md5(streamContent).hexdigest()
-                    else:
-                        object_stream = False
-                        stream_md5_digest = ''
-
-                    #Collect references between this object and others
-                    object_references = []
-                    for reference in pdf_object.GetReferences():
-                        object_references.append(reference[0])
-                    object_references = ','.join(object_references)
-
-                    #Get results from the object searching
-                    object_content = []
-                    if found_objects.get('js'):
-                        if str(pdf_object.id) in found_objects.get('js'):
-                            object_content.append('JavaScript')
-                    if found_objects.get('file'):
-                        if str(pdf_object.id) in found_objects.get('file'):
-                            object_content.append('EmbeddedFile')
-
-                    result = {
-                            "obj_id":           pdf_object.id,
-                            "obj_version":      pdf_object.version,
-                            "size":             len(rawContent),
-                            "type":             object_type,
-                            "entropy":          section_entropy,
-                            "content":          ','.join(object_content),
-                            "x_refs":           object_references,
-                            "stream":           object_stream,
-                            "stream_md5":       stream_md5_digest,
-                    }
-                    self._add_result('pdf_parser', section_md5_digest, result)
-            else:
-                done = True
+        """
+        #Inspect the PDF objects
+        found_objects = self.object_search(pdf_objects)
+        object_stats = {}
+
+        for pdf_object in pdf_objects:
+            #Get general information for this PDF object
+            rawContent = pdfparser.FormatOutput(pdf_object.content, True)
+            section_md5_digest = hashlib.md5(rawContent).hexdigest()
+            object_type = pdf_object.GetType()
+
+            #Objects with the same content have the same entropy and
+            #stream, only decompress and hash each distinct one once
+            if section_md5_digest not in object_stats:
+                object_stats[section_md5_digest] = (self.H(rawContent),
+                                                    self._stream_md5(pdf_object))
+            section_entropy, stream_md5_digest = object_stats[section_md5_digest]
+            object_stream = stream_md5_digest is not None
+            if not object_stream:
+                stream_md5_digest = ''
+
+            #Collect references between this object and others
+            object_references = []
+            for reference in pdf_object.GetReferences():
+                object_references.append(reference[0])
+            object_references = ','.join(object_references)
+
+            #Get results from the object searching
+            object_content = []
+            if found_objects.get('js'):
+                if str(pdf_object.id) in found_objects.get('js'):
+                    object_content.append('JavaScript')
+            if found_objects.get('file'):
+                if str(pdf_object.id) in found_objects.get('file'):
+                    object_content.append('EmbeddedFile')
+
+            result = {
+                    "obj_id":           pdf_object.id,
+                    "obj_version":      pdf_object.version,
+                    "size":             len(rawContent),
+                    "type":             object_type,
+                    "entropy":          section_entropy,
+                    "content":          ','.join(object_content),
+                    "x_refs":           object_references,
+                    "stream":           object_stream,
+                    "stream_md5":       stream_md5_digest,
+            }
+            self._add_result('pdf_parser', section_md5_digest, result)
 
     def run(self, obj, config):
         """
@@ -232,7 +196,9 @@ class PDFInfoService(Service):
         except AttributeError:
             pass
 
-        self.run_pdfid(data)
+        #Walk the PDF once, the keyword counts come from the same pass
+        pdf_objects, keywords = pdfwalk.walk_pdf(data)
+        self.run_pdfid(keywords)
         self._notify()
-        self.run_pdfparser(data)
+        self.run_pdfparser(pdf_objects)
 
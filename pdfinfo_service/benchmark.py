@@ -0,0 +1,79 @@
+"""
+Compare pdf-parser's byte at a time tokenizer with the buffered regex
+tokenizer on generated PDFs.
+
+Only needs pdfparser.py and its imports, the PDFs are generated in memory.
+
+Example Usage:
+    python benchmark.py -o 2000 -s 4096 -n 3
+"""
+
+import os
+import random
+import time
+from optparse import OptionParser
+
+import pdfparser
+
+
+def make_pdf(objects, stream_size, rng):
+    parts = ['%PDF-1.5\n%\xe2\xe3\xcf\xd3\n']
+    for i in range(1, objects + 1):
+        if i % 2:
+            stream = os.urandom(stream_size)
+            parts.append('%d 0 obj\n<< /Length %d /Filter /FlateDecode >>\n'
+                         'stream\n%s\nendstream\nendobj\n' %
+                         (i, len(stream), stream))
+        else:
+            parts.append('%d 0 obj\n<< /Type /Page /Parent 1 0 R '
+                         '/MediaBox [0 0 612 792] /Contents %d 0 R '
+                         '/Resources << /Font << /F1 %d 0 R >> >> '
+                         '/Title (Page %d) >>\nendobj\n' %
+                         (i, i - 1, rng.randint(1, objects), i))
+    parts.append('trailer\n<< /Root 1 0 R /Size %d >>\nstartxref\n0\n%%%%EOF\n'
+                 % (objects + 1))
+    return ''.join(parts)
+
+
+def tokenize(tokenizer):
+    count = 0
+    token = tokenizer.Token()
+    while token is not None:
+        count += 1
+        token = tokenizer.Token()
+    return count
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-o", "--objects", action="store", dest="objects",
+            type="int", default=2000, help="objects in each PDF")
+    parser.add_option("-s", "--stream-size", action="store", dest="size",
+            type="int", default=4096, help="stream size in bytes")
+    parser.add_option("-n", "--pdfs", action="store", dest="pdfs",
+            type="int", default=3, help="number of PDFs")
+    (opts, args) = parser.parse_args()
+
+    rng = random.Random(1)
+    corpus = [make_pdf(opts.objects, opts.size, rng) for _ in range(opts.pdfs)]
+    mb = sum(len(data) for data in corpus) / (1024.0 * 1024.0)
+
+    start = time.time()
+    tokens_bytes = sum(tokenize(pdfparser.cPDFTokenizer(data))
+                       for data in corpus)
+    bytes_time = time.time() - start
+
+    start = time.time()
+    tokens_buffered = sum(tokenize(pdfparser.cPDFTokenizerBuffered(data))
+                          for data in corpus)
+    buffered_time = time.time() - start
+
+    print("%d PDFs, %.1f MB" % (opts.pdfs, mb))
+    print("byte at a time: %.3fs (%.2f MB/s) %d tokens" %
+          (bytes_time, mb / bytes_time, tokens_bytes))
+    print("buffered:       %.3fs (%.2f MB/s) %d tokens" %
+          (buffered_time, mb / buffered_time, tokens_buffered))
+
+
+if __name__ == '__main__':
+    main()
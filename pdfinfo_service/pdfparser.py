@@ -260,11 +260,49 @@ class cPDFTokenizer:
     def unget(self, byte):
         self.ungetted.append(byte)
 
+# Whitespace, regular characters, comments and the other delimiters, in the same groups as CharacterClass
+reToken = re.compile(r'([\x00\t\n\x0c\r ]+)|([^\x00\t\n\x0c\r ()<>\[\]{}/%]+)|(%[^\r\n]*(?:[\r\n]\n?)?|<<|>>|[()<>\[\]{}/])')
+TOKEN_CLASSES = {1: CHAR_WHITESPACE, 2: CHAR_REGULAR, 3: CHAR_DELIMITER}
+
+class cPDFTokenizerBuffered:
+    """Same tokens as cPDFTokenizer, matched with a regular expression on the whole document in memory instead of read byte by byte"""
+
+    def __init__(self, file):
+        oPDF = cPDFDocument(file)
+        self.data = oPDF.infile.read()
+        oPDF.infile.close()
+        if sys.version_info[0] > 2:
+            self.data = self.data.decode('latin-1')
+        self.index = 0
+        self.ungetted = []
+
+    def Token(self):
+        if len(self.ungetted) != 0:
+            return self.ungetted.pop()
+        oMatch = reToken.match(self.data, self.index)
+        if oMatch == None:
+            return None
+        self.index = oMatch.end()
+        self.token = oMatch.group()
+        return (TOKEN_CLASSES[oMatch.lastindex], self.token)
+
+    def TokenIgnoreWhiteSpace(self):
+        token = self.Token()
+        while token != None and token[0] == CHAR_WHITESPACE:
+            token = self.Token()
+        return token
+
+    def unget(self, byte):
+        self.ungetted.append(byte)
+
 class cPDFParser:
-    def __init__(self, file, verbose=False, extract=None):
+    def __init__(self, file, verbose=False, extract=None, buffered=False):
         self.context = CONTEXT_NONE
         self.content = []
-        self.oPDFTokenizer = cPDFTokenizer(file)
+        if buffered:
+            self.oPDFTokenizer = cPDFTokenizerBuffered(file)
+        else:
+            self.oPDFTokenizer = cPDFTokenizer(file)
         self.verbose = verbose
         self.extract = extract
 
@@ -0,0 +1,197 @@
+"""
+Single pass over a PDF with pdf-parser.
+
+pdf-parser already reads every byte of the file to find the indirect
+objects, so the PDFiD keyword counts are taken from the same tokens instead
+of reading the file again with PDFiD. The counting follows PDFiD's rules:
+words are runs of letters and digits, #xx hex codes are decoded in names,
+and the bytes up to the end of the PDF header are not counted.
+"""
+
+import re
+import string
+
+import pdfparser
+
+# Same keywords, in the same order, as PDFiD reports them.
+KEYWORDS = ('obj',
+            'endobj',
+            'stream',
+            'endstream',
+            'xref',
+            'trailer',
+            'startxref',
+            '/Page',
+            '/Encrypt',
+            '/ObjStm',
+            '/JS',
+            '/JavaScript',
+            '/AA',
+            '/OpenAction',
+            '/AcroForm',
+            '/JBIG2Decode',
+            '/RichMedia',
+            '/Launch',
+            '/EmbeddedFile',
+            '/XFA',
+           )
+COLORS_KEYWORD = '/Colors > 2^24'
+
+# Words, hex codes, a lone '#', a '/' or any run of other bytes.
+_pieces = re.compile(r'[A-Za-z0-9]+|#[0-9A-Fa-f]{2}|#|/|[^A-Za-z0-9#/]+')
+_word_chars = frozenset(string.ascii_letters + string.digits)
+
+
+def header_end(data):
+    """
+    Find where PDFiD starts counting keywords, after the PDF header.
+
+    :param data: The start of the PDF.
+    :type data: str
+    :returns: int, or None if there is no PDF header.
+    """
+
+    index = data.find('%PDF', 0, 1024)
+    if index == -1:
+        return None
+    end = index + 4
+    for end in xrange(index + 4, index + 4 + 10):
+        if data[end:end + 1] in ('\n', '\r'):
+            break
+    return end
+
+
+class KeywordCounter(object):
+    """
+    Count PDFiD keywords in data fed in consecutive pieces.
+    """
+
+    def __init__(self, skip=0):
+        self.counts = dict((keyword, 0) for keyword in KEYWORDS)
+        self.colors = 0
+        self.fed = 0
+        self._skip = skip
+        self._word = ''
+        self._slash = ''
+        self._last_name = ''
+
+    def feed(self, data):
+        start = self.fed
+        self.fed += len(data)
+        if self.fed <= self._skip:
+            return
+        if start < self._skip:
+            data = data[self._skip - start:]
+        for piece in _pieces.findall(data):
+            first = piece[0]
+            if first == '#':
+                if self._slash == '/':
+                    if len(piece) == 3:
+                        self._word += chr(int(piece[1:], 16))
+                    else:
+                        self._update()
+                    continue
+                self._other()
+                self._slash = ''
+                self._word = piece[1:]
+            elif first == '/':
+                self._other()
+                self._slash = '/'
+            elif first in _word_chars:
+                self._word += piece
+            else:
+                self._other()
+                self._slash = ''
+
+    def close(self):
+        """
+        Finish counting.
+
+        :returns: list of (keyword, count) tuples in PDFiD order.
+        """
+
+        self._update()
+        return ([(keyword, self.counts[keyword]) for keyword in KEYWORDS] +
+                [(COLORS_KEYWORD, self.colors)])
+
+    def _other(self):
+        # Any byte which is not part of a word ends it.
+        word = self._word
+        if (self._last_name == '/Colors' and word.isdigit() and
+            int(word) > 2^24):
+            self.colors += 1
+        self._update()
+
+    def _update(self):
+        word = self._word
+        if word:
+            name = self._slash + word
+            if name in self.counts:
+                self.counts[name] += 1
+            if self._slash == '/':
+                self._last_name = name
+            self._word = ''
+
+
+class CountingTokenizer(object):
+    """
+    Wrap a pdf-parser tokenizer, feeding every token it reads from the file
+    to a KeywordCounter. Tokens pushed back and read again are only fed once.
+    """
+
+    def __init__(self, tokenizer, counter):
+        self.tokenizer = tokenizer
+        self.counter = counter
+
+    def Token(self):
+        replay = len(self.tokenizer.ungetted) != 0
+        token = self.tokenizer.Token()
+        if token is not None and not replay:
+            self.counter.feed(token[1])
+        return token
+
+    def TokenIgnoreWhiteSpace(self):
+        token = self.Token()
+        while token is not None and token[0] == pdfparser.CHAR_WHITESPACE:
+            token = self.Token()
+        return token
+
+    def unget(self, byte):
+        self.tokenizer.unget(byte)
+
+
+def walk_pdf(data, buffered=True):
+    """
+    Parse a PDF once.
+
+    :param data: The PDF.
+    :type data: str
+    :param buffered: Use pdf-parser's regex tokenizer instead of reading the
+                     PDF one byte at a time.
+    :type buffered: bool
+    :returns: tuple (list of indirect objects, keyword counts). The keyword
+              counts are a list of (keyword, count) tuples like PDFiD
+              reports, or None if the data has no PDF header.
+    """
+
+    skip = header_end(data)
+    counter = KeywordCounter(skip or 0)
+    oPDFParser = pdfparser.cPDFParser(data, buffered=buffered)
+    oPDFParser.oPDFTokenizer = CountingTokenizer(oPDFParser.oPDFTokenizer,
+                                                 counter)
+    objects = []
+    while True:
+        try:
+            pdf_object = oPDFParser.GetObject()
+        except Exception:
+            pdf_object = None
+        if pdf_object is None:
+            break
+        if pdf_object.type == pdfparser.PDF_ELEMENT_INDIRECT_OBJECT:
+            objects.append(pdf_object)
+
+    if skip is None:
+        return objects, None
+    # The parser stops early on errors, count whatever it did not read.
+    counter.feed(data[counter.fed:])
+    return objects, counter.close()
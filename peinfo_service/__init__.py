@@ -8,9 +8,6 @@
 from __future__ import division
 
 import pefile
-import bitstring
-import string
-import bz2
 import binascii
 import hashlib
 import logging
@@ -26,9 +23,22 @@ from crits.vocabulary.relationships import RelationshipTypes
 from crits.vocabulary.acls import SampleACL
 
 from . import forms
+from .mapped import MappedImage
+from .pehash import pehash
 
 logger = logging.getLogger(__name__)
 
+# Data directories pefile has to parse for each group of results. The
+# sections, rich header, PEhash and timestamp only need the headers.
+GROUP_DIRECTORIES = {
+    'imports': 'IMAGE_DIRECTORY_ENTRY_IMPORT',
+    'exports': 'IMAGE_DIRECTORY_ENTRY_EXPORT',
+    'resources': 'IMAGE_DIRECTORY_ENTRY_RESOURCE',
+    'version': 'IMAGE_DIRECTORY_ENTRY_RESOURCE',
+    'debug': 'IMAGE_DIRECTORY_ENTRY_DEBUG',
+    'tls': 'IMAGE_DIRECTORY_ENTRY_TLS',
+}
+
 
 class PEInfoService(Service):
     """
@@ -40,7 +50,7 @@ class PEInfoService(Service):
     """
 
     name = "peinfo"
-    version = '1.1.5'
+    version = '1.2.0'
     supported_types = ['Sample']
     description = "Generate metadata about Windows PE/COFF files."
     added_files = []
@@ -55,6 +65,10 @@ class PEInfoService(Service):
     def bind_runtime_form(analyst, config):
         if 'resource' not in config:
             config['resource'] = False
+        if 'resource_limit' not in config:
+            config['resource_limit'] = forms.PEInfoRunForm().fields['resource_limit'].initial
+        if 'groups' not in config:
+            config['groups'] = [name for name, label in forms.GROUPS]
         return forms.PEInfoRunForm(config)
 
     @classmethod
@@ -72,149 +86,94 @@ class PEInfoService(Service):
         return {}
 
     def _get_pehash(self, exe):
-        #image characteristics
-        img_chars = bitstring.BitArray(hex(exe.FILE_HEADER.Characteristics))
-        #pad to 16 bits
-        if len(img_chars) == 8:
-            img_chars = bitstring.BitArray('0b00000000') + img_chars
-        img_chars = bitstring.BitArray(bytes=img_chars.tobytes())
-        img_chars_xor = img_chars[0:7] ^ img_chars[8:15]
-
-        #start to build pehash
-        pehash_bin = bitstring.BitArray(img_chars_xor)
-
-        #subsystem -
-        sub_chars = bitstring.BitArray(hex(exe.FILE_HEADER.Machine))
-        #pad to 16 bits
-        sub_chars = bitstring.BitArray(bytes=sub_chars.tobytes())
-        sub_chars_xor = sub_chars[0:7] ^ sub_chars[8:15]
-        pehash_bin.append(sub_chars_xor)
-
-        #Stack Commit Size
-        stk_size = bitstring.BitArray(hex(exe.OPTIONAL_HEADER.SizeOfStackCommit))
-        stk_size_bits = string.zfill(stk_size.bin, 32)
-        #now xor the bits
-        stk_size = bitstring.BitArray(bin=stk_size_bits)
-        stk_size_xor = stk_size[8:15] ^ stk_size[16:23] ^ stk_size[24:31]
-        #pad to 8 bits
-        stk_size_xor = bitstring.BitArray(bytes=stk_size_xor.tobytes())
-        pehash_bin.append(stk_size_xor)
-
-        #Heap Commit Size
-        hp_size = bitstring.BitArray(hex(exe.OPTIONAL_HEADER.SizeOfHeapCommit))
-        hp_size_bits = string.zfill(hp_size.bin, 32)
-        #now xor the bits
-        hp_size = bitstring.BitArray(bin=hp_size_bits)
-        hp_size_xor = hp_size[8:15] ^ hp_size[16:23] ^ hp_size[24:31]
-        #pad to 8 bits
-        hp_size_xor = bitstring.BitArray(bytes=hp_size_xor.tobytes())
-        pehash_bin.append(hp_size_xor)
-
-        #Section chars
-        for section in exe.sections:
-            #virutal address
-            sect_va =  bitstring.BitArray(hex(section.VirtualAddress))
-            sect_va = bitstring.BitArray(bytes=sect_va.tobytes())
-            pehash_bin.append(sect_va)
-
-            #rawsize
-            sect_rs =  bitstring.BitArray(hex(section.SizeOfRawData))
-            sect_rs = bitstring.BitArray(bytes=sect_rs.tobytes())
-            sect_rs_bits = string.zfill(sect_rs.bin, 32)
-            sect_rs = bitstring.BitArray(bin=sect_rs_bits)
-            sect_rs = bitstring.BitArray(bytes=sect_rs.tobytes())
-            sect_rs_bits = sect_rs[8:31]
-            pehash_bin.append(sect_rs_bits)
-
-            #section chars
-            sect_chars =  bitstring.BitArray(hex(section.Characteristics))
-            sect_chars = bitstring.BitArray(bytes=sect_chars.tobytes())
-            sect_chars_xor = sect_chars[16:23] ^ sect_chars[24:31]
-            pehash_bin.append(sect_chars_xor)
-
-            #entropy calulation
-            address = section.VirtualAddress
-            size = section.SizeOfRawData
-            raw = exe.write()[address+size:]
-            if size == 0:
-                kolmog = bitstring.BitArray(float=1, length=32)
-                pehash_bin.append(kolmog[0:7])
-                continue
-            bz2_raw = bz2.compress(raw)
-            bz2_size = len(bz2_raw)
-            #k = round(bz2_size / size, 5)
-            k = bz2_size / size
-            kolmog = bitstring.BitArray(float=k, length=32)
-            pehash_bin.append(kolmog[0:7])
-
-        m = hashlib.sha1()
-        m.update(pehash_bin.tobytes())
-        output = m.hexdigest()
+        try:
+            output = pehash(exe)
+        except Exception as e:
+            self._parse_error("PEhash", e)
+            return
         self._add_result('PEhash value', "%s" % output, {'Value': output})
 
     def run(self, obj, config):
+        groups = config.get('groups') or [name for name, label in forms.GROUPS]
+        directories = set(pefile.DIRECTORY_ENTRY[GROUP_DIRECTORIES[group]]
+                          for group in groups if group in GROUP_DIRECTORIES)
         try:
             self._debug("Version: %s" % pefile.__version__ )
-            pe = pefile.PE(data=obj.filedata.read())
+            # Only parse the data directories the results need.
+            pe = pefile.PE(data=obj.filedata.read(), fast_load=True)
+            if directories:
+                pe.parse_data_directories(directories=sorted(directories))
         except pefile.PEFormatError as e:
             self._error("A PEFormatError occurred: %s" % e)
             return
-        self._get_sections(pe)
-        self._get_pehash(pe)
+        if 'sections' in groups:
+            self._get_sections(pe)
+        if 'pehash' in groups:
+            self._get_pehash(pe)
 
         user = self.current_task.user
 
-        if hasattr(pe, 'DIRECTORY_ENTRY_RESOURCE'):
-            self._dump_resource_data("ROOT",
-                                     pe.DIRECTORY_ENTRY_RESOURCE,
-                                     pe,
-                                     config['resource'])
-            if user.has_access_to(SampleACL.WRITE):
-                for f in self.added_files:
-                    handle_file(f[0], f[1], obj.source,
-                                related_id=str(obj.id),
-                                related_type=str(obj._meta['crits_type']),
-                                campaign=obj.campaign,
-                                source_method=self.name,
-                                relationship=RelationshipTypes.CONTAINED_WITHIN,
-                                user=user)
-                    rsrc_md5 = hashlib.md5(f[1]).hexdigest()
-                    self._add_result("file_added", f[0], {'md5': rsrc_md5})
-        else:
-            self._debug("No resources")
-
-        if hasattr(pe, 'DIRECTORY_ENTRY_IMPORT'):
-            self._get_imports(pe)
-        else:
-            self._debug("No imports")
-
-        if hasattr(pe, 'DIRECTORY_ENTRY_EXPORT'):
-            self._get_exports(pe)
-        else:
-            self._debug("No exports")
-
-        if hasattr(pe, 'VS_VERSIONINFO'):
-            self._get_version_info(pe)
-        else:
-            self._debug("No Version information")
-
-        if hasattr(pe, 'DIRECTORY_ENTRY_DEBUG'):
-            self._get_debug_info(pe)
-        else:
-            self._debug("No debug info")
-
-        if hasattr(pe, 'DIRECTORY_ENTRY_TLS'):
-            self._get_tls_info(pe)
-        else:
-            self._debug("No TLS info")
-
-        if callable(getattr(pe, 'get_imphash', None)):
-            self._get_imphash(pe)
-        else:
-            self._debug("pefile does not support get_imphash, upgrade to 1.2.10-139")
+        if 'resources' in groups:
+            if hasattr(pe, 'DIRECTORY_ENTRY_RESOURCE'):
+                self.added_files = []
+                self.resource_bytes = 0
+                self.resource_limit = config.get('resource_limit', 0)
+                self._dump_resource_data("ROOT",
+                                         pe.DIRECTORY_ENTRY_RESOURCE,
+                                         MappedImage(pe),
+                                         config['resource'])
+                if user.has_access_to(SampleACL.WRITE):
+                    for f in self.added_files:
+                        handle_file(f[0], f[1], obj.source,
+                                    related_id=str(obj.id),
+                                    related_type=str(obj._meta['crits_type']),
+                                    campaign=obj.campaign,
+                                    source_method=self.name,
+                                    relationship=RelationshipTypes.CONTAINED_WITHIN,
+                                    user=user)
+                        self._add_result("file_added", f[0], {'md5': f[2]})
+            else:
+                self._debug("No resources")
+
+        if 'imports' in groups:
+            if hasattr(pe, 'DIRECTORY_ENTRY_IMPORT'):
+                self._get_imports(pe)
+            else:
+                self._debug("No imports")
+
+        if 'exports' in groups:
+            if hasattr(pe, 'DIRECTORY_ENTRY_EXPORT'):
+                self._get_exports(pe)
+            else:
+                self._debug("No exports")
+
+        if 'version' in groups:
+            if hasattr(pe, 'VS_VERSIONINFO'):
+                self._get_version_info(pe)
+            else:
+                self._debug("No Version information")
+
+        if 'debug' in groups:
+            if hasattr(pe, 'DIRECTORY_ENTRY_DEBUG'):
+                self._get_debug_info(pe)
+            else:
+                self._debug("No debug info")
+
+        if 'tls' in groups:
+            if hasattr(pe, 'DIRECTORY_ENTRY_TLS'):
+                self._get_tls_info(pe)
+            else:
+                self._debug("No TLS info")
+
+        if 'imports' in groups:
+            if callable(getattr(pe, 'get_imphash', None)):
+                self._get_imphash(pe)
+            else:
+                self._debug("pefile does not support get_imphash, upgrade to 1.2.10-139")
 
         self._get_timestamp(pe)
-        self._get_rich_header(pe)
+        if 'rich' in groups:
+            self._get_rich_header(pe)
 
     # http://www.ntcore.com/files/richsign.htm
     def _get_rich_header(self, pe):
@@ -257,7 +216,7 @@ class PEInfoService(Service):
         imphash = pe.get_imphash()
         self._add_result('imphash', imphash, {'import_hash': imphash})
 
-    def _dump_resource_data(self, name, dir, pe, save):
+    def _dump_resource_data(self, name, dir, image, save):
         for i in dir.entries:
             try:
                 if hasattr(i, 'data'):
@@ -265,31 +224,43 @@ class PEInfoService(Service):
                     rva = x.struct.OffsetToData
                     rname = "%s_%s_%s" % (name, i.name, x.struct.name)
                     size = x.struct.Size
-                    data = pe.get_memory_mapped_image()[rva:rva + size]
-                    if not data:
-                        data = ""
-                    if len(data) > 0:
-                        if (save or data[:2] == 'MZ' or data[:4] == "%%PDF"):
-                            self._debug("Adding new file from resource len %d - %s" % (len(data), rname))
-                            self.added_files.append((rname, data))
+                    # Hash the resource in place, it is only copied if it
+                    # becomes a new file.
+                    md5, length = image.md5(rva, size)
+                    if length > 0:
+                        magic = image.read(rva, 4)
+                        if (save or magic[:2] == 'MZ' or magic[:4] == "%%PDF"):
+                            self._add_resource_file(rname, image.read(rva, size), md5)
                     results = {
                             "resource_type": x.struct.name.decode('UTF-8', errors='replace') ,
                             "resource_id": i.id,
                             "language": x.lang,
                             "sub_language": x.sublang,
                             "address": hex(x.struct.OffsetToData),
-                            "size": len(data),
-                            "md5": hashlib.md5(data).hexdigest(),
+                            "size": length,
+                            "md5": md5,
                     }
                     self._debug("Adding result for resource %s" % i.name)
                     self._add_result('pe_resource', x.struct.name, results)
                 if hasattr(i, "directory"):
                     self._debug("Parsing next directory entry %s" % i.name)
                     self._dump_resource_data(name + "_%s" % i.name,
-                                             i.directory, pe, save)
+                                             i.directory, image, save)
             except Exception as e:
                 self._parse_error("Resource directory entry", e)
 
+    def _add_resource_file(self, rname, data, md5):
+        # Installers can hold hundreds of MB of resources, stop adding files
+        # once resource_limit bytes have been extracted.
+        if (self.resource_limit and
+            self.resource_bytes + len(data) > self.resource_limit):
+            self._info("Not adding resource %s (%d bytes), over the limit of %d bytes" %
+                       (rname, len(data), self.resource_limit))
+            return
+        self.resource_bytes += len(data)
+        self._debug("Adding new file from resource len %d - %s" % (len(data), rname))
+        self.added_files.append((rname, data, md5))
+
     def _get_sections(self, pe):
         for section in pe.sections:
             try:
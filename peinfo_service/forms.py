@@ -1,12 +1,34 @@
 from django import forms
 
+# Groups of results the service can generate.
+GROUPS = [('sections', 'Sections'),
+          ('imports', 'Imports and imphash'),
+          ('exports', 'Exports'),
+          ('resources', 'Resources'),
+          ('version', 'Version information'),
+          ('debug', 'Debug information'),
+          ('tls', 'TLS callbacks'),
+          ('rich', 'Rich header'),
+          ('pehash', 'PEhash')]
+
 class PEInfoRunForm(forms.Form):
     error_css_class = 'error'
     required_css_class = 'required'
+    groups = forms.MultipleChoiceField(required=True,
+                                       label='Results',
+                                       choices=GROUPS,
+                                       initial=[name for name, label in GROUPS],
+                                       widget=forms.CheckboxSelectMultiple,
+                                       help_text="Only parse the parts of the PE needed for these results.")
     resource = forms.BooleanField(required=False,
                                   label="Resources",
                                   help_text="New samples from resources.",
                                   initial=True)
+    resource_limit = forms.IntegerField(required=True,
+                                        label="Resource limit",
+                                        help_text="Maximum bytes of new samples from resources, 0 for no limit.",
+                                        min_value=0,
+                                        initial=100 * 1024 * 1024)
 
     def __init__(self, *args, **kwargs):
         kwargs.setdefault('label_suffix', ':')
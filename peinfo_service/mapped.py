@@ -0,0 +1,116 @@
+"""
+Read a PE's memory mapped image straight from the file data.
+
+pefile's get_memory_mapped_image() copies the whole file and every section
+into a new string each time it is called. MappedImage works out the same
+layout once, as a list of file ranges and zero filled gaps, and reads or
+hashes data by RVA from the original buffer.
+"""
+
+import hashlib
+
+# Zeros hashed at a time for gaps between sections.
+ZERO_BLOCK = '\x00' * 65536
+
+
+class MappedImage(object):
+    """
+    The layout of pefile's get_memory_mapped_image() for a parsed PE.
+
+    The image is a list of (start RVA, end RVA, file offset) segments. The
+    file offset is None for zero filled gaps.
+    """
+
+    def __init__(self, pe, max_virtual_address=0x10000000):
+        self.data = pe.__data__
+        self.segments = [(0, len(self.data), 0)]
+        self.length = len(self.data)
+
+        file_alignment = pe.OPTIONAL_HEADER.FileAlignment
+        section_alignment = pe.OPTIONAL_HEADER.SectionAlignment
+        for section in pe.sections:
+            # Same checks as get_memory_mapped_image().
+            if section.Misc_VirtualSize == 0 and section.SizeOfRawData == 0:
+                continue
+            srd = section.SizeOfRawData
+            prd = pe.adjust_FileAlignment(section.PointerToRawData,
+                                          file_alignment)
+            va = pe.adjust_SectionAlignment(section.VirtualAddress,
+                                            section_alignment,
+                                            file_alignment)
+            if (srd > len(self.data) or
+                prd > len(self.data) or
+                srd + prd > len(self.data) or
+                va >= max_virtual_address):
+                continue
+
+            if va > self.length:
+                self.segments.append((self.length, va, None))
+            elif va < self.length:
+                self._truncate(va)
+            self.length = va
+
+            # Same bytes as section.get_data().
+            end = min(prd + srd, section.PointerToRawData + srd,
+                      len(self.data))
+            if end > prd:
+                self.segments.append((va, va + end - prd, prd))
+                self.length = va + end - prd
+
+    def _truncate(self, length):
+        segments = []
+        for start, end, offset in self.segments:
+            if start >= length:
+                break
+            segments.append((start, min(end, length), offset))
+        self.segments = segments
+
+    def pieces(self, rva, size):
+        """
+        Get the data at an RVA without copying file data.
+
+        Reads past the end of the image are cut short, like slicing the
+        mapped image.
+
+        :param rva: The RVA to read from.
+        :type rva: int
+        :param size: Number of bytes to read.
+        :type size: int
+        :returns: generator of buffer or str
+        """
+
+        end = min(rva + size, self.length)
+        for seg_start, seg_end, offset in self.segments:
+            if seg_end <= rva:
+                continue
+            if seg_start >= end:
+                break
+            start = max(rva, seg_start)
+            length = min(end, seg_end) - start
+            if offset is None:
+                while length > 0:
+                    yield ZERO_BLOCK[:length]
+                    length -= len(ZERO_BLOCK)
+            else:
+                yield buffer(self.data, offset + start - seg_start, length)
+
+    def read(self, rva, size):
+        """
+        Same as get_memory_mapped_image()[rva:rva + size].
+        """
+
+        return ''.join(str(piece) for piece in self.pieces(rva, size))
+
+    def md5(self, rva, size):
+        """
+        Hash the data at an RVA without copying it.
+
+        :returns: tuple (md5 hex digest, number of bytes hashed)
+        """
+
+        md5 = hashlib.md5()
+        length = 0
+        for piece in self.pieces(rva, size):
+            md5.update(piece)
+            length += len(piece)
+        return md5.hexdigest(), length
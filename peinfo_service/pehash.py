@@ -0,0 +1,139 @@
+# Copyright (c) 2016, The MITRE Corporation. All rights reserved.
+# Copyright (c) 2016, Adam Polkosnik, Team Cymru.  All rights reserved.
+
+# Source code distributed pursuant to license agreement.
+# PEhash computing code is from Team Cymru.
+
+"""
+PEhash of a PE parsed with pefile.
+
+This computes the same hash as Team Cymru's bitstring based code did, with
+the bit fields held in plain ints. The original code built each field from
+the hex() string of a header value, so a field is 4 bits per hex digit,
+padded on the right to whole bytes where the original called tobytes().
+The helpers below keep those rules, which matter for the result.
+
+Only the headers and section table are used, so the PE can be loaded with
+pefile's fast_load.
+"""
+
+from __future__ import division
+
+import bz2
+import hashlib
+import struct
+
+# Big endian IEEE 754 single precision, like BitArray(float=k, length=32).
+FLOAT32 = struct.Struct('>f')
+
+
+class PEhashError(ValueError):
+    pass
+
+
+def _hex_bits(value):
+    # BitArray(hex(value)): (bits, length)
+    return value, 4 * len('%x' % value)
+
+
+def _pad(value, length):
+    # BitArray(bytes=bits.tobytes()): zero pad on the right to whole bytes.
+    pad = -length % 8
+    return value << pad, length + pad
+
+
+def _slice(value, length, start, stop):
+    # bits[start:stop], bits are numbered from the most significant.
+    start = min(start, length)
+    stop = min(stop, length)
+    if stop < start:
+        stop = start
+    return (value >> (length - stop)) & ((1 << (stop - start)) - 1), stop - start
+
+
+def _xor(*fields):
+    value, length = fields[0]
+    for other, other_length in fields[1:]:
+        if other_length != length:
+            raise PEhashError("Fields must have the same length for xor")
+        value ^= other
+    return value, length
+
+
+def _commit_size(size):
+    # zfill the bits to 32, xor the last three bytes (7 bits of each) and
+    # pad the result to 8 bits.
+    value, length = _hex_bits(size)
+    length = max(length, 32)
+    return _pad(*_xor(_slice(value, length, 8, 15),
+                      _slice(value, length, 16, 23),
+                      _slice(value, length, 24, 31)))
+
+
+def _kolmogorov(k):
+    # First 7 bits of k as a 32 bit float.
+    return ord(FLOAT32.pack(k)[0]) >> 1, 7
+
+
+def pehash(pe):
+    """
+    Calculate the PEhash of a PE.
+
+    :param pe: The PE.
+    :type pe: pefile.PE
+    :returns: str, the PEhash as a hex digest.
+    :raises: PEhashError if a header value is too short to hash, the
+             original code failed on these too.
+    """
+
+    fields = []
+
+    # Image characteristics, padded to 16 bits.
+    value, length = _hex_bits(pe.FILE_HEADER.Characteristics)
+    if length == 8:
+        length = 16
+    value, length = _pad(value, length)
+    fields.append(_xor(_slice(value, length, 0, 7),
+                       _slice(value, length, 8, 15)))
+
+    # Subsystem, from the machine type.
+    value, length = _pad(*_hex_bits(pe.FILE_HEADER.Machine))
+    fields.append(_xor(_slice(value, length, 0, 7),
+                       _slice(value, length, 8, 15)))
+
+    fields.append(_commit_size(pe.OPTIONAL_HEADER.SizeOfStackCommit))
+    fields.append(_commit_size(pe.OPTIONAL_HEADER.SizeOfHeapCommit))
+
+    data = None
+    for section in pe.sections:
+        # Virtual address
+        fields.append(_pad(*_hex_bits(section.VirtualAddress)))
+
+        # Raw size, zfilled to 32 bits.
+        value, length = _pad(*_hex_bits(section.SizeOfRawData))
+        fields.append(_slice(value, max(length, 32), 8, 31))
+
+        # Section characteristics
+        value, length = _pad(*_hex_bits(section.Characteristics))
+        fields.append(_xor(_slice(value, length, 16, 23),
+                           _slice(value, length, 24, 31)))
+
+        # Compressibility of the data after the section.
+        size = section.SizeOfRawData
+        if size == 0:
+            fields.append(_kolmogorov(1))
+            continue
+        if data is None:
+            data = pe.write()
+        raw = data[section.VirtualAddress + size:]
+        fields.append(_kolmogorov(len(bz2.compress(raw)) / size))
+
+    pehash_bits = 0
+    pehash_length = 0
+    for value, length in fields:
+        pehash_bits = (pehash_bits << length) | value
+        pehash_length += length
+    pehash_bits, pehash_length = _pad(pehash_bits, pehash_length)
+    pehash_bin = ''.join(chr((pehash_bits >> shift) & 0xff)
+                         for shift in xrange(pehash_length - 8, -1, -8))
+    return hashlib.sha1(pehash_bin).hexdigest()
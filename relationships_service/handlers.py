@@ -3,14 +3,137 @@ try:
 except ImportError:
     from django.core.urlresolvers import reverse
 
+from bson.objectid import ObjectId
+
 from crits.campaigns.campaign import Campaign
 from crits.campaigns.handlers import get_campaign_details
 from crits.core.crits_mongoengine import EmbeddedCampaign
 from crits.core.user_tools import user_sources
 from crits.core.class_mapper import class_from_type, class_from_id
 
-def gather_relationships(obj_type, obj_id, user, depth, types):
+from . import snapshots
+
+# Field used as the label of each type of node.
+FIELD_DICT = {
+    'Actor': 'name',
+    'Backdoor': 'name',
+    'Campaign': 'name',
+    'Certificate': 'md5',
+    'Comment': 'object_id',
+    'Domain': 'domain',
+    'Email': 'date',
+    'Event': 'title',
+    'Exploit': 'name',
+    'Indicator': 'value',
+    'IP': 'ip',
+    'PCAP': 'md5',
+    'RawData': 'title',
+    'Sample': 'md5',
+    'Target': 'email_address'
+}
+
+# Fields loaded for each node, the ones a class does not have are skipped.
+NODE_FIELDS = ('id', 'status', 'relationships', 'campaign', 'version')
+
+# Most objects a graph will hold.
+MAX_NODES = 1000
+
+def _fetch_objects(query_by_type, sources, limit):
+    """
+    Fetch the objects of a traversal level with one query per TLO type.
+
+    :param query_by_type: Query for each TLO type.
+    :type query_by_type: dict
+    :param sources: The sources the user can see.
+    :type sources: list
+    :param limit: Most objects to fetch.
+    :type limit: int
+    :returns: list of objects, with only the fields the graph needs.
+    """
+
+    objs = []
+    for obj_type, query in query_by_type.iteritems():
+        klass = class_from_type(obj_type)
+        if not klass or limit - len(objs) <= 0:
+            continue
+        query = dict(query)
+        if hasattr(klass, 'source'):
+            query['source__name__in'] = sources
+        fields = [f for f in NODE_FIELDS + (FIELD_DICT.get(obj_type),)
+                  if f in klass._fields]
+        objs.extend(klass.objects(**query).only(*fields)
+                                          .limit(limit - len(objs)))
+    return objs
+
+def collect_objects(obj_type, obj_id, sources, depth, max_nodes=MAX_NODES):
+    """
+    Collect the objects within depth relationships of an object.
+
+    The graph is walked breadth first. Each level is fetched with one $in
+    query per TLO type, and everything tagged with a Campaign in the level
+    is added to the next one, again with one query per TLO type.
+
+    :param obj_type: The type of the starting object.
+    :type obj_type: str
+    :param obj_id: The ObjectId of the starting object.
+    :type obj_id: str
+    :param sources: The sources the user can see.
+    :type sources: list
+    :param depth: How many relationships to follow.
+    :type depth: int
+    :param max_nodes: Stop once this many objects are collected.
+    :type max_nodes: int
+    :returns: tuple (dict of ObjectId to object, True if max_nodes was hit)
+    """
+
     objects = {}
+    queued = set([obj_id])
+    level = []
+    if ObjectId.is_valid(obj_id):
+        level = _fetch_objects({obj_type: {'id': obj_id}}, sources, max_nodes)
+
+    while level:
+        for obj in level:
+            objects[str(obj.id)] = obj
+        if len(objects) >= max_nodes or depth == 0:
+            break
+        depth -= 1
+
+        ids_by_type = {}
+        campaigns = []
+        for obj in level:
+            for r in obj.relationships:
+                rid = str(r.object_id)
+                if rid not in queued and ObjectId.is_valid(rid):
+                    queued.add(rid)
+                    ids_by_type.setdefault(r.rel_type, []).append(rid)
+            if obj._meta['crits_type'] == 'Campaign':
+                campaigns.append(obj.name)
+
+        limit = max_nodes - len(objects)
+        level = _fetch_objects(dict((t, {'id__in': ids})
+                                    for t, ids in ids_by_type.iteritems()),
+                               sources, limit)
+
+        # If we traverse into a Campaign object, walk everything tagged
+        # with that campaign along with related objects.
+        if campaigns:
+            # Not every object in FIELD_DICT can be tagged with a campaign.
+            # For example, comments.
+            tagged = [t for t in FIELD_DICT
+                      if hasattr(class_from_type(t), 'campaign')]
+            query = {'campaign__name__in': campaigns}
+            for tobj in _fetch_objects(dict((t, query) for t in tagged),
+                                       sources, limit - len(level)):
+                tid = str(tobj.id)
+                if tid not in queued:
+                    queued.add(tid)
+                    level.append(tobj)
+
+    return objects, len(objects) >= max_nodes
+
+def gather_relationships(obj_type, obj_id, user, depth, types,
+                         max_nodes=MAX_NODES):
     nodes = []
     links = []
     # These would be used if we move to force labels
@@ -19,25 +142,7 @@ def gather_relationships(obj_type, obj_id, user, depth, types):
 
     sources = user_sources(user)
     if not sources:
-        return { 'nodes': nodes, 'links': links }
-
-    field_dict = {
-        'Actor': 'name',
-        'Backdoor': 'name',
-        'Campaign': 'name',
-        'Certificate': 'md5',
-        'Comment': 'object_id',
-        'Domain': 'domain',
-        'Email': 'date',
-        'Event': 'title',
-        'Exploit': 'name',
-        'Indicator': 'value',
-        'IP': 'ip',
-        'PCAP': 'md5',
-        'RawData': 'title',
-        'Sample': 'md5',
-        'Target': 'email_address'
-    }
+        return { 'nodes': nodes, 'links': links, 'truncated': False }
 
     # Define the styles for each of the data types. Absent these, the vis.js library will
     # auto-select sensible defaults
@@ -156,55 +261,20 @@ def gather_relationships(obj_type, obj_id, user, depth, types):
         }
     }
 
-    def inner_collect(obj_type, obj_id, sources, depth):
-        # Don't keep going if we've already processed this object
-        if obj_id in objects:
-            return
-
-        klass = class_from_type(obj_type)
-        if not klass:
-            return
-
-        if hasattr(klass, 'source'):
-            obj = klass.objects(id=obj_id, source__name__in=sources).first()
-        else:
-            obj = klass.objects(id=obj_id).first()
-        if not obj:
-            return
-
-        objects[obj_id] = obj
-
-        if depth == 0:
-            return
-
-        depth -= 1
-        for r in obj.relationships:
-            inner_collect(r.rel_type, str(r.object_id), sources, depth)
-
-        # If we traverse into a Campaign object, walk everything tagged
-        # with that campaign along with related objects.
-        if obj_type == 'Campaign':
-            for c in field_dict.keys():
-                klass = class_from_type(c)
-                # Not every object in field_dict can be tagged with a campaign.
-                # For example, comments.
-                if not hasattr(klass, 'campaign'):
-                    continue
-                tagged_objs = klass.objects(campaign__name=obj.name)
-                for tobj in tagged_objs:
-                    inner_collect(tobj._meta['crits_type'],
-                                  str(tobj.id),
-                                  sources,
-                                  depth)
-        # END OF INNER COLLECT
-
     try:
         depth = int(depth)
     except ValueError:
         depth = 3
 
+    # The same graph is kept for everyone who can see the same sources.
+    key = (obj_type, str(obj_id), depth, tuple(sorted(types)),
+           tuple(sorted(sources)), max_nodes)
+    graph = snapshots.get_snapshot(key)
+    if graph is not None:
+        return graph
 
-    inner_collect(obj_type, str(obj_id), sources, depth)
+    (objects, truncated) = collect_objects(obj_type, str(obj_id), sources,
+                                           depth, max_nodes)
 
     # This dictionary is used to describe the position of each object
     # in the nodes list. The key is an object ID and the value is a
@@ -235,7 +305,7 @@ def gather_relationships(obj_type, obj_id, user, depth, types):
             continue
 
         obj_type = obj._meta['crits_type']
-        value = getattr(obj, field_dict[obj_type], '')
+        value = getattr(obj, FIELD_DICT[obj_type], '')
         if obj_type == 'Backdoor':
             # Append a version or family
             if obj.version == '':
@@ -333,12 +403,25 @@ def gather_relationships(obj_type, obj_id, user, depth, types):
         #         'weight': 1,
         #}
         #labelAnchorLinks.append(alink)
-    return {
-            'nodes': nodes,
-            'links': links,
-            #'labelAnchors': labelAnchors,
-            #'labelAnchorLinks': labelAnchorLinks,
-           }
+    graph = {
+             'nodes': nodes,
+             'links': links,
+             'truncated': truncated,
+             #'labelAnchors': labelAnchors,
+             #'labelAnchorLinks': labelAnchorLinks,
+            }
+
+    # Drop the graph when any object in it, or tagged with one of its
+    # campaigns, is saved.
+    ids = set(objects.keys())
+    ids.update(n['id'] for n in nodes)
+    ids.update(snapshots.campaign_key(obj.name)
+               for obj in objects.itervalues()
+               if obj._meta['crits_type'] == 'Campaign')
+    # Campaign nodes show counts of all objects tagged with the campaign.
+    ids.update(snapshots.campaign_key(name) for name in campaign_cache)
+    snapshots.put_snapshot(key, graph, ids)
+    return graph
 
 def add_campaign_from_nodes(name, confidence, nodes, user):
     result = { "success": False }
@@ -0,0 +1,146 @@
+"""
+Per process cache of relationship graphs.
+
+Each snapshot is kept for SNAPSHOT_TIMEOUT seconds. A snapshot is dropped
+early when one of its objects is saved, or when an object tagged with one
+of its campaigns is saved, which covers the counts shown on campaign nodes.
+Saves are seen through mongoengine's post_save signal, which needs the
+blinker library. Without blinker, or for saves made by another process,
+snapshots only expire on the timeout. So do campaign counts when an object
+outside the graph has a campaign removed, as it is no longer tagged with it
+when saved.
+"""
+
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from mongoengine import signals
+
+logger = logging.getLogger(__name__)
+
+# Seconds to keep a graph.
+SNAPSHOT_TIMEOUT = 300
+
+# Most graphs to keep, the oldest are dropped first.
+MAX_SNAPSHOTS = 200
+
+_lock = threading.Lock()
+# key -> (expiry time, graph, object ids and campaign keys)
+_snapshots = OrderedDict()
+# object id or campaign key -> set of snapshot keys
+_index = {}
+_stats = {'hits': 0, 'misses': 0, 'invalidated': 0}
+
+
+def campaign_key(name):
+    return 'campaign:%s' % name
+
+
+def _drop(key):
+    entry = _snapshots.pop(key, None)
+    if not entry:
+        return
+    for id_ in entry[2]:
+        keys = _index.get(id_)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del _index[id_]
+
+
+def get_snapshot(key):
+    """
+    Get a cached graph.
+
+    :param key: The graph's key.
+    :type key: tuple
+    :returns: dict, or None if there is no current snapshot.
+    """
+
+    with _lock:
+        entry = _snapshots.get(key)
+        if entry and entry[0] > time.time():
+            _stats['hits'] += 1
+            graph = entry[1]
+        else:
+            _drop(key)
+            _stats['misses'] += 1
+            graph = None
+        logger.debug("Relationship graph cache %s (hits: %d, misses: %d, "
+                     "invalidated: %d, cached: %d)" %
+                     ('hit' if graph is not None else 'miss',
+                      _stats['hits'], _stats['misses'], _stats['invalidated'],
+                      len(_snapshots)))
+    # Callers are free to change what they get back.
+    return copy.deepcopy(graph)
+
+
+def put_snapshot(key, graph, ids):
+    """
+    Cache a graph.
+
+    :param key: The graph's key.
+    :type key: tuple
+    :param graph: The graph.
+    :type graph: dict
+    :param ids: ObjectIds of the objects in the graph, and campaign_key() of
+                each campaign whose tagged objects are in it.
+    :type ids: iterable of str
+    """
+
+    ids = frozenset(ids)
+    graph = copy.deepcopy(graph)
+    with _lock:
+        _drop(key)
+        _snapshots[key] = (time.time() + SNAPSHOT_TIMEOUT, graph, ids)
+        for id_ in ids:
+            _index.setdefault(id_, set()).add(key)
+        while len(_snapshots) > MAX_SNAPSHOTS:
+            _drop(next(iter(_snapshots)))
+
+
+def invalidate(ids):
+    """
+    Drop every graph holding any of these objects or campaign keys.
+
+    :param ids: ObjectIds or campaign_key() values.
+    :type ids: iterable of str
+    """
+
+    with _lock:
+        for id_ in ids:
+            for key in list(_index.get(id_, ())):
+                _drop(key)
+                _stats['invalidated'] += 1
+
+
+def snapshot_stats():
+    """
+    Get the cache counters for this process.
+
+    :returns: dict with hits, misses, invalidated and cached counts.
+    """
+
+    with _lock:
+        stats = dict(_stats)
+        stats['cached'] = len(_snapshots)
+    return stats
+
+
+def _document_saved(sender, document, **kwargs):
+    # Also used for deletes. New objects can not be in a graph yet, unless
+    # they are tagged with a campaign which is.
+    if not hasattr(document, 'relationships'):
+        return
+    ids = [str(document.id)]
+    for campaign in getattr(document, 'campaign', None) or []:
+        ids.append(campaign_key(campaign.name))
+    invalidate(ids)
+
+
+if signals.signals_available:
+    signals.post_save.connect(_document_saved)
+    signals.post_delete.connect(_document_saved)
@@ -1,10 +1,12 @@
 import json
 
+from django.conf import settings
 from django.contrib.auth.decorators import user_passes_test
 from django.shortcuts import HttpResponse
 
 from crits.core.user_tools import user_can_view_data
 from . import handlers
+from . import snapshots
 
 @user_passes_test(user_can_view_data)
 def get_relationships(request, ctype, cid):
@@ -18,6 +20,9 @@ def get_relationships(request, ctype, cid):
                                                       depth,
                                                       types)
     result['success'] = True
+    if settings.DEBUG:
+        # How well this process' graph cache is doing.
+        result['cache'] = snapshots.snapshot_stats()
 
     return HttpResponse(json.dumps(result), content_type="application/json")
 
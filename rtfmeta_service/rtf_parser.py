@@ -84,6 +84,23 @@ class RtfParser(object):
     whitespace_range = (0x20, 0x0a, 0x0d, 0x07)
     number_range = range(0x30, 0x39)
 
+    # Bytes counted as ascii by binary_percent, deleted with translate()
+    # to count the rest.
+    ascii_range_bytes = bytes(bytearray(range(8, 127)))
+
+    brace_regex = re.compile(br'[{}]')
+
+    # Everything normalize_data_stream removes or replaces, in the order it
+    # checks for them. A backslash or brace matching none of the others is
+    # invalid.
+    normalize_regex = re.compile(
+        br'[\x20\x0a\x0d\x07\x00]+'
+        br'|\\[{}]'
+        br'|\\dde(?:00){0,125}'
+        br'|\\([0-9A-Fa-f]{2})'
+        br'|\{[^}]*\}'
+        br'|[\\{]')
+
     def __init__(self, data, debug=False):
         if type(data) == str:
             self.data = bytearray(data)
@@ -119,23 +136,25 @@ class RtfParser(object):
         return self.data.startswith(b'{\\rt')
         
     def unique_list(self, input_list):
-        """Return unique values from input_list"""
+        """Return unique values from input_list, in the order they are
+        first seen"""
+        seen = set()
         output_list = []
-        [output_list.append(i) for i in input_list if i not in output_list]
+        for i in input_list:
+            # bytearrays are not hashable, compare them by value.
+            key = bytes(i) if isinstance(i, bytearray) else i
+            if key not in seen:
+                seen.add(key)
+                output_list.append(i)
         return output_list
 
     def binary_percent(self):
         """Calculates the percentage of bytes that are binary vs ascii"""
-        ascii_bytes = 0
-        binary_bytes = 0
-        for i in range(0,self.features.get('data_len')):
-            if self.data[i] > 7 and self.data[i] < 127:
-                ascii_bytes += 1
-            else:
-                binary_bytes += 1
+        data_len = self.features.get('data_len')
+        binary_bytes = len(bytes(self.data).translate(None, self.ascii_range_bytes))
+        ascii_bytes = data_len - binary_bytes
         self.features['binary_bytes'] = binary_bytes
         self.features['ascii_bytes'] = ascii_bytes
-        data_len = self.features.get('data_len')
         self.features['binary_ratio'] = (ascii_bytes * 1.0) / data_len
             
     def parse_header(self):
@@ -221,25 +240,22 @@ class RtfParser(object):
         content associated with a specific tag."""
         if b'{' not in arg:
             return
-        chars = []
+        # Everything between the brace opening the first group and the
+        # brace closing it, only the braces need to be looked at.
         n = 0
-        for c in arg:
-            if c == 0x7b:
-                if n > 0:
-                    chars.append(c)
+        for m in self.brace_regex.finditer(arg):
+            if m.group() == b'{':
                 n += 1
-            elif c == 0x7d:
+                if n == 1:
+                    start = m.end()
+            else:
                 n -= 1
-                if n > 0:
-                    chars.append(c)
-                elif n == 0:
+                if n == 0:
+                    chars = bytearray(arg[start:m.start()])
                     if strip:
-                        return bytearray(chars).strip()
+                        return chars.strip()
                     else:
-                        return bytearray(chars)
-                    chars = []
-            elif n > 0:
-                chars.append(c)
+                        return chars
 
     def parse_time(self, data):
         match = self.time_regex.match(data)
@@ -288,50 +304,22 @@ class RtfParser(object):
         self.features.update({'info': info})
 
     def normalize_data_stream(self, data):
-        x = 0
-        out = bytearray()
-        while x < len(data):
-            if data[x] in self.whitespace_range:
-                 x += 1
-                 continue
-            if data[x] == 0:
-                x += 1
-                continue
-            if data[x] == ord('\\'):
-                if data[x+1] in (ord('{'), ord('}')):
-                    x += 2
-                    continue
-                if data[x + 1: x + 4] == b'dde':
-                    x += 4
-                    y = 0
-                    while y < 250 and data[x:x+2] == b'00':
-                        x += 2
-                        y += 2
-                    continue
-                if data[x + 1: x + 2] == b'li':
-                    while data[x + 3] in self.number_range:
-                        x += 1
-                    x += 3
-                    continue
-                if data[x+1] == ord('x'):
-                    x + 1
-                    # do not continue here, process as binascii
-                if data[x + 1] in self.binascii_range:
-                    if data[x + 2] in self.binascii_range:
-                        out_byte = \
-                            binascii.unhexlify(data[x + 1:x + 3])
-                        if ord(out_byte) not in self.whitespace_range:
-                            out += bytearray(out_byte)
-                        x += 3
-                    continue
-            elif data[x] == ord('{'):
-                while data[x] != ord('}'):
-                    x += 1
-                x += 1
-            else:
-                out += data[x:x + 1]
-                x += 1
-        return out
+        """Removes whitespace, NULs, escaped braces, \\dde padding and
+        {} groups from a hex data stream, and decodes \\HH escapes.
+        Raises ValueError on a backslash or brace which can not be
+        normalized."""
+        return bytearray(self.normalize_regex.sub(self._normalize_match,
+                                                  data))
+
+    def _normalize_match(self, m):
+        if m.group(1) is not None:
+            out_byte = binascii.unhexlify(m.group(1))
+            if ord(out_byte) in self.whitespace_range:
+                return b''
+            return out_byte
+        if m.group() in (b'\\', b'{'):
+            raise ValueError('Invalid data stream at offset %d' % m.start())
+        return b''
 
     def read_length_prefixed_string(self, data):
         if len(data) < 4:
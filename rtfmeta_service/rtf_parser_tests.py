@@ -117,6 +117,16 @@ class RtfParserTests(unittest.TestCase):
             out = r.normalize_data_stream(d[0])
             self.assertEqual(out, d[1])
 
+    def test_NormalizeDataInvalid(self):
+        data = [
+            bytearray(b'0102\\*0304'),
+            bytearray(b'0102\\'),
+            bytearray(b'0102{0304'),
+        ]
+        r = RtfParser('{\\rtf1}')
+        for d in data:
+            self.assertRaises(ValueError, r.normalize_data_stream, d)
+
     def test_InfoParse(self):
         data = bytearray(
             b'asdfasfsadfsadfdsaf{\\info{\\author ivan  }\n{\\operator ivan}' +
@@ -399,7 +409,9 @@ class RtfParserTests(unittest.TestCase):
     def testUniqueList(self):
         tests = [
             ([1,2,2,3,4], [1,2,3,4]),
-            (['a', 'a', 'a', 'a'], ['a'])
+            (['a', 'a', 'a', 'a'], ['a']),
+            ([bytearray(b'rsid1'), bytearray(b'rsid2'), bytearray(b'rsid1')],
+             [bytearray(b'rsid1'), bytearray(b'rsid2')]),
         ]
         for t in tests:
             r = RtfParser('{\\rtf1}')
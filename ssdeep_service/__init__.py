@@ -7,9 +7,13 @@ from crits.samples.sample import Sample
 from crits.services.core import Service
 
 from . import forms
+from . import ssdeep_index
 
 logger = logging.getLogger(__name__)
 
+# Index new samples as they are saved, not only when the service runs.
+ssdeep_index.watch_field('ssdeep', 'ssdeep')
+
 class SSDeepService(Service):
     """
     Compare sample to others with ssdeep.
@@ -55,6 +59,39 @@ class SSDeepService(Service):
             logger.error = "Could not get the target ssdeep value for sample"
             self._error("Could not get the target ssdeep value for sample")
             return
+        if ssdeep_index.has_index('ssdeep'):
+            candidates = ssdeep_index.find_candidates('ssdeep', target_ssdeep)
+        else:
+            self._info("ssdeep index has not been built, comparing against "
+                       "all samples. Run the ssdeep_index script to build it.")
+            candidates = self._scan_candidates(target_ssdeep, target_mimetype)
+        # Keep the index current with every sample the service runs on.
+        ssdeep_index.index_hash('ssdeep', target_md5, target_ssdeep)
+
+        scores = {}
+        for md5, ssdeep in candidates:
+            if md5 == target_md5:
+                continue
+            score = pydeep.compare(target_ssdeep, ssdeep)
+            if score >= threshold:
+                scores[md5] = score
+
+        # Only fetch the samples that matched, using the mimetype as a
+        # comparator if available.
+        match_list = []
+        if scores:
+            query_filter = {'md5': {'$in': scores.keys()}}
+            if target_mimetype:
+                query_filter['mimetype'] = target_mimetype
+            for sample in Sample.objects(__raw__=query_filter).only('md5', 'description'):
+                match_list.append({'md5': sample.md5, 'description': sample.description, 'score': scores[sample.md5]})
+        # finally sort the results
+        match_list.sort(key=lambda sample: sample["score"], reverse=True)
+        for match in match_list:
+            self._add_result("ssdeep_match (MD5)", match["md5"], {'description': match["description"], 'score': match["score"]})
+
+    @staticmethod
+    def _scan_candidates(target_ssdeep, target_mimetype):
         # setup the sample space to compare against
         # first use the mimetype as a comparator if available
         query_filter = {}
@@ -63,18 +100,8 @@ class SSDeepService(Service):
         # then use only samples with a multiple of chunksize
         chunk_size = int(target_ssdeep.split(":")[0])
         query_filter["$or"] = []
-        query_filter["$or"].append({"ssdeep": {"$regex": "^%d:" % chunk_size * 2}})
+        query_filter["$or"].append({"ssdeep": {"$regex": "^%d:" % (chunk_size * 2)}})
         query_filter["$or"].append({"ssdeep": {"$regex": "^%d:" % chunk_size}})
         query_filter["$or"].append({"ssdeep": {"$regex": "^%d:" % (chunk_size / 2)}})
-        result_filter = {'md5': 1, 'ssdeep': 1, 'description':1}
-        candidate_space = Sample.objects(__raw__=query_filter).only(*result_filter)
-        match_list = []
-        for candidate in candidate_space:
-            if "ssdeep" in candidate:
-                score = pydeep.compare(target_ssdeep, candidate["ssdeep"])
-                if score >= threshold and candidate["md5"] != target_md5:
-                    match_list.append({'md5': candidate["md5"], 'description': candidate["description"], 'score': score})
-        # finally sort the results
-        match_list.sort(key=lambda sample: sample["score"], reverse=True)
-        for match in match_list:
-            self._add_result("ssdeep_match (MD5)", match["md5"], {'description': match["description"], 'score': match["score"]})
+        candidate_space = Sample.objects(__raw__=query_filter).only('md5', 'ssdeep')
+        return [(c.md5, c.ssdeep) for c in candidate_space if c.ssdeep]
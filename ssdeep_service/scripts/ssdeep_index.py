@@ -0,0 +1,32 @@
+"""
+Build the ssdeep candidate index for existing Samples.
+
+The service only uses the index once this has run without a filter. Re-run
+it to pick up new Samples if blinker is not installed, see the README.
+
+Example Usage:
+    python ssdeep_index.py -f "{'source.name': 'foo'}"
+"""
+
+import ast
+from optparse import OptionParser
+
+from crits.core.basescript import CRITsBaseScript
+from ssdeep_service.ssdeep_index import backfill
+
+class CRITsScript(CRITsBaseScript):
+    def __init__(self, username=None):
+        self.username = username
+
+    def run(self, argv):
+        parser = OptionParser()
+        parser.add_option("-f", "--filter", action="store", dest="filter",
+                type="string", help="Sample filter, only index matching samples")
+        (opts, args) = parser.parse_args(argv)
+
+        if opts.filter:
+            query = ast.literal_eval(opts.filter)
+        else:
+            query = {}
+        count = backfill('ssdeep', 'ssdeep', query)
+        print "[+] Indexed %d samples" % count
@@ -0,0 +1,284 @@
+"""
+Candidate index for fuzzy hash (ssdeep style) similarity lookups.
+
+Two ssdeep hashes can only score above zero when they have compatible block
+sizes and share at least one 7 character substring in a chunk of the same
+block size. For every hash we store the set of those 7-grams, prefixed with
+the block size they belong to, so a lookup only has to compare against hashes
+sharing a key instead of every Sample.
+
+The index is shared by the services comparing ssdeep style hashes, each
+storing its hashes under its own hash_type. An index is only used once
+backfill() has indexed every existing Sample. After that, Samples are
+indexed as they are saved, when mongoengine signals are available, and when
+a service runs on them.
+"""
+
+import datetime
+import logging
+import re
+
+from mongoengine import Document, StringField, IntField, ListField
+from mongoengine import DateTimeField, signals
+
+from crits.samples.sample import Sample
+
+logger = logging.getLogger(__name__)
+
+NGRAM_SIZE = 7
+
+# ssdeep reduces runs of more than three identical characters before
+# comparing, so the keys have to be built from the reduced chunks.
+_repeats = re.compile(r'(.)\1{3,}')
+
+
+class FuzzyHashIndex(Document):
+    """Fuzzy hash n-gram index Document Object"""
+    meta = {
+        "allow_inheritance": False,
+        "collection": 'fuzzy_hash_index',
+        "indexes": [
+            {'fields': ['hash_type', 'md5'], 'unique': True},
+            {'fields': ['hash_type', 'grams']},
+        ],
+    }
+
+    hash_type = StringField(required=True)
+    md5 = StringField(required=True)
+    value = StringField(required=True)
+    block_size = IntField()
+    grams = ListField(StringField())
+
+
+class FuzzyHashIndexStatus(Document):
+    """Fuzzy hash index backfill marker Document Object"""
+    meta = {
+        "allow_inheritance": False,
+        "collection": 'fuzzy_hash_index.status',
+        "indexes": [
+            {'fields': ['hash_type'], 'unique': True},
+        ],
+    }
+
+    hash_type = StringField(required=True)
+    backfilled = DateTimeField()
+
+
+def parse_hash(value):
+    """
+    Split a fuzzy hash into its block size and two chunks.
+
+    :param value: The fuzzy hash.
+    :type value: str
+    :returns: tuple (block_size, chunk, double_chunk), or None if invalid.
+    """
+
+    try:
+        block_size, chunk, double_chunk = value.split(':', 2)
+        return int(block_size), chunk, double_chunk
+    except (AttributeError, ValueError):
+        return None
+
+
+def ngram_keys(value):
+    """
+    Generate the index keys for a fuzzy hash.
+
+    Keys are "<block size>:<7-gram>" for the first chunk at the block size
+    and the second chunk at double the block size. Chunks too short to have
+    a 7-gram are used whole so identical hashes still find each other.
+
+    :param value: The fuzzy hash.
+    :type value: str
+    :returns: list of str
+    """
+
+    parsed = parse_hash(value)
+    if not parsed:
+        return []
+    block_size, chunk, double_chunk = parsed
+    keys = set()
+    for size, data in ((block_size, chunk), (block_size * 2, double_chunk)):
+        data = _repeats.sub(r'\1\1\1', data)
+        if len(data) < NGRAM_SIZE:
+            if data:
+                keys.add("%d:%s" % (size, data))
+            continue
+        for i in xrange(len(data) - NGRAM_SIZE + 1):
+            keys.add("%d:%s" % (size, data[i:i + NGRAM_SIZE]))
+    return sorted(keys)
+
+
+def has_index(hash_type):
+    """
+    Check if backfill() has indexed all Samples for a type of hash. Until
+    then the index may be missing Samples, so lookups should not use it.
+
+    :param hash_type: The type of hash.
+    :type hash_type: str
+    :returns: bool
+    """
+
+    return FuzzyHashIndexStatus.objects(hash_type=hash_type).first() is not None
+
+
+def index_hash(hash_type, md5, value):
+    """
+    Add or update the index entry for a Sample.
+
+    :param hash_type: The type of hash.
+    :type hash_type: str
+    :param md5: The MD5 of the Sample.
+    :type md5: str
+    :param value: The fuzzy hash of the Sample.
+    :type value: str
+    :returns: bool, False if the hash could not be parsed.
+    """
+
+    parsed = parse_hash(value)
+    if not parsed:
+        return False
+    FuzzyHashIndex.objects(hash_type=hash_type,
+                           md5=md5).update_one(upsert=True,
+                                               set__value=value,
+                                               set__block_size=parsed[0],
+                                               set__grams=ngram_keys(value))
+    return True
+
+
+def find_candidates(hash_type, value):
+    """
+    Find indexed hashes that share a key with a fuzzy hash.
+
+    :param hash_type: The type of hash.
+    :type hash_type: str
+    :param value: The fuzzy hash to look up.
+    :type value: str
+    :returns: list of (md5, value) tuples.
+    """
+
+    keys = ngram_keys(value)
+    if not keys:
+        return []
+    entries = FuzzyHashIndex.objects(hash_type=hash_type,
+                                     grams__in=keys).only('md5', 'value')
+    return [(entry.md5, entry.value) for entry in entries]
+
+
+def backfill(hash_type, field, query=None, compute=None):
+    """
+    Index the hashes of all Samples which have one.
+
+    Without a query the index is then marked as built, so lookups start
+    using it.
+
+    :param hash_type: The type of hash.
+    :type hash_type: str
+    :param field: The Sample field holding the hash.
+    :type field: str
+    :param query: Optional extra filter for the Samples to index.
+    :type query: dict
+    :param compute: Optional function called with each Sample missing the
+                    hash, with its md5 and filedata loaded. It returns the
+                    hash, or None if there is none.
+    :type compute: callable
+    :returns: int, number of Samples indexed.
+    """
+
+    query = dict(query or {})
+    # Only a run over every Sample completes the index.
+    started = None if query else datetime.datetime.now()
+    count = 0
+    present = dict(query)
+    present[field] = {'$nin': [None, '']}
+    for sample in Sample.objects(__raw__=present).only('md5', field):
+        if index_hash(hash_type, sample.md5, sample[field]):
+            count += 1
+    if compute:
+        query[field] = {'$in': [None, '']}
+        for sample in Sample.objects(__raw__=query).only('md5', 'filedata'):
+            value = compute(sample)
+            if value and index_hash(hash_type, sample.md5, value):
+                count += 1
+    if started:
+        FuzzyHashIndexStatus.objects(hash_type=hash_type).update_one(
+            upsert=True, set__backfilled=started)
+    return count
+
+
+# hash_type -> Sample field, for the hashes indexed when a Sample is saved.
+_watched = {}
+
+
+def watch_field(hash_type, field):
+    """
+    Index a Sample field whenever a Sample is saved.
+
+    This needs the blinker library for mongoengine signals. Without it,
+    new Samples are only indexed when a service runs on them, and backfill()
+    has to be run again to pick up the rest.
+
+    :param hash_type: The type of hash.
+    :type hash_type: str
+    :param field: The Sample field holding the hash.
+    :type field: str
+    """
+
+    if not _watched and signals.signals_available:
+        signals.post_save.connect(_sample_saved, sender=Sample)
+    _watched[hash_type] = field
+
+
+def _sample_saved(sender, document, **kwargs):
+    for hash_type, field in _watched.items():
+        try:
+            value = document[field]
+        except KeyError:
+            continue
+        if not value:
+            continue
+        try:
+            index_hash(hash_type, document.md5, value)
+        except Exception:
+            logger.exception("Could not index %s of sample %s" %
+                             (hash_type, document.md5))
+
+
+def iter_similar_pairs(hash_type, compare, threshold):
+    """
+    Find all pairs of indexed hashes scoring at or above a threshold.
+
+    The postings for every key are built in memory once, so each hash is
+    only compared against the hashes it shares a key with and each pair is
+    compared once.
+
+    :param hash_type: The type of hash.
+    :type hash_type: str
+    :param compare: Function returning the similarity score of two hashes.
+    :type compare: callable
+    :param threshold: Minimum score for a pair.
+    :type threshold: int
+    :returns: generator of (md5, md5, score) tuples.
+    """
+
+    entries = []
+    postings = {}
+    for entry in FuzzyHashIndex.objects(hash_type=hash_type).only('md5',
+                                                                 'value',
+                                                                 'grams'):
+        i = len(entries)
+        entries.append((entry.md5, entry.value, entry.grams))
+        for key in entry.grams:
+            postings.setdefault(key, []).append(i)
+
+    for i, (md5, value, grams) in enumerate(entries):
+        candidates = set()
+        for key in grams:
+            candidates.update(j for j in postings[key] if j > i)
+        for j in sorted(candidates):
+            other_md5, other_value = entries[j][:2]
+            if other_md5 == md5:
+                continue
+            score = compare(value, other_value)
+            if score >= threshold:
+                yield md5, other_md5, score
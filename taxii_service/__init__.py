@@ -18,7 +18,7 @@ class TAXIIClient(Service):
     """
 
     name = "taxii_service"
-    version = "2.2.0"
+    version = "2.4.0"
     supported_types = []
     required_fields = ['_id']
     description = "Communicate with TAXII servers and process STIX data."
@@ -29,6 +29,10 @@ class TAXIIClient(Service):
         namespace = config.get("namespace", "").strip()
         ns_prefix = config.get("ns_prefix", "").strip()
         max_rels = config.get("max_rels", "")
+        poll_threads = config.get("poll_threads", "")
+        poll_server_threads = config.get("poll_server_threads", "")
+        poll_timeout = config.get("poll_timeout", "")
+        import_batch = config.get("import_batch", "")
         errors = []
         if not namespace:
             errors.append("You must specify a XML Namespace.")
@@ -36,6 +40,15 @@ class TAXIIClient(Service):
             errors.append("You must specify a XML Namespace Prefix.")
         if not max_rels or max_rels > 5000 or max_rels < 0:
             errors.append("Maximum Related must be in the range 0-5000.")
+        if not poll_threads or poll_threads > 50 or poll_threads < 1:
+            errors.append("Parallel Polls must be in the range 1-50.")
+        if (not poll_server_threads or poll_server_threads > 50 or
+            poll_server_threads < 1):
+            errors.append("Parallel Polls per Server must be in the range 1-50.")
+        if poll_timeout is None or poll_timeout < 0:
+            errors.append("Poll Timeout must be 0 or more.")
+        if import_batch is None or import_batch < 0:
+            errors.append("Import Batch Size must be 0 or more.")
         if errors:
             raise ServiceConfigError("<br>".join(errors))
 
@@ -109,7 +122,7 @@ class TAXIIClient(Service):
             if name == 'taxii_servers':
                 display_config[field.label] = ', '.join(config[name])
             else:
-                display_config[field.label] = config[name]
+                display_config[field.label] = config.get(name, field.initial)
 
         return display_config
 
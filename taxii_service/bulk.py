@@ -0,0 +1,143 @@
+import datetime
+
+from mongoengine import signals
+
+from crits.core.crits_mongoengine import EmbeddedRelationship
+from crits.vocabulary.relationships import RelationshipTypes
+
+class RelationshipBatch(object):
+    """
+    Relationships between TLOs, collected in memory and written to the
+    database with bulk updates.
+
+    Relationships are formed the same way as CRITs' add_relationship(), but
+    existing ones are found with an index instead of scanning the TLO's
+    relationship list each time. Each TLO's new relationships are written
+    with a single $push instead of saving the TLO. That skips the TLO's
+    audit entry, and post_save is sent for each updated TLO by hand so
+    listeners such as caches still see the change.
+    """
+
+    def __init__(self, analyst):
+        self.analyst = analyst
+        self.objs = {} # TLO id -> TLO
+        self.existing = {} # TLO id -> {(object_id, relationship, rel_type): rel}
+        self.new = {} # TLO id -> list of relationships to write
+
+    def _index(self, obj):
+        if obj.id not in self.existing:
+            index = {}
+            for r in obj.relationships:
+                index.setdefault((r.object_id, r.relationship, r.rel_type), r)
+            self.objs[obj.id] = obj
+            self.existing[obj.id] = index
+            self.new[obj.id] = []
+        return self.existing[obj.id]
+
+    def _make(self, target, rel_type, date, confidence, like):
+        rel = EmbeddedRelationship()
+        rel.relationship = rel_type
+        rel.rel_type = target._meta['crits_type']
+        rel.object_id = target.id
+        if like: # Repair an unreciprocated relationship
+            rel.analyst = like.analyst
+            rel.date = like.date
+            rel.relationship_date = like.relationship_date
+            rel.rel_confidence = like.rel_confidence
+            rel.rel_reason = like.rel_reason
+        else:
+            rel.analyst = self.analyst
+            rel.date = date
+            rel.rel_confidence = confidence
+            rel.rel_reason = ''
+        return rel
+
+    def add(self, left, right, rel_type, rel_confidence='unknown'):
+        """
+        Relate two TLOs.
+
+        :param left: The TLO the relationship is from.
+        :type left: A CRITs TLO.
+        :param right: The TLO the relationship is to.
+        :type right: A CRITs TLO.
+        :param rel_type: The relationship type.
+        :type rel_type: str
+        :param rel_confidence: The confidence of the relationship.
+        :type rel_confidence: str
+        :returns: True if a relationship was added to either TLO.
+        """
+
+        rev_type = RelationshipTypes.inverse(rel_type)
+        if rev_type is None or left.id == right.id:
+            return False
+
+        mine = self._index(left)
+        theirs = self._index(right)
+        my_key = (right.id, rel_type, right._meta['crits_type'])
+        their_key = (left.id, rev_type, left._meta['crits_type'])
+        my_existing = mine.get(my_key)
+        their_existing = theirs.get(their_key)
+        if my_existing and their_existing:
+            return False
+
+        date = datetime.datetime.now()
+        if not my_existing:
+            rel = self._make(right, rel_type, date, rel_confidence,
+                             their_existing)
+            mine[my_key] = rel
+            left.relationships.append(rel)
+            self.new[left.id].append(rel)
+        if not their_existing:
+            rel = self._make(left, rev_type, date, rel_confidence,
+                             my_existing)
+            theirs[their_key] = rel
+            right.relationships.append(rel)
+            self.new[right.id].append(rel)
+        return True
+
+    def flush(self, batch_size, progress=None):
+        """
+        Write the new relationships to the database.
+
+        :param batch_size: Number of TLOs to update in each bulk write.
+        :type batch_size: int
+        :param progress: Called after each batch with the number of TLOs
+                         updated so far and the total to update.
+        :type progress: function
+        :returns: int, the number of TLOs updated.
+        """
+
+        pending = [obj_id for obj_id in self.new if self.new[obj_id]]
+        total = len(pending)
+        for i in xrange(0, total, batch_size):
+            updates = {}
+            batch = pending[i:i + batch_size]
+            for obj_id in batch:
+                obj = self.objs[obj_id]
+                field = obj._fields['relationships'].db_field
+                rels = [r.to_mongo() for r in self.new[obj_id]]
+                coll = obj._get_collection()
+                updates.setdefault(coll.name, (coll, []))[1].append(
+                    (obj_id, {'$push': {field: {'$each': rels}}}))
+                self.new[obj_id] = []
+            for coll, ops in updates.itervalues():
+                _bulk_update(coll, ops)
+            if signals.signals_available:
+                for obj_id in batch:
+                    obj = self.objs[obj_id]
+                    signals.post_save.send(obj.__class__, document=obj,
+                                           created=False)
+            if progress:
+                progress(min(i + batch_size, total), total)
+        return total
+
+def _bulk_update(coll, ops):
+    if hasattr(coll, 'bulk_write'): # pymongo 3
+        from pymongo import UpdateOne
+        coll.bulk_write([UpdateOne({'_id': id_}, update)
+                         for (id_, update) in ops], ordered=False)
+    else:
+        bulk = coll.initialize_unordered_bulk_op()
+        for (id_, update) in ops:
+            bulk.find({'_id': id_}).update_one(update)
+        bulk.execute()
@@ -180,6 +180,51 @@ class TAXIIServiceConfigForm(forms.Form):
                                             "items, of each type, that can "
                                             "be selected for a TAXII message.")
 
+    poll_threads = forms.IntegerField(required=True,
+                                      label="Parallel Polls",
+                                      initial=4,
+                                      min_value=1,
+                                      max_value=50,
+                                      widget=forms.TextInput(),
+                                      help_text="The maximum number of feeds "
+                                                "to poll at the same time.")
+
+    poll_server_threads = forms.IntegerField(required=True,
+                                             label="Parallel Polls per Server",
+                                             initial=2,
+                                             min_value=1,
+                                             max_value=50,
+                                             widget=forms.TextInput(),
+                                             help_text="The maximum number of "
+                                                       "feeds to poll at the "
+                                                       "same time from one "
+                                                       "TAXII server.")
+
+    poll_timeout = forms.IntegerField(required=True,
+                                      label="Poll Timeout",
+                                      initial=300,
+                                      min_value=0,
+                                      widget=forms.TextInput(),
+                                      help_text="Seconds to wait for a feed "
+                                                "poll before giving up on it. "
+                                                "It keeps running, and "
+                                                "counting against its "
+                                                "server's limit, until it "
+                                                "finishes. 0 to wait forever.")
+
+    import_batch = forms.IntegerField(required=True,
+                                      label="Import Batch Size",
+                                      initial=0,
+                                      min_value=0,
+                                      widget=forms.TextInput(),
+                                      help_text="Number of TLOs whose "
+                                                "relationships are written "
+                                                "at a time when importing "
+                                                "STIX, for example 500. "
+                                                "Batched writes make no "
+                                                "audit log entries. 0 to "
+                                                "save each TLO on its own.")
+
     tserver_attrs = {'size': 10,
                      'style':"height:100px; background-image: none"}
     taxii_servers = forms.ChoiceField(required=False,
@@ -4,10 +4,11 @@ import os
 import pytz
 import re
 import socket
+import threading
 import uuid
 import zipfile
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil.parser import parse
 from dateutil.tz import tzutc
 from io import BytesIO
@@ -44,7 +45,8 @@ from stix.threat_actor import ThreatActor
 from . import taxii
 from . import formats
 from . import forms
-from .parsers import STIXParser, STIXParserException
+from . import poller
+from .parsers import STIXParser, STIXParserException, IMPORT_BATCH
 from .object_mapper import make_cybox_object, UnsupportedCybOXObjectTypeError
 from .object_mapper import get_incident_category
 
@@ -61,11 +63,30 @@ from crits.vocabulary.relationships import RelationshipTypes
 
 logger = logging.getLogger("crits." + __name__)
 
+# Defaults for the feed polling settings in the service config.
+POLL_THREADS = 4
+POLL_SERVER_THREADS = 2
+POLL_TIMEOUT = 300
+
+# Imports from feeds polled at the same time are run one at a time, so two
+# feeds can't both create the same TLO.
+_import_lock = threading.Lock()
+
+_runtime_lock = threading.Lock()
+_last_runtime = [None]
+
 def poll_taxii_feeds(feeds, analyst, begin=None, end=None, import_now=False):
     """
-    Given a list of feeds, individually poll each, save the data to
+    Given a list of feeds, poll them in parallel, save the data to
     the DB, and return a preview for each and status.
 
+    At most "poll_threads" feeds are polled at once, and at most
+    "poll_server_threads" of those from the same TAXII server. A poll
+    that runs longer than "poll_timeout" seconds is reported as failed,
+    but keeps its place in its server's limit until it finishes. With
+    import_now, only the polls run in parallel, the imports are run one
+    at a time.
+
     :param feeds: Feeds to poll represented as [server_name, feed#]
     :type feeds: list
     :param analyst: Userid of the analyst initiating the poll
@@ -84,12 +105,15 @@ def poll_taxii_feeds(feeds, analyst, begin=None, end=None, import_now=False):
     results = {'polls': [], 'status': True}
     success_polls = failed_polls = 0
     poll_details = []
-    sc = get_config('taxii_service').taxii_servers
+    tsvc = get_config('taxii_service')
+    sc = tsvc.taxii_servers
+    timeout = getattr(tsvc, 'poll_timeout', POLL_TIMEOUT) or None
 
     if import_now:
         ret = {
                 'successes': 0,
                 'failures': [],
+                'batches': 0,
                 'Certificate': [],
                 'Domain': [],
                 'Email': [],
@@ -101,6 +125,8 @@ def poll_taxii_feeds(feeds, analyst, begin=None, end=None, import_now=False):
                 'Sample': [],
                }
 
+    jobs = []
+    names = []
     for feed in feeds:
         svrc = sc[feed[0]]
         hostname = svrc['hostname']
@@ -118,10 +144,35 @@ def poll_taxii_feeds(feeds, analyst, begin=None, end=None, import_now=False):
         ecert = feedc.get('fcert')
         ekey = feedc.get('fkey')
 
-        result = execute_taxii_agent(hostname, https, port, path, version,
-                                     feed_name, akey, acert, subID, analyst,
-                                     user, pword, ecert, ekey, begin, end,
-                                     import_now)
+        job = poller.PollJob(feed[0], execute_taxii_agent, hostname, https,
+                             port, path, version, feed_name, akey, acert,
+                             subID, analyst, user, pword, ecert, ekey, begin,
+                             end, import_now, timeout=timeout)
+        jobs.append(job)
+        names.append((hostname, feed_name))
+
+    poller.run_polls(jobs,
+                     getattr(tsvc, 'poll_threads', POLL_THREADS),
+                     getattr(tsvc, 'poll_server_threads', POLL_SERVER_THREADS),
+                     timeout)
+
+    # Results are merged here, once all of the polls are done.
+    for (job, (hostname, feed_name)) in zip(jobs, names):
+        result = job.result
+        if job.timed_out or job.error:
+            if job.timed_out:
+                msg = ("Poll did not finish within %s seconds, it will "
+                       "continue in the background" % timeout)
+            else:
+                msg = "Poll Error: %s" % job.error
+            result = {
+                       'failures': [msg],
+                       'blk_count': 0,
+                       'poll_id': None,
+                       'start': begin or 'None',
+                       'end': end or 'None',
+                       'taxii_msg_id': None,
+                     }
 
         fails = result['failures']
         fails = "<br>".join(cgi.escape(x) for x in fails)
@@ -136,7 +187,7 @@ def poll_taxii_feeds(feeds, analyst, begin=None, end=None, import_now=False):
 
         if 'import' in result:
             for k in ret:
-                if k == 'successes':
+                if k in ('successes', 'batches'):
                     ret[k] += result['import'][k]
                 else:
                     ret[k].extend(result['import'][k])
@@ -148,6 +199,7 @@ def poll_taxii_feeds(feeds, analyst, begin=None, end=None, import_now=False):
                         'blk_count': result['blk_count'],
                         'start': result['start'],
                         'end': result['end'],
+                        'time': '%.1f' % job.wall_time,
                         'success': success,
                         'msg': fails}
         results['polls'].append(poll_details)
@@ -160,12 +212,29 @@ def poll_taxii_feeds(feeds, analyst, begin=None, end=None, import_now=False):
     results['poll_msg'] = msg
     return results
 
+def _poll_runtime():
+    """
+    Get the current time for a poll. Poll IDs are made from this time in
+    milliseconds, so each call returns a time at least a millisecond after
+    the last one, even when feeds are polled at the same time.
+
+    :returns: :class:`datetime.datetime`
+    """
+    with _runtime_lock:
+        runtime = datetime.now(tzutc())
+        runtime = runtime.replace(microsecond=runtime.microsecond // 1000 * 1000)
+        last = _last_runtime[0]
+        if last and runtime <= last:
+            runtime = last + timedelta(milliseconds=1)
+        _last_runtime[0] = runtime
+        return runtime
+
 
 def execute_taxii_agent(hostname=None, https=None, port=None, path=None,
                         version="0", feed=None, akey=None, acert=None,
                         subID=None, analyst=None, user=None, pword=None,
                        ecert=None, ekey=None, start=None, end=None,
-                       import_now=False):
+                       import_now=False, timeout=None):
     """
     Poll a single feed using the provided parameters, if import_now is False,
     write the data to the database, if import_now is True, return the
@@ -205,6 +274,8 @@ def execute_taxii_agent(hostname=None, https=None, port=None, path=None,
     :type end: :class:`datetime.datetime`
     :param import_now: If True, import the data directly into CRITs
     :type import_now: boolean
+    :param timeout: Seconds to wait for the TAXII server to respond
+    :type timeout: int
     :returns: dict with keys:
               "failures" (list) - Failure messages
               "blk_count" (int) - The count of content blocks retrieved
@@ -240,7 +311,7 @@ def execute_taxii_agent(hostname=None, https=None, port=None, path=None,
         start = start.replace(tzinfo=pytz.utc)
 
     # store the current time as the time of this request
-    runtime = datetime.now(tzutc())
+    runtime = _poll_runtime()
 
     # End time is always now, unless specified.
     if not end:
@@ -333,7 +404,8 @@ def execute_taxii_agent(hostname=None, https=None, port=None, path=None,
         try:
             response = client.callTaxiiService2(hostname, path,
                                                 xml_msg_binding,
-                                                poll_msg.to_xml(), port)
+                                                poll_msg.to_xml(), port,
+                                                timeout=timeout)
         except Exception as e:
             if "alert unknown ca" in str(e):
                 ret['failures'].append("Certficate Error - TAXII Server does not "
@@ -400,6 +472,7 @@ def execute_taxii_agent(hostname=None, https=None, port=None, path=None,
         import_result = {
                 'successes': 0,
                 'failures': [],
+                'batches': 0,
                 'Certificate': [],
                 'Domain': [],
                 'Email': [],
@@ -420,10 +493,11 @@ def execute_taxii_agent(hostname=None, https=None, port=None, path=None,
         content.populate(data[0], analyst, mid, hostname, feed, label, start,
                          end, poll_time=runtime, errors=errors)
         if import_now:
-            ic_ret = import_content([content], analyst)
+            with _import_lock:
+                ic_ret = import_content([content], analyst)
             if ic_ret and ic_ret['status']:
                 for k in import_result:
-                    if k == 'successes':
+                    if k in ('successes', 'batches'):
                         import_result[k] += ic_ret[k]
                     else:
                         import_result[k].extend(ic_ret[k])
@@ -519,6 +593,7 @@ def process_stix_upload(filedata, analyst, source, reference, use_hdr_src,
         ret = {
                 'successes': 0,
                 'failures': [],
+                'batches': 0,
                 'Certificate': [],
                 'Domain': [],
                 'Email': [],
@@ -538,7 +613,7 @@ def process_stix_upload(filedata, analyst, source, reference, use_hdr_src,
                                        analyst, import_now, top_name)
                 if result and result['status']:
                     for k in ret:
-                        if k == 'successes':
+                        if k in ('successes', 'batches'):
                             ret[k] += result[k]
                         else:
                             ret[k].extend(result[k])
@@ -928,6 +1003,7 @@ def import_poll(poll_id, analyst, action=None):
               "failures" (list) - Individual failure messages
               "status" (bool) - True if import was generally successful
               "msg" (string) - General error messages
+              "batches" (int) - Count of bulk relationship writes
               "Certificate" (list) - IDs and values of imported Certificates
               "Domain" (list) - IDs and values of imported Domains
                 ...and so on for each TLO type
@@ -937,7 +1013,8 @@ def import_poll(poll_id, analyst, action=None):
             'successes': 0,
             'failures': [],
             'status': False,
-            'msg': ''
+            'msg': '',
+            'batches': 0
           }
     tlos = {
             'Certificate': [],
@@ -959,6 +1036,7 @@ def import_poll(poll_id, analyst, action=None):
     tsvc = get_config('taxii_service')
     hdr_events = tsvc['header_events']
     obs_as_ind = tsvc['obs_as_ind']
+    batch_size = getattr(tsvc, 'import_batch', IMPORT_BATCH)
     tsrvs = tsvc.taxii_servers
     pids = {}
 
@@ -983,9 +1061,15 @@ def import_poll(poll_id, analyst, action=None):
             source = block.hostname
             default_ci = ('unknown', 'unknown')
 
+        def progress(done, total, block_id=block.id):
+            ret['batches'] += 1
+            logger.info("Poll %s, block %s: relationships written for %d of "
+                        "%d TLOs" % (poll_id, block_id, done, total))
+
         objs = import_standards_doc(data, analyst, method, reference,
                                     hdr_events, default_ci, source,
-                                    use_hdr_src, obs_as_ind)
+                                    use_hdr_src, obs_as_ind,
+                                    batch_size=batch_size, progress=progress)
 
         if not objs['success']:
             ret['failures'].append((objs['reason'],
@@ -1044,6 +1128,7 @@ def import_content(content_objs, analyst, action=None):
               "failures" (list) - Individual failure messages
               "status" (bool) - True if import was generally successful
               "msg" (string) - General error messages
+              "batches" (int) - Count of bulk relationship writes
               "Certificate" (list) - IDs and values of imported Certificates
               "Domain" (list) - IDs and values of imported Domains
                 ...and so on for each TLO type
@@ -1053,7 +1138,8 @@ def import_content(content_objs, analyst, action=None):
             'successes': 0,
             'failures': [],
             'status': False,
-            'msg': ''
+            'msg': '',
+            'batches': 0
           }
     tlos = {
             'Certificate': [],
@@ -1079,6 +1165,7 @@ def import_content(content_objs, analyst, action=None):
     tsvc = get_config('taxii_service')
     hdr_events = tsvc['header_events']
     obs_as_ind = tsvc['obs_as_ind']
+    batch_size = getattr(tsvc, 'import_batch', IMPORT_BATCH)
     tsrvs = tsvc.taxii_servers
     pids = {}
 
@@ -1103,9 +1190,15 @@ def import_content(content_objs, analyst, action=None):
             source = block.hostname
             default_ci = ('unknown', 'unknown')
 
+        def progress(done, total, block_id=block.id):
+            ret['batches'] += 1
+            logger.info("Block %s: relationships written for %d of %d TLOs"
+                        % (block_id, done, total))
+
         objs = import_standards_doc(data, analyst, method, reference,
                                     hdr_events, default_ci, source,
-                                    use_hdr_src, obs_as_ind)
+                                    use_hdr_src, obs_as_ind,
+                                    batch_size=batch_size, progress=progress)
 
         if not objs['success']:
             ret['failures'].append((objs['reason'],
@@ -2111,7 +2204,8 @@ def update_taxii_service_config(post_data, analyst):
 
 def import_standards_doc(data, analyst, method, ref=None, hdr_events=False,
                          def_ci=None, source=None, use_hdr_src=False,
-                         obs_as_ind=False, preview_only=False):
+                         obs_as_ind=False, preview_only=False,
+                         batch_size=IMPORT_BATCH, progress=None):
     """
     Import a standards document into CRITs.
 
@@ -2138,6 +2232,12 @@ def import_standards_doc(data, analyst, method, ref=None, hdr_events=False,
     :type obs_as_ind: boolean
     :param preview_only: If True, nothing is imported and a preview is returned
     :type preview_only: boolean
+    :param batch_size: Number of TLOs whose relationships are written in each
+                       bulk update, or 0 to save each TLO on its own
+    :type batch_size: int
+    :param progress: Called after each batch with the number of TLOs updated
+                     so far and the total
+    :type progress: function
     :returns: dict with keys:
               "success" (boolean),
               "reason" (str),
@@ -2153,7 +2253,8 @@ def import_standards_doc(data, analyst, method, ref=None, hdr_events=False,
           }
 
     try:
-        parser = STIXParser(data, analyst, method, def_ci, preview_only)
+        parser = STIXParser(data, analyst, method, def_ci, preview_only,
+                            batch_size, progress)
         parser.parse_stix(ref, hdr_events, source, use_hdr_src, obs_as_ind)
         parser.relate_objects()
     except STIXParserException as e:
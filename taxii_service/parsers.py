@@ -78,6 +78,11 @@ from stix.threat_actor import ThreatActor
 from stix.utils.parser import UnsupportedVersionError
 
 from . import taxii
+from .bulk import RelationshipBatch
+
+# Number of TLOs whose relationships are written in each bulk update. 0
+# saves each TLO on its own, which also records its audit entry.
+IMPORT_BATCH = 0
 
 class STIXParserException(Exception):
     """
@@ -92,7 +97,8 @@ class STIXParser():
     STIX Parser class.
     """
 
-    def __init__(self, data, analyst, method, def_ci=None, preview_only=False):
+    def __init__(self, data, analyst, method, def_ci=None, preview_only=False,
+                 batch_size=IMPORT_BATCH, progress=None):
         """
         Instantiation of the STIXParser can take the data to parse, the analyst
         doing the parsing, and the method of data aquisition.
@@ -107,9 +113,17 @@ class STIXParser():
         :type def_ci: tuple
         :param preview_only: If True, nothing is imported and a preview is returned
         :type preview_only: boolean
+        :param batch_size: Number of TLOs whose relationships are written in
+                           each bulk update. If 0, each TLO is saved on its own.
+        :type batch_size: int
+        :param progress: Called after each batch of relationships is written
+                         with the number of TLOs updated so far and the total.
+        :type progress: function
         """
 
         self.data = data
+        self.batch_size = batch_size
+        self.progress = progress
         self.def_ci = def_ci or (None, None)
         self.obs_as_ind = False
         self.preview = preview_only
@@ -1337,6 +1351,10 @@ class STIXParser():
 
         Objects are related to each other using the relationships listed in
         their related_indicators attribute.
+
+        If batch_size is set, the relationships are collected in memory and
+        written batch_size TLOs at a time with bulk updates, instead of
+        saving each TLO.
         """
 
         if self.preview: # Previews don't include relationships
@@ -1345,6 +1363,17 @@ class STIXParser():
         analyst = self.source_instance.analyst
         valid_rel_types = RelationshipTypes.values()
 
+        if self.batch_size:
+            batch = RelationshipBatch(analyst)
+            def relate(left, right, rel_type, confidence):
+                batch.add(left, right, rel_type, confidence)
+        else:
+            def relate(left, right, rel_type, confidence):
+                left.add_relationship(right,
+                                      rel_type=rel_type,
+                                      rel_confidence=confidence,
+                                      analyst=analyst)
+
         # If package-level Events exists, relate TLOs to them
         if self.pkg_event:
             evt = self.pkg_event
@@ -1359,16 +1388,14 @@ class STIXParser():
                     rel_type = RelationshipTypes.RELATED_TO
                     confidence='Unknown'
                 for tlo_meta in imported.itervalues():
-                    evt.add_relationship(self.updates[tlo_meta[1]],
-                                         rel_type=rel_type,
-                                         rel_confidence=confidence,
-                                         analyst=analyst)
-                    sub_pkg.add_relationship(self.updates[tlo_meta[1]],
-                                             rel_type=RelationshipTypes.RELATED_TO,
-                                             rel_confidence='Unknown',
-                                             analyst=analyst)
-                sub_pkg.save(username=analyst)
-            evt.save(username=analyst)
+                    relate(evt, self.updates[tlo_meta[1]], rel_type,
+                           confidence)
+                    relate(sub_pkg, self.updates[tlo_meta[1]],
+                           RelationshipTypes.RELATED_TO, 'Unknown')
+                if not self.batch_size:
+                    sub_pkg.save(username=analyst)
+            if not self.batch_size:
+                evt.save(username=analyst)
 
         # relate objects to each other
         for rel in self.relationships:
@@ -1382,10 +1409,11 @@ class STIXParser():
                             rel_type = rel[1]
                             if rel_type not in valid_rel_types:
                                 rel_type = RelationshipTypes.RELATED_TO
-                            left.add_relationship(right,
-                                                  rel_type=rel_type,
-                                                  rel_confidence=rel[3],
-                                                  analyst=analyst)
+                            relate(left, right, rel_type, rel[3])
+
+        if self.batch_size:
+            batch.flush(self.batch_size, self.progress)
+            return
 
         # save objects
         for id_ in self.imported:
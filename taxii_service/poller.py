@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger("crits." + __name__)
+
+class PollJob(object):
+    """
+    One feed poll for run_polls().
+
+    When it finishes, the job holds the poll's result, or the error it
+    raised, and how long it ran. A job that ran past the timeout is marked
+    as timed out and left to finish in the background, still holding its
+    place in its server's limit.
+    """
+
+    def __init__(self, server, func, *args, **kwargs):
+        self.server = server
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.timed_out = False
+        self.started = None
+        self.wall_time = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            logger.exception("TAXII poll of %s failed" % self.server)
+            self.error = e
+
+
+def run_polls(jobs, max_threads, server_threads, timeout):
+    """
+    Run poll jobs in parallel.
+
+    :param jobs: The jobs to run. Jobs are started in this order, skipping
+                 those whose server is already at its limit.
+    :type jobs: list of :class:`PollJob`
+    :param max_threads: Most jobs to run at once.
+    :type max_threads: int
+    :param server_threads: Most jobs to run at once against one server.
+    :type server_threads: int
+    :param timeout: Seconds a job may run before it is given up on, or None
+                    to wait for every job. A job given up on still counts
+                    against server_threads until it returns, so the jobs
+                    queued behind it for the same server wait for it.
+    :type timeout: int
+    :returns: list of :class:`PollJob`, the same jobs.
+    """
+
+    cond = threading.Condition()
+    pending = list(jobs)
+    running = {}
+    active = set()
+
+    def next_job():
+        with cond:
+            while pending:
+                for job in pending:
+                    if running.get(job.server, 0) < max(server_threads, 1):
+                        pending.remove(job)
+                        running[job.server] = running.get(job.server, 0) + 1
+                        active.add(job)
+                        job.started = time.time()
+                        # Let run_polls() know when this one is due.
+                        cond.notify_all()
+                        return job
+                cond.wait()
+            return None
+
+    def worker():
+        while True:
+            job = next_job()
+            if not job:
+                return
+            job.run()
+            with cond:
+                running[job.server] -= 1
+                cond.notify_all()
+                if job.timed_out:
+                    # A new worker has taken this one's place already.
+                    return
+                job.wall_time = time.time() - job.started
+                active.discard(job)
+
+    def start_worker():
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    with cond:
+        for i in xrange(min(max(max_threads, 1), len(jobs))):
+            start_worker()
+
+        while pending or active:
+            wait = None
+            if timeout:
+                now = time.time()
+                for job in list(active):
+                    if now - job.started >= timeout:
+                        # Stop waiting for it, but leave its server slot
+                        # taken until it really returns.
+                        job.timed_out = True
+                        job.wall_time = now - job.started
+                        active.discard(job)
+                        if pending:
+                            start_worker()
+                        cond.notify_all()
+                if not (pending or active):
+                    break
+                if active:
+                    wait = min(job.started + timeout for job in active) - now
+                    wait = max(wait, 0.01)
+            cond.wait(wait)
+
+    return jobs
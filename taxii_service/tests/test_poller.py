@@ -0,0 +1,135 @@
+"""
+Tests for taxii_service.poller, using fake poll jobs.
+
+The poller has no CRITs dependencies, so it is loaded by path and these
+run without a CRITs install:
+
+    python -m unittest discover -s taxii_service/tests
+"""
+
+import imp
+import os
+import threading
+import time
+import unittest
+
+poller = imp.load_source('taxii_poller',
+                         os.path.join(os.path.dirname(__file__), os.pardir,
+                                      'poller.py'))
+
+class Tracker(object):
+    """
+    Fake poll that sleeps, and records how many ran at once per server.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peak = {}
+
+    def poll(self, server, delay, fail=False):
+        with self.lock:
+            self.active[server] = self.active.get(server, 0) + 1
+            self.peak[server] = max(self.peak.get(server, 0),
+                                    self.active[server])
+        try:
+            time.sleep(delay)
+            if fail:
+                raise ValueError("poll failed")
+            return (server, delay)
+        finally:
+            with self.lock:
+                self.active[server] -= 1
+
+    def job(self, server, delay, fail=False):
+        return poller.PollJob(server, self.poll, server, delay, fail)
+
+
+class RunPollsTests(unittest.TestCase):
+    def run_polls(self, jobs, max_threads, server_threads, timeout):
+        # Fail instead of hanging if run_polls never returns.
+        done = []
+        thread = threading.Thread(target=lambda: done.append(
+            poller.run_polls(jobs, max_threads, server_threads, timeout)))
+        thread.daemon = True
+        start = time.time()
+        thread.start()
+        thread.join(10)
+        self.assertTrue(done, "run_polls did not return")
+        return time.time() - start
+
+    def test_parallel_with_server_limit(self):
+        t = Tracker()
+        jobs = [t.job('a', 0.2) for i in range(6)]
+        jobs += [t.job('b', 0.2) for i in range(6)]
+        elapsed = self.run_polls(jobs, 4, 2, None)
+        self.assertEqual(t.peak, {'a': 2, 'b': 2})
+        self.assertLess(elapsed, 1.2) # 2.4 if run one at a time
+        for job in jobs:
+            self.assertEqual(job.result, (job.server, 0.2))
+            self.assertIsNone(job.error)
+            self.assertFalse(job.timed_out)
+            self.assertGreaterEqual(job.wall_time, 0.15)
+
+    def test_thread_limit(self):
+        t = Tracker()
+        jobs = [t.job(str(i), 0.1) for i in range(6)]
+        elapsed = self.run_polls(jobs, 2, 5, None)
+        self.assertGreaterEqual(elapsed, 0.25)
+
+    def test_errors(self):
+        t = Tracker()
+        jobs = [t.job('a', 0.05, fail=True), t.job('a', 0.05)]
+        self.run_polls(jobs, 2, 2, None)
+        self.assertIsInstance(jobs[0].error, ValueError)
+        self.assertIsNone(jobs[0].result)
+        self.assertEqual(jobs[1].result, ('a', 0.05))
+        self.assertIsNone(jobs[1].error)
+
+    def test_timeout_last_job(self):
+        t = Tracker()
+        jobs = [t.job('a', 2)]
+        elapsed = self.run_polls(jobs, 1, 1, 0.5)
+        self.assertTrue(jobs[0].timed_out)
+        self.assertIsNone(jobs[0].result)
+        self.assertLess(elapsed, 1.5)
+
+    def test_timeout_with_other_jobs(self):
+        t = Tracker()
+        jobs = [t.job('a', 2), t.job('b', 0.1)]
+        elapsed = self.run_polls(jobs, 2, 1, 0.5)
+        self.assertTrue(jobs[0].timed_out)
+        self.assertFalse(jobs[1].timed_out)
+        self.assertEqual(jobs[1].result, ('b', 0.1))
+        self.assertLess(elapsed, 1.5)
+
+    def test_timeout_frees_thread(self):
+        # With one thread, the jobs for other servers still run behind a
+        # stuck poll.
+        t = Tracker()
+        jobs = [t.job('a', 2)] + [t.job('b', 0.05) for i in range(3)]
+        elapsed = self.run_polls(jobs, 1, 1, 0.5)
+        self.assertTrue(jobs[0].timed_out)
+        for job in jobs[1:]:
+            self.assertFalse(job.timed_out)
+            self.assertEqual(job.result, ('b', 0.05))
+        self.assertLess(elapsed, 1.5)
+
+    def test_timeout_keeps_server_slot(self):
+        # The server limit holds while a timed out poll is still running.
+        t = Tracker()
+        jobs = [t.job('a', 1)] + [t.job('a', 0.05) for i in range(3)]
+        elapsed = self.run_polls(jobs, 4, 1, 0.3)
+        self.assertTrue(jobs[0].timed_out)
+        self.assertEqual(t.peak, {'a': 1})
+        for job in jobs[1:]:
+            self.assertFalse(job.timed_out)
+            self.assertEqual(job.result, ('a', 0.05))
+        self.assertGreaterEqual(elapsed, 0.9)
+
+    def test_no_jobs(self):
+        self.assertEqual(poller.run_polls([], 4, 2, 1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
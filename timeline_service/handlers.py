@@ -1,5 +1,8 @@
 import cgi
+import datetime
+import heapq
 import urllib
+from itertools import groupby
 
 try:
     from django.urls import reverse
@@ -9,69 +12,249 @@ from django.template.loader import render_to_string
 
 from crits.core.user_tools import user_sources
 from crits.core.class_mapper import class_from_type
+from crits.services.analysis_result import AnalysisResult
 
-def generate_timeline(obj_type, obj_id, user):
+# Days of events in each page of the timeline.
+TIMELINE_DAYS = 30
+
+# Relationships are checked against the user's sources in batches this big.
+RELATIONSHIP_BATCH = 200
+
+def generate_timeline(obj_type, obj_id, user, end=None, days=TIMELINE_DAYS):
+    """
+    Generate a page of the timeline for an object.
+
+    A page holds days worth of events, starting with the most recent event
+    before end. Events are read newest first, so only the page and the
+    first event after it are fetched.
+
+    :param obj_type: The type of the object.
+    :type obj_type: str
+    :param obj_id: The ObjectId of the object.
+    :type obj_id: str
+    :param user: The user generating the timeline.
+    :type user: str
+    :param end: Only events before this date. None for all events.
+    :type end: datetime.datetime
+    :param days: Number of days in the page.
+    :type days: int
+    :returns: dict with keys "success", "message" (the HTML), "more" (True
+              if there are older events) and "next" (the end date of the next
+              page, as YYYY-MM-DD).
+    """
 
     users_sources = user_sources(user)
     obj_class = class_from_type(obj_type)
+    fields = [f for f in ('id', 'created', 'link_id') if f in obj_class._fields]
     if hasattr(obj_class, 'source'):
         main_obj = obj_class.objects(id=obj_id,
-                                    source__name__in=users_sources).first()
+                                     source__name__in=users_sources).only(*fields).first()
     else:
-        main_obj = obj_class.objects(id=obj_id).first()
+        main_obj = obj_class.objects(id=obj_id).only(*fields).first()
     if not main_obj:
         return {'success': False,
                 'message': 'No starting object found.'}
 
-    # timeline is a dictionary.
-    # the key is the date with no time allowing us to collect a day's events.
-    # the value is a list of tuples.
+    events = iter_timeline(obj_type, main_obj, users_sources, end)
+
+    # timeline is a list of (day, events) tuples, newest day first.
+    # the day is the date with no time allowing us to collect a day's events.
+    # the events are a list of tuples, oldest first.
     # the first item in the tuple should be a datetime string for the event.
     # the second element should be a description of the event that happened.
-    timeline = {}
+    timeline = []
+    more = False
+    first_day = None
+    for day, day_events in groupby(events, key=lambda e: str(e[0]).split(" ")[0]):
+        if first_day is None:
+            first_day = _parse_day(day)
+            if first_day:
+                first_day -= datetime.timedelta(days=max(days, 1) - 1)
+        parsed = _parse_day(day)
+        if first_day and parsed and parsed < first_day:
+            more = True
+            break
+        day_events = sorted(day_events, key=lambda e: _date_key(e[0]))
+        timeline.append((day, [(str(date), i) for (date, i) in day_events]))
+
+    html = render_to_string('timeline_contents.html',
+                            {'timeline': timeline})
+    result = {'success': True,
+              'message': html,
+              'more': more}
+    if more:
+        result['next'] = first_day.strftime('%Y-%m-%d')
+    return result
+
+def iter_timeline(obj_type, main_obj, users_sources, end=None):
+    """
+    Generate the events in the timeline of an object, newest first.
+
+    Each kind of event is read with one query, projected to the fields it
+    needs, sorted newest first in the database and only read as far as the
+    caller goes.
+
+    :param obj_type: The type of the object.
+    :type obj_type: str
+    :param main_obj: The object, only id, created and link_id are needed.
+    :type main_obj: :class:`crits.core.crits_mongoengine.CritsBaseAttributes`
+    :param users_sources: The sources the user can see.
+    :type users_sources: list
+    :param end: Only events before this date. None for all events.
+    :type end: datetime.datetime
+    :returns: generator of (date, description) tuples. The date is None
+              for events without one, which come last.
+    """
+
+    return _merge_newest_first([
+        _created_events(obj_type, main_obj, end),
+        _source_events(obj_type, main_obj, users_sources, end),
+        _releasability_events(main_obj, users_sources, end),
+        _campaign_events(main_obj, end),
+        _object_events(main_obj, end),
+        _relationship_events(main_obj, users_sources, end),
+        _comment_events(obj_type, main_obj, end),
+        _analysis_events(obj_type, main_obj, end),
+        _ticket_events(main_obj, end),
+        _raw_data_events(obj_type, main_obj, end),
+        _indicator_events(obj_type, main_obj, end),
+    ])
+
+class _Newest(object):
+    """
+    Order timeline events newest first in heapq.merge.
+    """
+
+    __slots__ = ('event',)
+
+    def __init__(self, event):
+        self.event = event
+
+    def __lt__(self, other):
+        return _date_key(self.event[0]) > _date_key(other.event[0])
+
+def _date_key(date):
+    # Dates are compared as strings, some are stored as strings. Events
+    # without a date are the oldest.
+    if date is None:
+        date = datetime.datetime.min
+    return str(date)
+
+def _merge_newest_first(streams):
+    wrapped = [(_Newest(e) for e in stream) for stream in streams]
+    for item in heapq.merge(*wrapped):
+        yield item.event
+
+def _parse_day(day):
+    try:
+        return datetime.datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        return None
 
+def _aggregate(klass, pipeline):
+    result = klass._get_collection().aggregate(pipeline)
+    # pymongo 2 returns the whole result in a dict, pymongo 3 a cursor.
+    if isinstance(result, dict):
+        return iter(result.get('result', []))
+    return result
+
+def _embedded_events(main_obj, path, fields, end, names=None, instances=None):
+    """
+    Read a list of embedded documents of an object, newest first.
+
+    The list is unwound in the database so only the items before end are
+    returned, each as a dict of the requested fields plus "date".
+
+    :param main_obj: The object.
+    :param path: The list field, like "campaign".
+    :type path: str
+    :param fields: The fields of each item to return.
+    :type fields: list
+    :param end: Only items dated before this. None for all items.
+    :type end: datetime.datetime
+    :param names: Only items whose name is in this list.
+    :type names: list
+    :param instances: The list field in each item to unwind too, like the
+                      instances of a source. Its items are returned, with
+                      the name of the item they belong to.
+    :type instances: str
+    :returns: iterable of dict
+    """
+
+    klass = main_obj.__class__
+    list_field = klass._fields.get(path)
+    if not list_field:
+        return []
+    item_class = list_field.field.document_type
+    item_path = list_field.db_field
+    pipeline = [{'$match': {'_id': main_obj.id}},
+                {'$project': {item_path: 1}},
+                {'$unwind': '$' + item_path}]
+    project = {'_id': 0}
+    if names is not None:
+        name_path = '%s.%s' % (item_path, item_class._fields['name'].db_field)
+        pipeline.append({'$match': {name_path: {'$in': names}}})
+        project['name'] = '$' + name_path
+    if instances:
+        instances_field = item_class._fields[instances]
+        item_path = '%s.%s' % (item_path, instances_field.db_field)
+        item_class = instances_field.field.document_type
+        pipeline.append({'$unwind': '$' + item_path})
+    date_path = '%s.%s' % (item_path, item_class._fields['date'].db_field)
+    if end:
+        # Undated items sort last, so they belong to the last page.
+        pipeline.append({'$match': {'$or': [{date_path: {'$lt': end}},
+                                            {date_path: None}]}})
+    pipeline.append({'$sort': {date_path: -1}})
+    project['date'] = '$' + date_path
+    for field in fields:
+        if field in item_class._fields:
+            project[field] = '$%s.%s' % (item_path, item_class._fields[field].db_field)
+    pipeline.append({'$project': project})
+    return _aggregate(klass, pipeline)
+
+def _created_events(obj_type, main_obj, end):
     # creation time
-    i = "<b>%s</b> was created" % obj_type
-    append_to_timeline(timeline, main_obj.created, i)
-
-    # sources
-    if hasattr(main_obj, 'source'):
-        for source in main_obj.source:
-            if source.name in users_sources:
-                name = source.name
-                for instance in source.instances:
-                    i = "Source <b>%s</b> provided %s with a method of <b>'%s'</b> \
-                            and a reference of <b>'%s'</b>" % (name,
+    if main_obj.created and (not end or main_obj.created < end):
+        i = "<b>%s</b> was created" % obj_type
+        yield (main_obj.created, i)
+
+def _source_events(obj_type, main_obj, users_sources, end):
+    for instance in _embedded_events(main_obj, 'source',
+                                     ['method', 'reference'], end,
+                                     names=users_sources,
+                                     instances='instances'):
+        i = "Source <b>%s</b> provided %s with a method of <b>'%s'</b> \
+                            and a reference of <b>'%s'</b>" % (instance['name'],
                                                             obj_type,
-                                                            cgi.escape(str(instance.method)),
-                                                            cgi.escape(str(instance.reference)))
-                    append_to_timeline(timeline, instance.date, i)
-
-    # releasability
-    for release in main_obj.releasability:
-        if release.name in users_sources:
-            name = release.name
-            for instance in release.instances:
-                i = "Release to <b>%s</b> added." % cgi.escape(name)
-                append_to_timeline(timeline, instance.date, i)
-
-    # campaigns
-    for campaign in main_obj.campaign:
-        name = campaign.name
-        confidence = campaign.confidence
-        description = campaign.description
+                                                            cgi.escape(str(instance.get('method'))),
+                                                            cgi.escape(str(instance.get('reference'))))
+        yield (instance.get('date'), i)
+
+def _releasability_events(main_obj, users_sources, end):
+    for instance in _embedded_events(main_obj, 'releasability', [], end,
+                                     names=users_sources,
+                                     instances='instances'):
+        i = "Release to <b>%s</b> added." % cgi.escape(instance['name'])
+        yield (instance.get('date'), i)
+
+def _campaign_events(main_obj, end):
+    for campaign in _embedded_events(main_obj, 'campaign',
+                                     ['name', 'confidence', 'description'],
+                                     end):
+        name = campaign['name']
         rev = reverse('crits-campaigns-views-campaign_details', args=[name,])
         link = '<a href="%s">%s</a>' % (cgi.escape(rev), cgi.escape(name))
         i = "Campaign <b>%s</b> added with a confidence of <b>%s</b> and a \
                 description of '%s'" % (link,
-                                        confidence,
-                                        cgi.escape(description))
-        append_to_timeline(timeline, campaign.date, i)
-
-    # objects
-    for obj in main_obj.obj:
-        type_ = obj.object_type
-        value = obj.value
+                                        campaign.get('confidence'),
+                                        cgi.escape(campaign.get('description') or ''))
+        yield (campaign.get('date'), i)
+
+def _object_events(main_obj, end):
+    for obj in _embedded_events(main_obj, 'obj', ['object_type', 'value'], end):
+        type_ = obj['object_type']
+        value = obj['value']
         rev = '%s?search_type=object&otype=%s&q=%s&force_full=1' \
                 % (reverse('crits-core-views-global_search_listing'),
                    "%s" % (type_),
@@ -79,122 +262,164 @@ def generate_timeline(obj_type, obj_id, user):
         link = '<a href="%s">%s</a>' % (cgi.escape(rev), cgi.escape(value))
         i = "<b>%s</b> object added with a value of :<br />%s" % (type_,
                                                                   link)
-        append_to_timeline(timeline, obj.date, i)
-
-    # relationships
-    for rel in main_obj.relationships:
-        tobj = class_from_type(rel.rel_type)
-        if tobj.objects(id=rel.object_id,
-                        source__name__in=users_sources).only('id').first():
-            rev = reverse('crits-core-views-details', args=[rel.rel_type,
-                                                            str(rel.object_id),])
-            link = '<a href="%s">%s</a>' % (rev, rel.rel_type)
-            i = "<b>%s</b> was added with a relationship of <b>%s</b>." % (link,
-                                                             rel.relationship)
-            append_to_timeline(timeline, rel.date, i)
-
-    # comments
+        yield (obj.get('date'), i)
+
+def _relationship_events(main_obj, users_sources, end):
+    rels = _embedded_events(main_obj, 'relationships',
+                            ['relationship', 'rel_type', 'object_id'], end)
+    batch = []
+    for rel in rels:
+        batch.append(rel)
+        if len(batch) == RELATIONSHIP_BATCH:
+            for event in _visible_relationships(batch, users_sources):
+                yield event
+            batch = []
+    for event in _visible_relationships(batch, users_sources):
+        yield event
+
+def _visible_relationships(rels, users_sources):
+    # Only show relationships to objects the user can see, with one query
+    # per type of object.
+    ids_by_type = {}
+    for rel in rels:
+        ids_by_type.setdefault(rel['rel_type'], []).append(rel['object_id'])
+    visible = set()
+    for rel_type, ids in ids_by_type.iteritems():
+        tobj = class_from_type(rel_type)
+        if not tobj:
+            continue
+        if hasattr(tobj, 'source'):
+            found = tobj.objects(id__in=ids,
+                                 source__name__in=users_sources).only('id')
+        else:
+            found = tobj.objects(id__in=ids).only('id')
+        visible.update(str(o.id) for o in found)
+    for rel in rels:
+        if str(rel['object_id']) not in visible:
+            continue
+        rev = reverse('crits-core-views-details', args=[rel['rel_type'],
+                                                        str(rel['object_id']),])
+        link = '<a href="%s">%s</a>' % (rev, rel['rel_type'])
+        i = "<b>%s</b> was added with a relationship of <b>%s</b>." % (link,
+                                                         rel['relationship'])
+        yield (rel.get('date'), i)
+
+def _comment_events(obj_type, main_obj, end):
     cobj = class_from_type("Comment")
     comments = cobj.objects(obj_type=obj_type,
-                            obj_id=obj_id)
-    for comment in comments:
+                            obj_id=main_obj.id)
+    if end:
+        comments = comments.filter(created__lt=end)
+    for comment in comments.order_by('-created'):
         comment.comment_to_html()
         i = "<b>%s</b> made a comment: %s" % (comment.analyst,
                                               cgi.escape(comment.comment))
-        append_to_timeline(timeline, comment.created, i)
-
-    analysis_results = main_obj.get_analysis_results()
-
-    # analysis
-    for analysis in analysis_results:
-        analyst = analysis.analyst
-        service_name = analysis.service_name
-        version = analysis.version
-        results = len(analysis.results)
-        i = "<b>%s</b> ran <b>%s (%s)</b> and got <b>%d</b> results." % (analyst,
-                                                                         service_name,
-                                                                         version,
-                                                                         results)
-        append_to_timeline(timeline, analysis.start_date, i)
-
-    # tickets
-    for ticket in main_obj.tickets:
-        i = "<b>%s</b> added Ticket <b>%s</b>" % (ticket.analyst,
-                                                  cgi.escape(ticket.ticket_number))
-        append_to_timeline(timeline, ticket.date, i)
+        yield (comment.created, i)
+
+def _analysis_events(obj_type, main_obj, end):
+    fields = AnalysisResult._fields
+    date_path = fields['start_date'].db_field
+    match = {fields['object_type'].db_field: obj_type,
+             fields['object_id'].db_field: str(main_obj.id)}
+    if end:
+        # start_date may be stored as a string or a datetime.
+        match['$or'] = [{date_path: {'$lt': end}},
+                        {date_path: {'$lt': str(end)}}]
+    results_path = '$' + fields['results'].db_field
+    pipeline = [{'$match': match},
+                {'$sort': {date_path: -1}},
+                {'$project': {
+                    'analyst': '$' + fields['analyst'].db_field,
+                    'service_name': '$' + fields['service_name'].db_field,
+                    'version': '$' + fields['version'].db_field,
+                    'start_date': '$' + date_path,
+                    # Count the results without reading them.
+                    'results': {'$size': {'$ifNull': [results_path, []]}},
+                }}]
+    for analysis in _aggregate(AnalysisResult, pipeline):
+        i = "<b>%s</b> ran <b>%s (%s)</b> and got <b>%d</b> results." % (analysis.get('analyst'),
+                                                                         analysis.get('service_name'),
+                                                                         analysis.get('version'),
+                                                                         analysis['results'])
+        yield (analysis.get('start_date'), i)
+
+def _ticket_events(main_obj, end):
+    for ticket in _embedded_events(main_obj, 'tickets',
+                                   ['analyst', 'ticket_number'], end):
+        i = "<b>%s</b> added Ticket <b>%s</b>" % (ticket.get('analyst'),
+                                                  cgi.escape(ticket['ticket_number']))
+        yield (ticket.get('date'), i)
 
+def _raw_data_events(obj_type, main_obj, end):
     # raw data specific timeline entries
-    if obj_type == "RawData":
-
-        # inline comments
-        for inline in main_obj.inlines:
-            i = "<b>%s</b> made an inline comment on line <b>%d</b>: %s" % (inline.analyst,
-                                                                            inline.line,
-                                                                            cgi.escape(inline.comment))
-            append_to_timeline(timeline, inline.date, i)
-
-        # highlights
-        for highlight in main_obj.highlights:
-            i = "<b>%s</b> highlighted line <b>%d</b>: %s" % (highlight.analyst,
-                                                              highlight.line,
-                                                              highlight.comment)
-            append_to_timeline(timeline, highlight.date, i)
-
-        # versions
-        robj = class_from_type(obj_type)
-        versions = robj.objects(link_id=main_obj.link_id).only('id',
-                                                               'version',
-                                                               'created')
-        for version in versions:
-            rev = reverse('crits-raw_data-views-raw_data_details',
-                          args=[str(version.id),])
-            link = '<a href="%s">%d</a>' % (rev, version.version)
-            i = "Version %s was added." % link
-            append_to_timeline(timeline, version.created, i)
+    if obj_type != "RawData":
+        return []
+    return _merge_newest_first([
+        _inline_events(main_obj, end),
+        _highlight_events(main_obj, end),
+        _version_events(obj_type, main_obj, end),
+    ])
 
-    # indicator specific timeline entries
-    if obj_type == "Indicator":
-
-        # actions
-        for action in main_obj.actions:
-            i = "<b>%s</b> added action <b>%s</b> to start on <b>%s</b>" \
-                % (action.analyst,
-                   action.action_type,
-                   action.begin_date)
-            i += ", set to <b>%s</b>, with a reason of: <b>%s</b>" \
-                    % (action.active,
-                       cgi.escape(action.reason))
-            append_to_timeline(timeline, action.date, i)
-
-        # activity
-        for activity in main_obj.activity:
-            i = "<b>%s</b> noted Indicator activity from <b>%s</b> to <b>%s</b> \
-                    and said: %s" % (activity.analyst,
-                                     activity.start_date,
-                                     activity.end_date,
-                                     cgi.escape(activity.description))
-            append_to_timeline(timeline, activity.date, i)
-
-    # sort timeline
-    sorted_timeline = []
-    keys = timeline.keys()
-    keys.sort()
-    for key in keys:
-        k = timeline[key]
-        k.sort(key=lambda tup:tup[0])
-        sorted_timeline.append((key, k))
+def _inline_events(main_obj, end):
+    for inline in _embedded_events(main_obj, 'inlines',
+                                   ['analyst', 'line', 'comment'], end):
+        i = "<b>%s</b> made an inline comment on line <b>%d</b>: %s" % (inline['analyst'],
+                                                                        inline['line'],
+                                                                        cgi.escape(inline['comment']))
+        yield (inline.get('date'), i)
 
-    html = render_to_string('timeline_contents.html',
-                            {'timeline': sorted_timeline})
+def _highlight_events(main_obj, end):
+    for highlight in _embedded_events(main_obj, 'highlights',
+                                      ['analyst', 'line', 'comment'], end):
+        i = "<b>%s</b> highlighted line <b>%d</b>: %s" % (highlight['analyst'],
+                                                          highlight['line'],
+                                                          highlight['comment'])
+        yield (highlight.get('date'), i)
 
-    return {'success': True,
-            'message': html}
+def _version_events(obj_type, main_obj, end):
+    robj = class_from_type(obj_type)
+    versions = robj.objects(link_id=main_obj.link_id)
+    if end:
+        versions = versions.filter(created__lt=end)
+    versions = versions.order_by('-created').only('id',
+                                                  'version',
+                                                  'created')
+    for version in versions:
+        rev = reverse('crits-raw_data-views-raw_data_details',
+                      args=[str(version.id),])
+        link = '<a href="%s">%d</a>' % (rev, version.version)
+        i = "Version %s was added." % link
+        yield (version.created, i)
+
+def _indicator_events(obj_type, main_obj, end):
+    # indicator specific timeline entries
+    if obj_type != "Indicator":
+        return []
+    return _merge_newest_first([
+        _action_events(main_obj, end),
+        _activity_events(main_obj, end),
+    ])
 
+def _action_events(main_obj, end):
+    for action in _embedded_events(main_obj, 'actions',
+                                   ['analyst', 'action_type', 'begin_date',
+                                    'active', 'reason'], end):
+        i = "<b>%s</b> added action <b>%s</b> to start on <b>%s</b>" \
+            % (action.get('analyst'),
+               action.get('action_type'),
+               action.get('begin_date'))
+        i += ", set to <b>%s</b>, with a reason of: <b>%s</b>" \
+                % (action.get('active'),
+                   cgi.escape(action.get('reason') or ''))
+        yield (action.get('date'), i)
 
-def append_to_timeline(timeline, date, item):
-    dt = str(date)
-    d = dt.split(" ")[0]
-    add = (dt, item)
-    if d not in timeline:
-        timeline[d] = []
-    timeline[d].append(add)
+def _activity_events(main_obj, end):
+    for activity in _embedded_events(main_obj, 'activity',
+                                     ['analyst', 'start_date', 'end_date',
+                                      'description'], end):
+        i = "<b>%s</b> noted Indicator activity from <b>%s</b> to <b>%s</b> \
+                    and said: %s" % (activity.get('analyst'),
+                                     activity.get('start_date'),
+                                     activity.get('end_date'),
+                                     cgi.escape(activity.get('description') or ''))
+        yield (activity.get('date'), i)
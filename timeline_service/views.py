@@ -1,3 +1,4 @@
+import datetime
 import json
 
 from django.contrib.auth.decorators import user_passes_test
@@ -8,5 +9,18 @@ from . import handlers
 
 @user_passes_test(user_can_view_data)
 def get_timeline(request, ctype, cid):
-    result = handlers.generate_timeline(ctype, cid, "%s" % request.user)
+    # Pages after the first are requested with the "next" date of the page
+    # before them.
+    end = request.POST.get('end', None)
+    if end:
+        try:
+            end = datetime.datetime.strptime(end, '%Y-%m-%d')
+        except ValueError:
+            end = None
+    try:
+        days = int(request.POST.get('days', handlers.TIMELINE_DAYS))
+    except ValueError:
+        days = handlers.TIMELINE_DAYS
+    result = handlers.generate_timeline(ctype, cid, "%s" % request.user,
+                                        end=end, days=days)
     return HttpResponse(json.dumps(result), content_type="application/json")
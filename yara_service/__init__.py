@@ -1,6 +1,12 @@
 import binascii
+import contextlib
+import hashlib
 import logging
 import os
+import re
+import shutil
+import tempfile
+import threading
 import yara
 
 from django.conf import settings
@@ -13,6 +19,21 @@ from . import forms
 
 logger = logging.getLogger(__name__)
 
+# Externals referenced by signatures. They must be declared when compiling,
+# the real values are passed in when matching each sample.
+DEFAULT_EXTERNALS = {'filepath': '', 'filename': '', 'extension': ''}
+
+# Compiled rules shared by all scans in this process.
+# Maps signature file path -> (content sha256, yara.Rules).
+_rules_cache = {}
+_rules_lock = threading.Lock()
+
+# include statements, whose files are part of a signature file's digest.
+INCLUDE_RE = re.compile(r'^\s*include\s+"([^"]+)"', re.M)
+
+# Read size used when copying large samples to disk for scanning.
+SPOOL_CHUNK_SIZE = 4 * 1024 * 1024
+
 
 class YaraService(Service):
     """
@@ -37,8 +58,13 @@ class YaraService(Service):
 
         if isinstance(sigfiles, basestring):
             config['sigfiles'] = [sigfile for sigfile in sigfiles.split('\r\n')]
+        cachedir = config.get('cachedir', '')
+        if cachedir and not os.path.isdir(cachedir):
+            raise ServiceConfigError("Cache directory does not exist.")
         # This will raise ServiceConfigError
-        YaraService._compile_rules(config['sigdir'], config['sigfiles'])
+        YaraService._compile_rules(config['sigdir'], config['sigfiles'],
+                                   cachedir,
+                                   config.get('merge_sigfiles', False))
 
     @staticmethod
     def get_config(existing_config):
@@ -85,6 +111,7 @@ class YaraService(Service):
             del config['api_key']
             del config['distribution_url']
         del config['sigdir']
+        config.pop('cachedir', None)
 
     @staticmethod
     def _get_api_keys(config, analyst):
@@ -149,42 +176,176 @@ class YaraService(Service):
         return html
 
     @staticmethod
-    def _compile_rules(sigdir, sigfiles, sfpath=""):
+    def _compile_rules(sigdir, sigfiles, cachedir="", merge=False):
         if not sigfiles or not sigdir:
             raise ServiceConfigError("No signature files specified.")
         sigsets = []
+        filepaths = {}
+        # In the configured order, so merged results are added in the same
+        # order as when scanning one file at a time.
+        namespaces = []
         for sigfile in sigfiles:
             if sigfile[0] == '#':
                 continue
-            sigfile = os.path.abspath(os.path.join(sigdir, sigfile.strip()))
+            namespace = sigfile.strip()
+            # A file listed twice would have its matches added twice.
+            if namespace in namespaces:
+                continue
+            namespaces.append(namespace)
+            sigfile = os.path.abspath(os.path.join(sigdir, namespace))
             logger.debug("Full path to file file: %s" % sigfile)
+            if merge:
+                filepaths[namespace] = sigfile
+                continue
             filename = os.path.basename(sigfile)
-            dirname = os.path.dirname(sigfile)
-            sfname = str(os.path.basename(sfpath))
-            sfext = str(os.path.splitext(sfname))
-            old = os.getcwd()
-            try:
-                with open(sigfile, "rt") as f:
-                    data = f.read()
-                    os.chdir(dirname)
-            except Exception as e:
-                logger.exception("File cannot be opened: %s" % sigfile)
-                raise ServiceConfigError(str(e))
-            try:
-                rules = yara.compile(source=data,
-                                        externals = {'filepath': sfpath,
-                                                        'filename': sfname,
-                                                        'extension': sfext })
-            except yara.SyntaxError as e:
-                message = "Yara rules file: %s: %s" % (sigfile, str(e))
-                logger.exception(message)
-                os.chdir(old)
-                raise ServiceConfigError(message)
+            rules = YaraService._load_rules(sigfile, cachedir)
             sigsets.append({'name': filename, 'rules': rules})
-            os.chdir(old) 
+        if filepaths:
+            rules = YaraService._load_merged_rules(filepaths, cachedir)
+            sigsets.append({'name': ', '.join(namespaces),
+                            'rules': rules,
+                            'namespaces': namespaces})
         logger.debug(str(sigsets))
         return sigsets
 
+    @staticmethod
+    def _read_sigfile(sigfile):
+        try:
+            with open(sigfile, "rt") as f:
+                return f.read()
+        except Exception as e:
+            logger.exception("File cannot be opened: %s" % sigfile)
+            raise ServiceConfigError(str(e))
+
+    @staticmethod
+    def _sigfile_digest(sigfile, data, h, seen=None):
+        """
+        Add the path and contents of a signature file to a hash, followed
+        by those of each file it includes, recursively.
+
+        Included files are resolved relative to the including file, the
+        same way yara does. A missing file is hashed as missing, so the
+        rules are recompiled once it appears.
+        """
+
+        if seen is None:
+            seen = set()
+        seen.add(sigfile)
+        h.update("%s\0%s\0" % (sigfile, hashlib.sha256(data).hexdigest()))
+        for include in INCLUDE_RE.findall(data):
+            path = os.path.abspath(os.path.join(os.path.dirname(sigfile),
+                                                include))
+            if path in seen:
+                continue
+            try:
+                with open(path, "rt") as f:
+                    included = f.read()
+            except (IOError, OSError):
+                seen.add(path)
+                h.update("%s\0missing\0" % path)
+                continue
+            YaraService._sigfile_digest(path, included, h, seen)
+
+    @staticmethod
+    def _load_rules(sigfile, cachedir=""):
+        """
+        Return compiled rules for a signature file.
+
+        Rules are cached per process, keyed by the path of the signature
+        file and a hash of its path and contents and those of the files it
+        includes, so they are only recompiled when one of them changes. If
+        a cache directory is given the compiled rules are also saved there,
+        so new workers can load them without compiling.
+        """
+
+        data = YaraService._read_sigfile(sigfile)
+        h = hashlib.sha256()
+        YaraService._sigfile_digest(sigfile, data, h)
+        return YaraService._cached_rules(
+            sigfile, h.hexdigest(), cachedir,
+            lambda: YaraService._compile_source(sigfile, data))
+
+    @staticmethod
+    def _load_merged_rules(filepaths, cachedir=""):
+        """
+        Return one set of compiled rules for several signature files, with
+        the rules from each file in its own namespace.
+
+        filepaths maps namespace -> path of the signature file. Cached the
+        same way as _load_rules, keyed on all of the files.
+        """
+
+        h = hashlib.sha256()
+        for namespace in sorted(filepaths):
+            data = YaraService._read_sigfile(filepaths[namespace])
+            h.update("%s\0" % namespace)
+            YaraService._sigfile_digest(filepaths[namespace], data, h)
+        key = tuple(sorted(filepaths.items()))
+        return YaraService._cached_rules(
+            key, h.hexdigest(), cachedir,
+            lambda: YaraService._compile_filepaths(filepaths))
+
+    @staticmethod
+    def _cached_rules(key, digest, cachedir, compile_rules):
+        with _rules_lock:
+            cached = _rules_cache.get(key)
+        if cached and cached[0] == digest:
+            return cached[1]
+
+        rules = None
+        cached_path = None
+        if cachedir:
+            cached_path = os.path.join(cachedir, "%s.yarc" % digest)
+            if os.path.isfile(cached_path):
+                try:
+                    rules = yara.load(cached_path)
+                except yara.Error as e:
+                    logger.warning("Unable to load compiled rules %s: %s" %
+                                   (cached_path, e))
+
+        if rules is None:
+            rules = compile_rules()
+            if cached_path:
+                try:
+                    rules.save(cached_path)
+                except (yara.Error, IOError, OSError) as e:
+                    logger.warning("Unable to save compiled rules %s: %s" %
+                                   (cached_path, e))
+
+        with _rules_lock:
+            _rules_cache[key] = (digest, rules)
+        return rules
+
+    @staticmethod
+    def _compile_filepaths(filepaths):
+        # yara resolves includes relative to each file, no chdir needed.
+        try:
+            return yara.compile(filepaths=filepaths,
+                                externals=DEFAULT_EXTERNALS)
+        except yara.SyntaxError as e:
+            message = "Yara rules files: %s" % str(e)
+            logger.exception(message)
+            raise ServiceConfigError(message)
+
+    @staticmethod
+    def _compile_source(sigfile, data):
+        # Change to the directory of the signature file so relative
+        # includes resolve. The externals are only declared here, the
+        # values for each sample are given when matching.
+        old = os.getcwd()
+        try:
+            os.chdir(os.path.dirname(sigfile))
+            return yara.compile(source=data, externals=DEFAULT_EXTERNALS)
+        except yara.SyntaxError as e:
+            message = "Yara rules file: %s: %s" % (sigfile, str(e))
+            logger.exception(message)
+            raise ServiceConfigError(message)
+        except OSError as e:
+            logger.exception("Cannot change to directory of %s" % sigfile)
+            raise ServiceConfigError(str(e))
+        finally:
+            os.chdir(old)
+
     @staticmethod
     def valid_for(obj):
         if obj.filedata.grid_id == None:
@@ -246,38 +407,85 @@ class YaraService(Service):
                 return
             self._info("Submitted job to yara queue.")
         else:
-            data = obj.filedata.read()
             sfpath= str(obj.filename)
             sfname = str(os.path.basename(obj.filename))
             sfext = str(os.path.splitext(sfname))
-            sigsets = self._compile_rules(config['sigdir'], config['sigfiles'], sfpath)
-            for sigset in sigsets:
-                logger.debug("Signature set name: %s" % sigset['name'])
-                self._info("Scanning with %s" % sigset['name'])
-                matches = sigset['rules'].match(data=data,
-                                                 externals = {'filepath': sfpath,
-                                                                'filename': sfname,
-                                                                'extension': sfext })
-                for match in matches:
-                    strings = {}
-                    for s in match.strings:
-                        s_name = s[1]
-                        s_offset = s[0]
-                        try:
-                            s_data = s[2].decode('ascii')
-                        except UnicodeError:
-                            s_data = "Hex: " + binascii.hexlify(s[2])
-                        s_key = "{0}-{1}".format(s_name, s_data)
-                        if s_key in strings:
-                            strings[s_key]['offset'].append(s_offset)
-                        else:
-                            strings[s_key] = {
-                                'offset':       [s_offset],
-                                'name':         s_name,
-                                'data':         s_data,
-                                }
-                    string_list = []
-                    for key in strings:
-                        string_list.append(strings[key])
-                    self._add_result(self.name, match.rule, {'strings': string_list})
+            externals = {'filepath': sfpath,
+                         'filename': sfname,
+                         'extension': sfext }
+            sigsets = self._compile_rules(config['sigdir'], config['sigfiles'],
+                                          config.get('cachedir', ''),
+                                          config.get('merge_sigfiles', False))
+            threshold = int(config.get('spool_threshold') or 0) * 1024 * 1024
+            if threshold and (obj.size or 0) > threshold:
+                # Don't hold large samples in memory, let yara read them
+                # from disk instead.
+                self._info("Sample larger than %s MB, scanning from disk" %
+                           config['spool_threshold'])
+                with self._spool_filedata(obj) as path:
+                    self._scan(sigsets, {'filepath': path}, externals)
+            else:
+                data = obj.filedata.read()
+                self._scan(sigsets, {'data': data}, externals)
             self.current_task.finish()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _spool_filedata(obj, chunk_size=SPOOL_CHUNK_SIZE):
+        """
+        Copy the filedata of an object to a temporary file in chunks and
+        yield the path to it. The file is removed afterwards.
+        """
+
+        f = tempfile.NamedTemporaryFile(prefix='crits_yara_', delete=False)
+        try:
+            with f:
+                shutil.copyfileobj(obj.filedata, f, chunk_size)
+            yield f.name
+        finally:
+            os.unlink(f.name)
+
+    def _scan(self, sigsets, target, externals):
+        # target is either {'data': ...} or {'filepath': ...}.
+        for sigset in sigsets:
+            logger.debug("Signature set name: %s" % sigset['name'])
+            self._info("Scanning with %s" % sigset['name'])
+            matches = sigset['rules'].match(externals=externals, **target)
+            if 'namespaces' not in sigset:
+                for match in matches:
+                    self._add_match(match)
+                continue
+            # Merged rules, attribute matches to their signature file.
+            by_namespace = {}
+            for match in matches:
+                by_namespace.setdefault(match.namespace, []).append(match)
+            for namespace in sigset['namespaces']:
+                ns_matches = by_namespace.get(namespace, [])
+                if ns_matches:
+                    self._info("%d matches from %s" % (len(ns_matches),
+                                                       namespace))
+                for match in ns_matches:
+                    self._add_match(match)
+
+    def _add_match(self, match):
+        strings = {}
+        for s in match.strings:
+            s_name = s[1]
+            s_offset = s[0]
+            try:
+                s_data = s[2].decode('ascii')
+            except UnicodeError:
+                s_data = "Hex: " + binascii.hexlify(s[2])
+            s_key = "{0}-{1}".format(s_name, s_data)
+            if s_key in strings:
+                strings[s_key]['offset'].append(s_offset)
+            else:
+                strings[s_key] = {
+                    'offset':       [s_offset],
+                    'name':         s_name,
+                    'data':         s_data,
+                    }
+        string_list = []
+        for key in strings:
+            string_list.append(strings[key])
+        self._add_result(self.name, match.rule, {'strings': string_list})
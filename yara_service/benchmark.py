@@ -0,0 +1,99 @@
+"""
+Compare scanning with one ruleset per signature file against scanning with
+all signature files merged into a single namespaced ruleset.
+
+Only needs yara-python, a synthetic corpus and signature files are
+generated in a temporary directory.
+
+Example Usage:
+    python benchmark.py -r 50 -p 200 -n 20
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+import yara
+
+
+def make_rules(sigdir, count, rules_per_file):
+    rng = random.Random(1)
+    paths = {}
+    for i in range(count):
+        lines = []
+        for j in range(rules_per_file):
+            needle = ''.join(rng.choice('abcdef0123456789') for _ in range(12))
+            lines.append('rule r_%d_%d { strings: $a = "%s" $b = { %02x %02x %02x } '
+                         'condition: any of them }' %
+                         (i, j, needle, rng.randint(0, 255),
+                          rng.randint(0, 255), rng.randint(0, 255)))
+        name = "sigs_%03d.yara" % i
+        path = os.path.join(sigdir, name)
+        with open(path, "w") as f:
+            f.write("\n".join(lines))
+        paths[name] = path
+    return paths
+
+
+def make_corpus(count, size):
+    return [os.urandom(size) for _ in range(count)]
+
+
+def per_file(rulesets, corpus):
+    hits = 0
+    for data in corpus:
+        for rules in rulesets:
+            hits += len(rules.match(data=data))
+    return hits
+
+
+def merged(rules, corpus):
+    hits = 0
+    for data in corpus:
+        hits += len(rules.match(data=data))
+    return hits
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-r", "--rule-files", action="store", dest="files",
+            type="int", default=50, help="number of signature files")
+    parser.add_option("-p", "--rules-per-file", action="store", dest="rules",
+            type="int", default=200, help="rules in each signature file")
+    parser.add_option("-n", "--samples", action="store", dest="samples",
+            type="int", default=20, help="number of samples")
+    parser.add_option("-s", "--size", action="store", dest="size",
+            type="int", default=1024 * 1024, help="sample size in bytes")
+    (opts, args) = parser.parse_args()
+
+    sigdir = tempfile.mkdtemp(prefix='yara_bench_')
+    try:
+        paths = make_rules(sigdir, opts.files, opts.rules)
+        corpus = make_corpus(opts.samples, opts.size)
+
+        rulesets = [yara.compile(filepath=p) for p in sorted(paths.values())]
+        start = time.time()
+        hits_per_file = per_file(rulesets, corpus)
+        per_file_time = time.time() - start
+
+        rules = yara.compile(filepaths=paths)
+        start = time.time()
+        hits_merged = merged(rules, corpus)
+        merged_time = time.time() - start
+    finally:
+        shutil.rmtree(sigdir)
+
+    mb = opts.samples * opts.size / (1024.0 * 1024.0)
+    print("%d signature files, %d samples, %.1f MB" % (opts.files,
+                                                       opts.samples, mb))
+    print("per-file: %.3fs (%.1f MB/s) %d matches" %
+          (per_file_time, mb / per_file_time, hits_per_file))
+    print("merged:   %.3fs (%.1f MB/s) %d matches" %
+          (merged_time, mb / merged_time, hits_merged))
+
+
+if __name__ == '__main__':
+    main()
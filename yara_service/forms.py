@@ -14,6 +14,19 @@ class YaraConfigForm(forms.Form):
                                widget=forms.Textarea(attrs={'cols': 40,
                                                            'rows': 6}),
                                help_text="Newline separated list of signature files.")
+    cachedir = forms.CharField(required=False,
+                               label="Compiled rules directory",
+                               initial='',
+                               widget=forms.TextInput(),
+                               help_text="Directory to store compiled rules in. Leave blank to only cache in memory.")
+    spool_threshold = forms.IntegerField(required=False,
+                                         label="Disk scan threshold (MB)",
+                                         initial=0,
+                                         help_text="Samples larger than this are copied to a temporary file and scanned from disk. 0 always scans in memory.")
+    merge_sigfiles = forms.BooleanField(required=False,
+                                        label="Merge signature files",
+                                        initial=False,
+                                        help_text="Compile all signature files into one ruleset so each sample is scanned once.")
 
     distribution_url = forms.CharField(required=False,
                                        label="Distribution URL",
@@ -17,7 +17,7 @@ class ZipMetaService(Service):
         if obj.filedata.grid_id == None:
             raise ServiceConfigError("Missing filedata.")
 
-        data = obj.filedata.read()
+        data = obj.filedata.read(4)
         # Reset the read pointer.
         obj.filedata.seek(0)
 
@@ -28,7 +28,8 @@ class ZipMetaService(Service):
             raise ServiceConfigError("Not a zip file.")
 
     def run(self, obj, config):
-        zparser = ZipParser(obj.filedata.read())
+        # The parser seeks around the GridFS file and only reads what it needs.
+        zparser = ZipParser(obj.filedata)
         parsedZip =  zparser.parseZipFile()
         if not parsedZip:
             self._error("Could not parse document as a zip file")
@@ -1,5 +1,6 @@
 import struct
 import binascii
+from cStringIO import StringIO
 from datetime import datetime
 from pprint import pprint
 import extra_field_parse
@@ -41,37 +42,45 @@ class ZipParser():
     def getExtraField(self):
         if self.getExtraFieldLDLength() == 0:
             return None
-        #Handler for case where offset cannot be found in central Directory
-        if self.zip64Flag["offsetZip64"]:
-            #If Offset flag present use central directory to find offset in extrafield
-            startPosition = (46 + self.getFileNameLength())
-            extraField = self.centralDirectory[startPosition:(startPosition + self.getExtraFieldCDLength())]
-
-            efParser = extra_field_parse.HeaderIdMapping()
-            efMappings = efParser.HeaderIds()
-
-            start = extraField.find("\x01\x00")
-            blockMagic = extraField[start:start + 2]
-            blockSize = struct.unpack("<H", extraField[start + 2:start + 4])[0]
-            parser = efMappings[blockMagic]["parseField"]()
-            zip64 = parser.parse(efBlock,self.zip64Flag)
-            offset = zip64["RelativeOffset"]
-
-            startPosition = (offset + 30 + self.getFileNameLength())
-            extraField = self.localDirectory[startPosition:(startPosition + self.getExtraFieldLDLength())]
-        else:
-            startPosition = (self.getRelativeOffset() + 30 + self.getFileNameLength())
-            extraField = self.localDirectory[startPosition:(startPosition + self.getExtraFieldLDLength())]
+        startPosition = (self.getLocalHeaderOffset() + 30 + self.getFileNameLength())
+        extraField = self.readLocal(startPosition, self.getExtraFieldLDLength())
         return self.parseExtraField(extraField)
 
+    def getLocalHeaderOffset(self):
+        offset = self.getRelativeOffset()
+        if not self.zip64Flag["offsetZip64"]:
+            return offset
+        #If Offset flag present use central directory to find offset in extrafield
+        startPosition = (46 + self.getFileNameLength())
+        extraField = self.centralDirectory[startPosition:(startPosition + self.getExtraFieldCDLength())]
+        efParser = extra_field_parse.HeaderIdMapping()
+        efMappings = efParser.HeaderIds()
+        start = extraField.find("\x01\x00")
+        if start == -1:
+            return 0
+        blockSize = struct.unpack("<H", extraField[start + 2:start + 4])[0]
+        efBlock = extraField[start:start + 4 + blockSize]
+        parser = efMappings["\x01\x00"]["parseField"]()
+        zip64 = parser.parse(efBlock,self.zip64Flag)
+        return zip64["RelativeOffset"][0]
+
+    def readLocal(self, offset, length):
+        #Read from the archive, but never past the start of the central directory.
+        length = max(0, min(length, self.cdStart - offset))
+        if offset < 0 or not length:
+            return ""
+        self.file.seek(offset)
+        return self.file.read(length)
+
     def getExtraFieldCDLength(self): #Central Directory
         length = struct.unpack("<H", self.centralDirectory[30:32])[0]
         return length
 
     def getExtraFieldLDLength(self): #Local Directory
-        length = struct.unpack("<H", self.localDirectory[self.getRelativeOffset()
-                                +28:self.getRelativeOffset()+30])[0]
-        return length
+        length = self.readLocal(self.getLocalHeaderOffset() + 28, 2)
+        if len(length) < 2:
+            return 0
+        return struct.unpack("<H", length)[0]
 
     def getModifyDate(self):
         #MS-DOS Epoch
@@ -272,24 +281,36 @@ class ZipParser():
 
         return centralDirectory
 
+    def getCDEntryLength(self, offset):
+        nameLength, extraLength, commentLength = struct.unpack("<HHH",
+                self.cdData[offset + 28:offset + 34])
+        return 46 + nameLength + extraLength + commentLength
+
     def parseZipFile(self):
         #Because a central directory is an extended version of a local
         #directory and thus, contains more data, we parse it rather than
         #the local directory.
-        if not self.centralDirectory.startswith(self.zipCDMagic):
+        if not self.cdData.startswith(self.zipCDMagic):
             return None
-        start = 1
         parsedFiles = []
-        while start > 0:
+        offset = 0
+        #Walk the entries by their declared lengths rather than searching
+        #for the next magic, so each entry is only sliced once.
+        while (offset + 46 <= len(self.cdData) and
+               self.cdData[offset:offset + 4] == self.zipCDMagic):
+            length = self.getCDEntryLength(offset)
+            for flag in self.zip64Flag:
+                self.zip64Flag[flag] = False
+            self.centralDirectory = self.cdData[offset:offset + length]
             parsedFiles.append(self.parseCentralDirectory())
-            start = self.centralDirectory[1:].find(self.zipCDMagic) +1
-            self.centralDirectory = self.centralDirectory[start:]
+            offset += length
         return parsedFiles
 
 #***************************END**DIRECTORY**PARSING*****************************
 
     def getHeaderSignature(self):
-        return self.data[0:4]
+        self.file.seek(0)
+        return self.file.read(4)
 
     def getCDComment(self):
         if self.endDirectory[22:(22 + self.getCDCommentLength())] == 0:
@@ -318,9 +339,20 @@ class ZipParser():
     def getNumberOfDisk(self):
         return struct.unpack("<H",self.endDirectory[4:6])[0]
 
+    def findEndDirectory(self):
+        #The end of central directory record is at the end of the file,
+        #followed by at most a 64k comment, so search backwards from the end.
+        self.file.seek(0, 2)
+        size = self.file.tell()
+        tailSize = min(size, 22 + 0xFFFF)
+        self.file.seek(size - tailSize)
+        tail = self.file.read(tailSize)
+        start = tail.rfind("\x50\x4b\x05\x06")
+        if start == -1 or len(tail) - start < 22:
+            return None
+        return tail[start:]
+
     def parseEndDirectory(self):
-        start = self.data.find("\x50\x4b\x05\x06")
-        self.endDirectory = self.data[start:]
         endDirectoryDict = {
         "NumberOfDisk"              :self.getNumberOfDisk(),
         "StartOfCDDisk"             :self.getStartOfCDDisk(),
@@ -335,11 +367,19 @@ class ZipParser():
 #***********************END**DIRECTORY**PARSING**ENDS***************************
 
     def __init__(self,data):
-        self.data = data
-        cdStart = self.parseEndDirectory()["CDStartOffset"]
-        cdEnd = cdStart + self.parseEndDirectory()["CDSize"]
-        self.localDirectory = data[:cdStart]
-        self.centralDirectory = data[cdStart:cdEnd]
+        #data is a seekable file-like object. A string is also accepted.
+        if isinstance(data, basestring):
+            data = StringIO(data)
+        self.file = data
+        self.cdStart = 0
+        self.cdData = ""
+        self.centralDirectory = ""
+        self.endDirectory = self.findEndDirectory()
+        if self.endDirectory:
+            self.cdStart = self.getCDStartOffset()
+            self.file.seek(self.cdStart)
+            self.cdData = self.file.read(self.getSizeOfCD())
+            self.centralDirectory = self.cdData
         # Flags needed to denote a zip64 file type
         self.zip64Flag = {"ucZip64"     : False,
                           "cZip64"      : False,